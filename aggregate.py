@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+
+
+def to_datetime(value):
+    """
+    received_at はDBから読むとdatetime，受信データでは 'yymmddHHMMSS' の文字列
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value), '%y%m%d%H%M%S')
+
+
+class MoistureStats(object):
+    """
+    1センサ分の土中水分量の集計値
+    min/max/count/sum は全履歴，窓の中の最小値は (received_at, moisture) の単調deque で持つ．
+    窓は最新のデータから測るので，履歴を再生しても受信時と同じ値になる
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'window', 'newest', 'window_min')
+
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.window = window
+        self.newest = None
+        self.window_min = deque()
+
+    def add(self, received_at, moisture):
+        self.count += 1
+        self.total += moisture
+        if self.min is None or moisture < self.min:
+            self.min = moisture
+        if self.max is None or moisture > self.max:
+            self.max = moisture
+        self.add_to_window(to_datetime(received_at), moisture)
+
+    def add_to_window(self, received_at, moisture):
+        if self.window is None:
+            return
+        if received_at is not None and (self.newest is None or received_at > self.newest):
+            self.newest = received_at
+        while self.window_min and self.window_min[-1][1] >= moisture:
+            self.window_min.pop()
+        self.window_min.append((received_at, moisture))
+        if self.newest is not None:
+            oldest = self.newest - self.window
+            while len(self.window_min) > 1 and self.window_min[0][0] is not None \
+                    and self.window_min[0][0] < oldest:
+                self.window_min.popleft()
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def windowed_min(self):
+        if self.window is None:
+            return self.min
+        return self.window_min[0][1] if self.window_min else None
+
+
+class MoistureAggregate(object):
+    """
+    全土中水分センサの集計値
+    loader(sensor_id, window) は最初に参照したときに履歴から1センサ分を作り，
+    (count, total, min, max, recent) を返す．recent は窓の中の (received_at, moisture) の古い順のリスト
+    """
+
+    def __init__(self, loader, window_days=30):
+        self.loader = loader
+        self.window = timedelta(days=window_days) if window_days > 0 else None
+        self._stats = {}
+        self._lock = threading.RLock()
+
+    def _get(self, sensor_id):
+        stats = self._stats.get(sensor_id)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.get(sensor_id)
+                if stats is None:
+                    stats = self.rebuild(sensor_id)
+        return stats
+
+    def rebuild(self, sensor_id):
+        count, total, lo, hi, recent = self.loader(sensor_id, self.window)
+        stats = MoistureStats(self.window)
+        stats.count, stats.total, stats.min, stats.max = count or 0, total or 0.0, lo, hi
+        for received_at, moisture in recent:
+            stats.add_to_window(to_datetime(received_at), moisture)
+        with self._lock:
+            self._stats[sensor_id] = stats
+        return stats
+
+    def add(self, sensor_id, received_at, moisture):
+        with self._lock:
+            self._get(sensor_id).add(received_at, moisture)
+
+    def min(self, sensor_id):
+        """
+        a(t) で使う最小値．ウィンドウが設定されていればその期間内の最小値
+        """
+        return self._get(sensor_id).windowed_min()
+
+    def stats(self, sensor_id):
+        return self._get(sensor_id)
+
+    def has(self, sensor_id):
+        return sensor_id in self._stats
+
+    def invalidate(self, sensor_id=None):
+        with self._lock:
+            if sensor_id is None:
+                self._stats.clear()
+            else:
+                self._stats.pop(sensor_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((sensor_id, (stats.count, stats.total, stats.min, stats.max, stats.newest,
+                                     list(stats.window_min)))
+                        for sensor_id, stats in self._stats.items())
+
+    def restore(self, snapshot):
+        with self._lock:
+            for sensor_id, (count, total, lo, hi, newest, window_min) in snapshot.items():
+                stats = MoistureStats(self.window)
+                stats.count, stats.total, stats.min, stats.max, stats.newest = count, total, lo, hi, newest
+                stats.window_min.extend(window_min)
+                self._stats[sensor_id] = stats
+
+
+def rainfall_since(previous, accumulation):
+    """
+    積算雨量 (V) の前回からの増分．積算値がリセットされたら今回の値をそのまま使う
+    """
+    if accumulation is None or previous is None:
+        return 0.0
+    if accumulation < previous:
+        return accumulation
+    return accumulation - previous
+
+
+class RainfallWindow(object):
+    """
+    直近 window の雨量の合計．サンプルは1回ずつ入って1回ずつ出るので，1件あたりO(1)
+    """
+    __slots__ = ('window', 'samples', 'total')
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+
+    def add(self, received_at, rainfall):
+        self.samples.append((received_at, rainfall))
+        self.total += rainfall
+
+    def expire(self, newest):
+        oldest = newest - self.window
+        while self.samples and self.samples[0][0] <= oldest:
+            self.total -= self.samples.popleft()[1]
+        if not self.samples:
+            # 足し引きの誤差を残さない
+            self.total = 0.0
+
+
+class RainfallTotals(object):
+    """
+    1センサ分の期間ごとの雨量の合計
+    期間は土中水分の窓と同じく最新のデータから測る
+    """
+    __slots__ = ('windows', 'accumulation', 'newest')
+
+    def __init__(self, windows):
+        self.windows = [(name, RainfallWindow(window)) for name, window in windows]
+        self.accumulation = None
+        self.newest = None
+
+    def add(self, received_at, rainfall):
+        if received_at is not None and (self.newest is None or received_at > self.newest):
+            self.newest = received_at
+        for _, window in self.windows:
+            window.add(received_at, rainfall)
+            if self.newest is not None:
+                window.expire(self.newest)
+
+    def add_accumulation(self, received_at, accumulation):
+        """
+        積算雨量を追加し，前回からの雨量を返す
+        """
+        rainfall = rainfall_since(self.accumulation, accumulation)
+        if accumulation is not None:
+            self.accumulation = accumulation
+        self.add(received_at, rainfall)
+        return rainfall
+
+    def totals(self):
+        return OrderedDict((name, window.total) for name, window in self.windows)
+
+
+# 雨量を合計する期間
+RAIN_WINDOWS = (('1h', timedelta(hours=1)), ('3h', timedelta(hours=3)), ('24h', timedelta(hours=24)))
+
+
+class RainfallAggregate(object):
+    """
+    全気象センサの期間ごとの雨量
+    loader(sensor_id, window) は最初に参照したときに (accumulation, recent) を返す．
+    accumulation は最後の積算雨量 (V)，recent は一番長い期間の中の (received_at, rainfall) の古い順のリスト
+    """
+
+    def __init__(self, loader, windows=RAIN_WINDOWS):
+        self.loader = loader
+        self.windows = windows
+        self.longest = max(window for _, window in windows)
+        self._totals = {}
+        self._lock = threading.RLock()
+
+    def _get(self, sensor_id):
+        totals = self._totals.get(sensor_id)
+        if totals is None:
+            with self._lock:
+                totals = self._totals.get(sensor_id)
+                if totals is None:
+                    accumulation, recent = self.loader(sensor_id, self.longest)
+                    totals = RainfallTotals(self.windows)
+                    for received_at, rainfall in recent:
+                        totals.add(to_datetime(received_at), rainfall or 0.0)
+                    totals.accumulation = accumulation
+                    self._totals[sensor_id] = totals
+        return totals
+
+    def add(self, sensor_id, received_at, accumulation):
+        with self._lock:
+            return self._get(sensor_id).add_accumulation(to_datetime(received_at), accumulation)
+
+    def totals(self, sensor_id):
+        """
+        {'1h': 雨量, '3h': 雨量, '24h': 雨量}
+        """
+        with self._lock:
+            return self._get(sensor_id).totals()
+
+    def has(self, sensor_id):
+        return sensor_id in self._totals
+
+    def invalidate(self, sensor_id=None):
+        with self._lock:
+            if sensor_id is None:
+                self._totals.clear()
+            else:
+                self._totals.pop(sensor_id, None)
+
+    def replay(self, sensor_id, received_at, rainfall, accumulation):
+        """
+        保存済みの雨量を追加する (スナップショットの後にDBに書かれたデータ用)
+        """
+        received_at = to_datetime(received_at)
+        with self._lock:
+            totals = self._get(sensor_id)
+            if totals.newest is not None and received_at <= totals.newest:
+                return
+            totals.add(received_at, rainfall or 0.0)
+            if accumulation is not None:
+                totals.accumulation = accumulation
+
+    def snapshot(self):
+        # 一番長い期間のサンプルがあれば，短い期間の合計も作り直せる
+        with self._lock:
+            snapshot = {}
+            for sensor_id, totals in self._totals.items():
+                longest = max(totals.windows, key=lambda window: window[1].window)[1]
+                snapshot[sensor_id] = (totals.accumulation, list(longest.samples))
+            return snapshot
+
+    def restore(self, snapshot):
+        with self._lock:
+            for sensor_id, (accumulation, samples) in snapshot.items():
+                totals = RainfallTotals(self.windows)
+                for received_at, rainfall in samples:
+                    totals.add(received_at, rainfall)
+                totals.accumulation = accumulation
+                self._totals[sensor_id] = totals
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+傾斜と土中水分の履歴の列ごとのアーカイブ．numpy.memmap で読む
+"""
+
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+from sqlalchemy import select
+
+import numpy as np
+
+import db
+import cache
+import logs
+
+logger = logs.get_logger(__name__, 'archive')
+
+VERSION = 1
+
+# 種類ごとの (列, dtype)．DBのNULLは浮動小数点ならNaN，整数なら-1にする
+COLUMNS = {
+    cache.TILT: [
+        ('received_at', 'M8[us]'),
+        ('observed_at', '<i8'),
+        ('node_state', '<i4'),
+        ('battery_voltage', '<f8'),
+        ('tilt_x', '<f8'),
+        ('tilt_y', '<f8'),
+        ('tempereture', '<f8'),
+        ('table_id', '<i4'),
+    ],
+    cache.SOIL: [
+        ('received_at', 'M8[us]'),
+        ('data_get_at', 'S20'),
+        ('moisture', '<f8'),
+        ('tempereture', '<f8'),
+        ('ec', '<f8'),
+    ],
+}
+
+MISSING = {'f': np.nan, 'i': -1, 'M': np.datetime64('NaT'), 'S': b''}
+
+
+def tables():
+    return {
+        cache.TILT: (db.TiltSensorData.__table__, db.TiltSensor.__table__),
+        cache.SOIL: (db.SoilSensorData.__table__, db.SoilSensor.__table__),
+    }
+
+
+def to_array(rows, column, dtype):
+    dtype = np.dtype(dtype)
+    missing = MISSING[dtype.kind]
+    values = [getattr(row, column) for row in rows]
+    return np.array([missing if value is None else value for value in values], dtype=dtype)
+
+
+class Series(object):
+    """
+    1センサ分の列．列は読み込み専用のmemmap
+    """
+
+    def __init__(self, path, kind, meta):
+        self.path = path
+        self.kind = kind
+        self.meta = meta
+        self.count = meta['count']
+        self._columns = OrderedDict()
+
+    def column(self, name):
+        values = self._columns.get(name)
+        if values is None:
+            dtype = np.dtype(dict(COLUMNS[self.kind])[name])
+            if self.count == 0:
+                values = np.empty(0, dtype=dtype)
+            else:
+                values = np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(self.count,))
+            self._columns[name] = values
+        return values
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def __len__(self):
+        return self.count
+
+    def columns(self):
+        return OrderedDict((name, self.column(name)) for name, _ in COLUMNS[self.kind])
+
+    def bounds(self, since=None, until=None):
+        """
+        received_at が [since, until) の行の範囲 (start, stop)．時刻順に並んでいるときだけ使える
+        """
+        at = self.column('received_at')
+        start = 0 if since is None else int(np.searchsorted(at, np.datetime64(since, 'us'), 'left'))
+        stop = self.count if until is None else int(np.searchsorted(at, np.datetime64(until, 'us'), 'left'))
+        return start, stop
+
+    def range(self, since=None, until=None):
+        """
+        received_at が [since, until) の行の {列: 配列}．時刻順なら memmap のスライス (コピーなし)
+        """
+        if self.meta['ordered']:
+            start, stop = self.bounds(since, until)
+            return OrderedDict((name, values[start:stop]) for name, values in self.columns().items())
+        at = self.column('received_at')
+        mask = np.ones(self.count, dtype=bool)
+        if since is not None:
+            mask &= at >= np.datetime64(since, 'us')
+        if until is not None:
+            mask &= at < np.datetime64(until, 'us')
+        return OrderedDict((name, values[mask]) for name, values in self.columns().items())
+
+
+class Archive(object):
+    """
+    <root>/<kind>/<sensor_id>/ に列ごとのファイルと meta.json を置く
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def sensor_path(self, kind, sensor_id):
+        return os.path.join(self.root, kind, str(sensor_id))
+
+    def read_meta(self, kind, sensor_id):
+        path = os.path.join(self.sensor_path(kind, sensor_id), 'meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_meta(self, kind, sensor_id, meta):
+        path = os.path.join(self.sensor_path(kind, sensor_id), 'meta.json')
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(meta, f)
+        os.rename(temporary, path)
+
+    def sensors(self, kind):
+        directory = os.path.join(self.root, kind)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(name) for name in os.listdir(directory) if name.isdigit()
+                      and self.read_meta(kind, int(name)) is not None)
+
+    def series(self, kind, sensor_id):
+        meta = self.read_meta(kind, sensor_id)
+        if meta is None:
+            raise KeyError("no archive for {0} sensor {1}".format(kind, sensor_id))
+        return Series(self.sensor_path(kind, sensor_id), kind, meta)
+
+    def append(self, kind, sensor_id, rows, mac=None):
+        """
+        id順の行をセンサの列に追加する．追加した行数を返す
+        """
+        path = self.sensor_path(kind, sensor_id)
+        meta = self.read_meta(kind, sensor_id)
+        if meta is None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            meta = {'version': VERSION, 'count': 0, 'last_id': 0, 'mac': mac, 'ordered': True, 'last_at': None}
+        rows = [row for row in rows if row.id > meta['last_id']]
+        if not rows:
+            return 0
+        for name, dtype in COLUMNS[kind]:
+            values = to_array(rows, name, dtype)
+            with open(os.path.join(path, name), 'ab') as f:
+                # 前回途中で止まった分は上書きする
+                f.truncate(meta['count'] * values.dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(values.tobytes())
+            if name == 'received_at':
+                at = values.astype('<i8')
+                ordered = bool(np.all(at[1:] >= at[:-1]))
+                if meta['last_at'] is not None:
+                    ordered = ordered and bool(at[0] >= meta['last_at'])
+                meta['ordered'] = meta['ordered'] and ordered
+                meta['last_at'] = int(at[-1])
+        meta['count'] += len(rows)
+        meta['last_id'] = rows[-1].id
+        if mac is not None:
+            meta['mac'] = mac
+        self.write_meta(kind, sensor_id, meta)
+        return len(rows)
+
+    def position(self, kind):
+        """
+        DBのどのidまで読んだか．センサごとの meta.json の後に書く
+        """
+        path = os.path.join(self.root, '{0}.json'.format(kind))
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return json.load(f)['last_id']
+
+    def set_position(self, kind, last_id):
+        path = os.path.join(self.root, '{0}.json'.format(kind))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'last_id': last_id}, f)
+        os.rename(path + '.tmp', path)
+
+    def sync(self, engine, chunk_size=10000):
+        """
+        前回から増えたDBの行を追加し，種類ごとの追加した行数を返す
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        appended = {}
+        for kind, (table, sensor_table) in tables().items():
+            with engine.connect() as conn:
+                macs = dict(conn.execute(select([sensor_table.c.id, sensor_table.c.mac])).fetchall())
+            # 途中で止まっていたら，センサごとの last_id までの行は append で飛ばされる
+            last_id = self.position(kind)
+            total = 0
+            while True:
+                with engine.connect() as conn:
+                    rows = conn.execute(select([table]).where(table.c.id > last_id)
+                                        .order_by(table.c.id).limit(chunk_size)).fetchall()
+                if not rows:
+                    break
+                by_sensor = OrderedDict()
+                for row in rows:
+                    by_sensor.setdefault(row.sensor_id, []).append(row)
+                for sensor_id, sensor_rows in by_sensor.items():
+                    if sensor_id is not None:
+                        total += self.append(kind, sensor_id, sensor_rows, macs.get(sensor_id))
+                last_id = rows[-1].id
+                self.set_position(kind, last_id)
+            appended[kind] = total
+        logger.info("archived {0}".format(appended))
+        return appended
+
+
+def main():
+    parser = argparse.ArgumentParser(description='columnar archive of the sensor history')
+    parser.add_argument('command', choices=['sync', 'run', 'info'])
+    parser.add_argument('--dir', default=os.getenv('SSS_ARCHIVE_DIR', './archive'))
+    parser.add_argument('--chunk-size', type=int, default=int(os.getenv('SSS_ARCHIVE_CHUNK_SIZE', '10000')))
+    parser.add_argument('--interval', type=float, default=3600.0)
+    args = parser.parse_args()
+
+    archive = Archive(args.dir)
+    if args.command == 'sync':
+        started = time.time()
+        appended = archive.sync(db.engine, args.chunk_size)
+        print("{0} in {1:.1f}s".format(appended, time.time() - started))
+    elif args.command == 'run':
+        while True:
+            try:
+                archive.sync(db.engine, args.chunk_size)
+            except Exception:
+                logger.exception("archive failed")
+            time.sleep(args.interval)
+    else:
+        for kind in (cache.TILT, cache.SOIL):
+            for sensor_id in archive.sensors(kind):
+                series = archive.series(kind, sensor_id)
+                at = series['received_at']
+                print("{0} {1:>5} {2:20} {3:>9} rows {4} .. {5}{6}".format(
+                    kind, sensor_id, series.meta['mac'], len(series),
+                    at[0] if len(series) else '-', at[-1] if len(series) else '-',
+                    '' if series.meta['ordered'] else ' (unordered)'))
+
+
+if __name__ == '__main__':
+    main()
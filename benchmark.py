@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+受信から検知までのベンチマーク
+
+    python benchmark.py --sites 10 --messages 5000 --mode direct|pipeline
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import subprocess
+import threading
+from datetime import datetime, timedelta
+
+import metrics
+import payload
+
+
+class Message(object):
+    """
+    paho の MQTTMessage の代わり
+    """
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class Client(object):
+    """
+    paho の Client の代わり．パブリッシュしたメッセージを記録する
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+
+def tilt_mac(site, sensor):
+    return '00:1D:12:90:{0:02X}:{1:02X}:00:{2:02X}'.format(site // 256, site % 256, sensor)
+
+
+def soil_mac(site):
+    return '10:50:C2:FF:{0:02X}:{1:02X}:00:01'.format(site // 256, site % 256)
+
+
+def weather_mac(site):
+    return '20:00:00:00:{0:02X}:{1:02X}:00:01'.format(site // 256, site % 256)
+
+
+def timestamp(at):
+    return at.strftime('%y%m%d%H%M%S')
+
+
+def tilt_payload(mac, at, observations=1, rng=random):
+    """
+    52660, mac, received_at, node id, node state, battery voltage, number of observed data,
+    [observed time, tilt x, tilt y, temperature, table id] * number of observed data
+    """
+    fields = ['52660', mac, timestamp(at), mac.replace(':', '').lower(), '00', '3.3', str(observations)]
+    for i in range(observations):
+        fields += [str(int(time.mktime(at.timetuple())) + i),
+                   '{0:.3f}'.format(rng.gauss(0.0, 1.0)), '{0:.3f}'.format(rng.gauss(0.0, 1.0)),
+                   '{0:.1f}'.format(rng.uniform(5.0, 25.0)), '8']
+    return ','.join(fields)
+
+
+def soil_payload(mac, at, rng=random):
+    """
+    52652, mac, received_at, command_id, sensor_type_id, data_size, data_get_time, data_type,
+    temperature, moisture, ec
+    """
+    return ','.join(['52652', mac, timestamp(at), '4002', '1001', '14', timestamp(at), '0003',
+                     '{0:.2f}'.format(rng.uniform(5.0, 25.0)), '{0:.2f}'.format(rng.uniform(5.0, 40.0)), '0'])
+
+
+def weather_payload(mac, at, rng=random):
+    """
+    0, mac, received_at, $WIXDR, V (雨量), Z (降雨時間), R (雨の強さ) の測定値
+    """
+    intensity = rng.expovariate(1 / 5.0)
+    return ','.join(['0', mac, timestamp(at), '$WIXDR',
+                     'V', '{0:.2f}'.format(rng.uniform(0.0, 10.0)), 'M', '0',
+                     'Z', '0', 's', '0',
+                     'R', '{0:.1f}'.format(intensity), 'M', '0'])
+
+
+def topology(sites, tilts_per_site):
+    return {
+        'default': 'site0',
+        'sites': [{
+            'name': 'site{0}'.format(i),
+            'groups': {'ABCD': [tilt_mac(i, k) for k in range(tilts_per_site)]},
+            'default_group': 'ABCD',
+            'soil': soil_mac(i),
+            'weather': weather_mac(i),
+            'thresholds': {'alert': 50.0, 'caution': 10.0},
+        } for i in range(sites)]
+    }
+
+
+def messages(sites, tilts_per_site, count, mix, observations, seed, batch=0):
+    """
+    mix: (傾斜, 土中水分, 気象) の比率
+    batch: 0ならCSV，1以上ならbatch件ずつまとめたバイナリ形式のメッセージ
+    """
+    if batch:
+        frames = []
+        for kind, msg in messages(sites, tilts_per_site, count, mix, observations, seed):
+            frames.extend(payload.parse(msg.payload))
+            if len(frames) == batch:
+                yield 'binary', Message('sensor/data', payload.pack(frames))
+                frames = []
+        if frames:
+            yield 'binary', Message('sensor/data', payload.pack(frames))
+        return
+
+    rng = random.Random(seed)
+    kinds = ['tilt'] * mix[0] + ['soil'] * mix[1] + ['weather'] * mix[2]
+    at = datetime(2017, 1, 1)
+    for i in range(count):
+        at += timedelta(seconds=1)
+        site = rng.randrange(sites)
+        kind = rng.choice(kinds)
+        if kind == 'tilt':
+            data = tilt_payload(tilt_mac(site, rng.randrange(tilts_per_site)), at, observations, rng)
+        elif kind == 'soil':
+            data = soil_payload(soil_mac(site), at, rng)
+        else:
+            data = weather_payload(weather_mac(site), at, rng)
+        yield kind, Message('sensor/data', data)
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+    return {
+        'count': len(values),
+        'mean_ms': 1000.0 * sum(values) / len(values),
+        'p50_ms': 1000.0 * pick(50),
+        'p95_ms': 1000.0 * pick(95),
+        'p99_ms': 1000.0 * pick(99),
+        'max_ms': 1000.0 * values[-1],
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup(args, workdir):
+    """
+    環境変数を設定してからDBと検知器を読み込む
+    """
+    import feedback_stub
+    stub = feedback_stub.StubGateway(cert=os.path.join(workdir, 'stub.crt'),
+                                     key=os.path.join(workdir, 'stub.key')).start()
+    topology_path = os.path.join(workdir, 'topology.json')
+    with open(topology_path, 'w') as f:
+        json.dump(topology(args.sites, args.tilts), f)
+    os.environ['SSS_TOPOLOGY'] = topology_path
+    os.environ['SSS_DB_URL'] = args.db_url or 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['SSS_FB_HOST'] = stub.url
+    os.environ['SSS_FB_CERT'] = os.path.join(workdir, 'stub.crt')
+    os.environ['SSS_FB_KEY'] = os.path.join(workdir, 'stub.key')
+    os.environ['SSS_WORKERS'] = str(args.workers)
+
+    import db
+    db.reset_table()
+    for i in range(args.sites):
+        for k in range(args.tilts):
+            db.add_tilt_sensor('bench', tilt_mac(i, k), 1000)
+        db.session.add(db.SoilSensor(name='bench', mac=soil_mac(i), threshold=1000))
+    db.session.commit()
+    db.sensor_registry.reload()
+    # 検知には各センサの最新のデータが必要
+    at = datetime(2017, 1, 1)
+    for i in range(args.sites):
+        for k in range(args.tilts):
+            mac = tilt_mac(i, k)
+            db.add_tilt_data(db.get_sensor('52660', mac).id, payload.parse(tilt_payload(mac, at))[0])
+        db.add_soil_data(db.get_sensor('52652', soil_mac(i)).id, payload.parse(soil_payload(soil_mac(i), at))[0])
+    db.add_event(0, 0.0, 'site0', flush=True)
+    db.end_transaction()
+
+    import detector_runner
+    return db, detector_runner, stub
+
+
+class Timed(object):
+    """
+    関数の処理時間を記録する
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.seconds = []
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        started = time.time()
+        try:
+            return self.function(*args)
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                self.seconds.append(elapsed)
+
+
+def run_direct(args, db, runner, workload):
+    client = Client()
+    parse = Timed(lambda msg: payload.parse(msg.payload))
+    detect = Timed(runner.detector.detect)
+
+    def detect_unit(frame):
+        # detector_runner.process と同じく1フレームずつ unit_of_work で囲む
+        with db.unit_of_work():
+            return detect(frame)
+
+    unit = Timed(detect_unit)
+    publish = Timed(lambda event: runner.publish(client, event))
+    total = []
+    by_kind = {}
+
+    started = time.time()
+    for kind, msg in workload:
+        t0 = time.time()
+        for frame in parse(msg):
+            event = unit(frame)
+            if event is not None:
+                publish(event)
+        elapsed = time.time() - t0
+        by_kind.setdefault(kind, []).append(elapsed)
+        total.append(elapsed)
+    flush = Timed(db.write_buffer.flush)
+    flush()
+    elapsed = time.time() - started
+    return elapsed, {
+        'parse': percentiles(parse.seconds),
+        'detect': percentiles(detect.seconds),
+        'unit_of_work': percentiles(unit.seconds),
+        'publish': percentiles(publish.seconds),
+        'final_flush': percentiles(flush.seconds),
+        'total': percentiles(total),
+        'by_kind': dict((kind, percentiles(values)) for kind, values in by_kind.items()),
+    }
+
+
+def run_pipeline(args, db, runner, workload):
+    from pipeline import Pipeline
+    client = Client()
+    submitted = {}
+    end_to_end = []
+    lock = threading.Lock()
+    done = threading.Event()
+    detect = Timed(runner.process)
+
+    def handler(msg):
+        try:
+            events = detect(msg)
+        except Exception:
+            finished(msg)
+            raise
+        if not events:
+            finished(msg)
+            return None
+        return (msg, events)
+
+    def finished(msg):
+        with lock:
+            end_to_end.append(time.time() - submitted.pop(id(msg)))
+            if not submitted and sent[0] == len(workload):
+                done.set()
+
+    def publisher(item):
+        msg, events = item
+        for event in events:
+            runner.publish(client, event)
+        finished(msg)
+
+    pipeline = Pipeline(handler, publisher, workers=args.workers, queue_size=args.queue_size,
+                        policy=args.policy).start()
+    sent = [0]
+    started = time.time()
+    for i, (kind, msg) in enumerate(workload):
+        if args.rate > 0:
+            delay = started + float(i) / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        with lock:
+            submitted[id(msg)] = time.time()
+            sent[0] += 1
+        if not pipeline.submit(msg):
+            with lock:
+                submitted.pop(id(msg), None)
+    with lock:
+        if not submitted:
+            done.set()
+    done.wait(args.timeout)
+    db.write_buffer.flush()
+    elapsed = time.time() - started
+    stats = pipeline.stats()
+    return elapsed, {
+        'detect': percentiles(detect.seconds),
+        'end_to_end': percentiles(end_to_end),
+        'dropped': stats['dropped'],
+        'pipeline': stats['latency'],
+    }
+
+
+def compare(path):
+    if not os.path.exists(path):
+        print("no results in {0}".format(path))
+        return
+    print("{0:<20} {1:<10} {2:<9} {3:>8} {4:>10} {5:>9} {6:>9} {7:>9}".format(
+        'date', 'revision', 'mode', 'messages', 'msg/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    with open(path) as f:
+        for line in f:
+            result = json.loads(line)
+            latency = result['stages'].get('total') or result['stages'].get('end_to_end')
+            print("{0:<20} {1:<10} {2:<9} {3:>8} {4:>10.1f} {5:>9.3f} {6:>9.3f} {7:>9.3f}".format(
+                result['date'][:19], result['revision'] or '-', result['params']['mode'],
+                result['params']['messages'], result['throughput'],
+                latency.get('p50_ms', 0), latency.get('p95_ms', 0), latency.get('p99_ms', 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the ingest and detect path')
+    parser.add_argument('--mode', choices=['direct', 'pipeline'], default='direct')
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--tilts', type=int, default=4, help='tilt sensors per site')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--observations', type=int, default=1, help='observations per tilt message')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='frames per binary message, 0 for one CSV payload per message')
+    parser.add_argument('--mix', default='8,1,1', help='ratio of tilt, soil and weather messages')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second in pipeline mode, 0 for unpaced')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--policy', default='block')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-url', help='database to run against, a temporary SQLite file by default')
+    parser.add_argument('--results', default='bench_results')
+    parser.add_argument('--compare', action='store_true', help='print stored results and exit')
+    args = parser.parse_args()
+
+    results_path = os.path.join(args.results, 'results.jsonl')
+    if args.compare:
+        compare(results_path)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='sss_bench_')
+    db, runner, stub = setup(args, workdir)
+    # ベンチマーク中は1件ごとのログを出さない
+    import logging
+    for name in ('db', 'detector_v1', 'detector_runner', 'writer', 'dispatcher', 'pipeline'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    mix = [int(v) for v in args.mix.split(',')]
+    workload = list(messages(args.sites, args.tilts, args.messages, mix, args.observations, args.seed, args.batch))
+    if args.mode == 'direct':
+        elapsed, stages = run_direct(args, db, runner, workload)
+    else:
+        elapsed, stages = run_pipeline(args, db, runner, workload)
+    db.table_dispatcher.wait(30)
+    stub.stop()
+
+    result = {
+        'date': datetime.now().isoformat(),
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'db': db.engine.url.drivername,
+        'params': vars(args),
+        'seconds': elapsed,
+        'throughput': args.messages / elapsed if elapsed else 0.0,
+        'stages': stages,
+        'table_commands': stub.requests,
+        'db_queries': metrics.db_queries.value(),
+    }
+    if not os.path.exists(args.results):
+        os.makedirs(args.results)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
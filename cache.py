@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque, namedtuple
+
+TILT = 'tilt'
+SOIL = 'soil'
+
+TiltReading = namedtuple('TiltReading', [
+    'received_at', 'node_state', 'battery_voltage', 'observed_at',
+    'tilt_x', 'tilt_y', 'tempereture', 'table_id'
+])
+
+SoilReading = namedtuple('SoilReading', [
+    'received_at', 'data_get_at', 'tempereture', 'moisture', 'ec'
+])
+
+
+class SensorState(object):
+    """
+    1センサ分の直近N件のデータと，そこから求めた値
+    """
+    __slots__ = ('readings', 'diff')
+
+    def __init__(self, kind, readings, size):
+        self.readings = deque(readings, maxlen=size)
+        self.diff = None
+        self.update_diff(kind)
+
+    def update_diff(self, kind):
+        if len(self.readings) < 2:
+            self.diff = (0.0, 0.0) if kind == TILT else 0.0
+            return
+        last, prev = self.readings[-1], self.readings[-2]
+        if kind == TILT:
+            self.diff = (last.tilt_x - prev.tilt_x, last.tilt_y - prev.tilt_y)
+        else:
+            self.diff = last.moisture - prev.moisture
+
+
+class SensorStateCache(object):
+    """
+    全センサの直近のデータ (プロセス内)
+    loader(kind, sensor_id, limit) でセンサごとに1回だけDBから古い順に読む．
+    データは書き込みバッファに渡す前に push するので，まだ書き込んでいない行も読める
+    """
+
+    def __init__(self, size, loader):
+        self.size = max(size, 2)
+        self.loader = loader
+        self._states = {}
+        self._hysteresis = {}
+        self._lock = threading.RLock()
+
+    def _state(self, kind, sensor_id):
+        key = (kind, sensor_id)
+        state = self._states.get(key)
+        if state is None:
+            with self._lock:
+                state = self._states.get(key)
+                if state is None:
+                    readings = self.loader(kind, sensor_id, self.size)
+                    state = SensorState(kind, readings, self.size)
+                    self._states[key] = state
+        return state
+
+    def push(self, kind, sensor_id, readings):
+        """
+        保存するデータを追加する．DBに書き込む前に呼ぶこと
+        """
+        with self._lock:
+            state = self._state(kind, sensor_id)
+            state.readings.extend(readings)
+            state.update_diff(kind)
+
+    def latest(self, kind, sensor_id):
+        readings = self._state(kind, sensor_id).readings
+        return readings[-1] if readings else None
+
+    def latest_diff(self, kind, sensor_id):
+        return self._state(kind, sensor_id).diff
+
+    def history(self, kind, sensor_id):
+        with self._lock:
+            return list(self._state(kind, sensor_id).readings)
+
+    def hysteresis_at(self, sensor_id):
+        return self._hysteresis.get(sensor_id)
+
+    def set_hysteresis_at(self, sensor_id, at):
+        self._hysteresis[sensor_id] = at
+
+    def has(self, kind, sensor_id):
+        return (kind, sensor_id) in self._states
+
+    def snapshot(self):
+        """
+        保存用の値 (タプルとdictだけ)
+        """
+        with self._lock:
+            return {
+                'states': dict((key, [tuple(reading) for reading in state.readings])
+                               for key, state in self._states.items()),
+                'hysteresis': dict(self._hysteresis),
+            }
+
+    def restore(self, snapshot):
+        reading_types = {TILT: TiltReading, SOIL: SoilReading}
+        with self._lock:
+            for (kind, sensor_id), readings in snapshot['states'].items():
+                self._states[(kind, sensor_id)] = SensorState(
+                    kind, [reading_types[kind](*reading) for reading in readings], self.size)
+            self._hysteresis.update(snapshot['hysteresis'])
+
+    def discard(self, kind, sensor_id, readings):
+        """
+        push したデータを取り除く (ロールバック用)．押し出された古いデータは戻らない
+        """
+        with self._lock:
+            state = self._states.get((kind, sensor_id))
+            if state is None:
+                return
+            discarded = set(id(reading) for reading in readings)
+            state.readings = deque((reading for reading in state.readings if id(reading) not in discarded),
+                                   maxlen=self.size)
+            state.update_diff(kind)
+
+    def invalidate(self, kind=None, sensor_id=None):
+        with self._lock:
+            if kind is None:
+                self._states.clear()
+            else:
+                self._states.pop((kind, sensor_id), None)
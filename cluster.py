@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+複数の検知器のプロセスでセンサのデータを分担する．サイトごとに1つの検知器が受け持つ
+"""
+
+import os
+import sys
+import zlib
+import time
+import json
+import random
+import argparse
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+
+import paho.mqtt.client as mqtt
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import payload
+import metrics
+from registry import normalize_mac
+import logs
+
+logger = logs.get_logger(__name__, 'cluster')
+
+DATA_TOPIC = 'sensor/data'
+
+
+def owner(key, size):
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % size
+
+
+def partition_topic(index, data_topic=DATA_TOPIC):
+    return '{0}/{1}'.format(data_topic, index)
+
+
+class Node(object):
+    """
+    このプロセスが受け持つサイトのフレームだけを検知に回し，他は持ち主に転送する
+    """
+
+    def __init__(self, index, size, topology, publish=None, data_topic=DATA_TOPIC, group='sss', shared=True):
+        if not 0 <= index < size:
+            raise ValueError("cluster index {0} is out of range for size {1}".format(index, size))
+        self.index = index
+        self.size = size
+        self.topology = topology
+        self.publish = publish
+        self.data_topic = data_topic
+        self.group = group
+        self.shared = shared
+        self.topic = partition_topic(index, data_topic)
+        self._owners = {}
+
+    def topics(self):
+        if not self.shared:
+            return [self.data_topic]
+        return ['$share/{0}/{1}'.format(self.group, self.data_topic), self.topic]
+
+    def owns(self, site):
+        return owner(site.name, self.size) == self.index
+
+    def owner_of(self, mac):
+        index = self._owners.get(mac)
+        if index is None:
+            site, _ = self.topology.locate(mac)
+            index = self._owners[mac] = owner(site.name if site is not None else normalize_mac(mac), self.size)
+        return index
+
+    def claim(self, topic, data, frames):
+        """
+        受け持つフレームのリストを返す．他のフレームは持ち主のトピックに転送する (shared のとき)
+        """
+        if topic == self.topic:
+            metrics.cluster_frames.inc(len(frames), ('owned',))
+            return frames
+        owned, others = [], OrderedDict()
+        for frame in frames:
+            index = self.owner_of(frame.mac)
+            if index == self.index:
+                owned.append(frame)
+            else:
+                others.setdefault(index, []).append(frame)
+        metrics.cluster_frames.inc(len(owned), ('owned',))
+        for index, forwarded in others.items():
+            if not self.shared:
+                metrics.cluster_frames.inc(len(forwarded), ('skipped',))
+                continue
+            # 1つのサイトだけのメッセージはそのまま，混ざっていれば分けてバイナリ形式で送る
+            forward = data if len(forwarded) == len(frames) else payload.pack(forwarded)
+            self.publish(partition_topic(index, self.data_topic), forward)
+            metrics.cluster_frames.inc(len(forwarded), ('forwarded',))
+        return owned
+
+
+def from_env(topology, data_topic=DATA_TOPIC):
+    """
+    SSS_CLUSTER_SIZE が2以上ならNode，そうでなければNone
+    """
+    size = int(os.getenv('SSS_CLUSTER_SIZE', '1'))
+    if size <= 1:
+        return None
+    return Node(int(os.getenv('SSS_CLUSTER_INDEX', '0')), size, topology,
+                data_topic=data_topic,
+                group=os.getenv('SSS_CLUSTER_GROUP', 'sss'),
+                shared=os.getenv('SSS_CLUSTER_SHARED', '1') != '0')
+
+
+# ブローカの代わり (demo 用)
+
+Message = namedtuple('Message', ['topic', 'payload'])
+
+
+class LocalClient(object):
+    """
+    paho の Client のうち検知器が使う部分だけを持つ，LocalBroker のクライアント
+    """
+
+    def __init__(self, client_id, inbox, outbox):
+        self.client_id = client_id
+        self.inbox = inbox
+        self.outbox = outbox
+        self.on_connect = None
+        self.on_message = None
+
+    def connect(self, host=None, port=None, keepalive=60):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def subscribe(self, topic):
+        self.inbox.put(('subscribe', self.client_id, topic))
+
+    def publish(self, topic, data):
+        self.inbox.put(('publish', topic, data))
+
+    def loop_forever(self):
+        while True:
+            msg = self.outbox.get()
+            if msg is None:
+                return
+            if self.on_message is not None:
+                self.on_message(self, None, Message(*msg))
+
+
+class LocalBroker(object):
+    """
+    forkしたプロセスで共有するMQTTブローカーの代わり (メモリ上)
+    クライアントはプロセスを起動する前に client(client_id) で作る．$share/<group>/<filter> の購読者には順番に配る
+    """
+
+    def __init__(self):
+        self.inbox = multiprocessing.Queue()
+        self.outboxes = {}
+        self.subscriptions = []
+        self.shared = OrderedDict()
+        self.published = 0
+        self._thread = None
+
+    def client(self, client_id):
+        self.outboxes[client_id] = multiprocessing.Queue()
+        return LocalClient(client_id, self.inbox, self.outboxes[client_id])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='local-broker')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def subscribed(self):
+        return len(self.subscriptions) + sum(len(members) for members, _ in self.shared.values())
+
+    def _run(self):
+        while True:
+            command = self.inbox.get()
+            if command is None:
+                return
+            if command[0] == 'subscribe':
+                _, client_id, topic = command
+                if topic.startswith('$share/'):
+                    _, group, topic_filter = topic.split('/', 2)
+                    self.shared.setdefault((group, topic_filter), ([], [0]))[0].append(client_id)
+                else:
+                    self.subscriptions.append((client_id, topic))
+                continue
+            _, topic, data = command
+            self.published += 1
+            for client_id, topic_filter in self.subscriptions:
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    self.outboxes[client_id].put((topic, data))
+            for (group, topic_filter), (members, turn) in self.shared.items():
+                if mqtt.topic_matches_sub(topic_filter, topic):
+                    self.outboxes[members[turn[0] % len(members)]].put((topic, data))
+                    turn[0] += 1
+
+    def stop(self):
+        for outbox in self.outboxes.values():
+            outbox.put(None)
+        self.inbox.put(None)
+
+
+def demo_topology(sites, tilts):
+    from topology import Site, Topology
+    return Topology([Site('site{0}'.format(i),
+                          OrderedDict([('A', ['00:00:00:00:00:{0:02x}:00:{1:02x}'.format(i, k)
+                                              for k in range(tilts)])]),
+                          soil_mac='00:00:00:00:00:{0:02x}:01:00'.format(i))
+                     for i in range(sites)])
+
+
+def demo_node(index, size, topology, client, shared, results):
+    node = Node(index, size, topology, publish=client.publish, shared=shared)
+
+    def on_connect(client, data, flags, response_code):
+        for topic in node.topics():
+            client.subscribe(topic)
+
+    def on_message(client, data, msg):
+        frames = payload.parse(msg.payload)
+        for frame in node.claim(msg.topic, msg.payload, frames):
+            site, _ = topology.locate(frame.mac)
+            results.put((index, site.name, frame.mac))
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect()
+    client.loop_forever()
+
+
+def demo_messages(topology, messages, seed):
+    """
+    CSVの1フレームと，複数サイトのフレームをまとめたバイナリ形式を混ぜる
+    """
+    rng = random.Random(seed)
+    macs = [mac for site in topology for macs in site.groups.values() for mac in macs]
+    at = datetime(2017, 3, 1)
+    for i in range(messages):
+        at += timedelta(seconds=1)
+        if i % 4:
+            mac = rng.choice(macs)
+            yield 1, ','.join(['52660', mac, at.strftime('%y%m%d%H%M%S'), mac.replace(':', ''), '00', '3.3', '1',
+                               str(i), '{0:.3f}'.format(rng.uniform(-1, 1)), '{0:.3f}'.format(rng.uniform(-1, 1)),
+                               '20', '8'])
+        else:
+            frames = [payload.TiltFrame(mac, at, mac.replace(':', ''), 0, 3.3,
+                                        [payload.TiltObservation(i, rng.uniform(-1, 1), rng.uniform(-1, 1), 20.0, 8)])
+                      for mac in rng.sample(macs, 4)]
+            yield len(frames), payload.pack(frames)
+
+
+def demo(processes, sites, tilts, messages, shared=True, seed=0, timeout=60.0):
+    """
+    1フレームも重複・欠落せず，1サイトを1プロセスだけが処理したかを確かめる
+    """
+    topology = demo_topology(sites, tilts)
+    broker = LocalBroker()
+    gateway = broker.client('gateway')
+    clients = [broker.client('detector-{0}'.format(i)) for i in range(processes)]
+    results = multiprocessing.Queue()
+    children = [multiprocessing.Process(target=demo_node, args=(i, processes, topology, clients[i], shared, results))
+                for i in range(processes)]
+    for child in children:
+        child.start()
+    broker.start()
+    subscriptions = processes * (2 if shared else 1)
+    while broker.subscribed() < subscriptions:
+        time.sleep(0.01)
+
+    workload = list(demo_messages(topology, messages, seed))
+    expected = sum(count for count, _ in workload)
+    started = time.time()
+    for _, data in workload:
+        gateway.publish(DATA_TOPIC, data)
+    handled = []
+    while len(handled) < expected and time.time() - started < timeout:
+        try:
+            handled.append(results.get(timeout=0.5))
+        except queue.Empty:
+            pass
+    elapsed = time.time() - started
+    # 遅れて届いた重複も数える
+    time.sleep(0.5)
+    while not results.empty():
+        handled.append(results.get())
+    broker.stop()
+    for child in children:
+        child.join(5)
+
+    owners = {}
+    for index, site, _ in handled:
+        owners.setdefault(site, set()).add(index)
+    report = OrderedDict([
+        ('processes', processes),
+        ('shared', shared),
+        ('messages', messages),
+        ('frames', expected),
+        ('handled', len(handled)),
+        ('published', broker.published),
+        ('seconds', elapsed),
+        ('frames_per_process', [sum(1 for h in handled if h[0] == i) for i in range(processes)]),
+        ('sites_per_process', [sorted(site for site, indexes in owners.items() if i in indexes)
+                               for i in range(processes)]),
+        ('ok', len(handled) == expected and all(len(indexes) == 1 for indexes in owners.values())),
+    ])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='clustered detectors')
+    parser.add_argument('command', choices=['demo'])
+    parser.add_argument('--processes', type=int, default=3)
+    parser.add_argument('--sites', type=int, default=6)
+    parser.add_argument('--tilts', type=int, default=4, help='tilt sensors per site')
+    parser.add_argument('--messages', type=int, default=600)
+    parser.add_argument('--no-shared', action='store_true', help='every process subscribes to sensor/data')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = demo(args.processes, args.sites, args.tilts, args.messages, not args.no_shared, args.seed)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
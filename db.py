@@ -2,48 +2,206 @@
 
 import os
 import math
-import requests
+import threading
 import json
-import time
+import cache
+import aggregate
+import writer
+import dispatcher
+import registry
+import payload
+import metrics
+import event_state
+import dedupe
+import features
+from contextlib import contextmanager
 from sqlalchemy import *
+from sqlalchemy import exc
+from sqlalchemy.event import listens_for
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import orm, pool
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker, object_session
 from sqlalchemy.sql import func
 from datetime import datetime, timedelta
-from logging import getLogger, FileHandler, StreamHandler, DEBUG
+import logs
  
-logger = getLogger(__name__)
-if not logger.handlers:
-    fileHandler = FileHandler(r'./log/db.log')
-    fileHandler.setLevel(DEBUG)
-    streamHander = StreamHandler()
-    streamHander.setLevel(DEBUG)
-    logger.setLevel(DEBUG)
-    logger.addHandler(fileHandler)
-    logger.addHandler(streamHander)
-
-engine = create_engine("mysql+mysqldb://{0}:{1}@{2}/social_sensor_server?charset=utf8"
-                       .format(os.getenv('SSS_DB_USER'), os.getenv('SSS_DB_PASS'), os.getenv('SSS_DB_HOST')),
-                       echo=False, pool_recycle=3600)
+logger = logs.get_logger(__name__, 'db')
+
+# SSS_DB_BACKEND=sqlite ならゲートウェイ上のSQLiteファイル (SSS_SQLITE_PATH) に書き，
+# replicate.py で中央のMySQLに送る．SSS_DB_URL を指定すればそれを使う (ベンチマーク用のSQLiteなど)
+BACKEND = os.getenv('SSS_DB_BACKEND', 'mysql')
+
+# SQLiteのコネクションごとに設定する．WALなら読み込みと書き込みが互いを待たない
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    # WALではコミットごとのfsyncを省いても壊れない (電源断で最後のコミットが消えるだけ)
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', int(os.getenv('SSS_SQLITE_BUSY_TIMEOUT', '5000'))),
+    # 負の値はKB
+    ('cache_size', -int(os.getenv('SSS_SQLITE_CACHE_KB', '20000'))),
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', int(os.getenv('SSS_SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))),
+    ('foreign_keys', 'ON'),
+]
+
+
+def backend_url(backend):
+    if backend == 'sqlite':
+        return 'sqlite:///' + os.path.abspath(os.getenv('SSS_SQLITE_PATH', './data/detector.db'))
+    if backend == 'mysql':
+        return "mysql+mysqldb://{0}:{1}@{2}/social_sensor_server?charset=utf8"\
+            .format(os.getenv('SSS_DB_USER'), os.getenv('SSS_DB_PASS'), os.getenv('SSS_DB_HOST'))
+    raise ValueError("unknown SSS_DB_BACKEND: {0}".format(backend))
+
+
+db_url = os.getenv('SSS_DB_URL') or backend_url(BACKEND)
+
+
+def create_sqlite_engine(url):
+    """
+    ファイルのSQLiteはコネクションをプールし，開くときにPRAGMAを設定する
+    """
+    path = make_url(url).database
+    if not path or path == ':memory:':
+        return create_engine(url, echo=False)
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # コネクションはプールを通して1度に1スレッドだけが使う
+    db_engine = create_engine(url, echo=False, poolclass=pool.QueuePool,
+                              pool_size=int(os.getenv('SSS_DB_POOL_SIZE', '8')),
+                              max_overflow=int(os.getenv('SSS_DB_MAX_OVERFLOW', '4')),
+                              pool_timeout=float(os.getenv('SSS_DB_POOL_TIMEOUT', '30')),
+                              connect_args={'check_same_thread': False})
+
+    @listens_for(db_engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA {0}={1}'.format(name, value))
+        cursor.close()
+
+    return db_engine
+
+
+def create_db_engine(url, count_queries=True):
+    """
+    count_queries: 検知のクエリ数のメトリクスに数えるか (レプリケーション先などはFalse)
+    """
+    if url.startswith('sqlite'):
+        db_engine = create_sqlite_engine(url)
+    else:
+        # 検知のワーカーごとに1本，残りはフィードバックや集計用
+        db_engine = create_engine(url, echo=False,
+                                  pool_size=int(os.getenv('SSS_DB_POOL_SIZE', '8')),
+                                  max_overflow=int(os.getenv('SSS_DB_MAX_OVERFLOW', '4')),
+                                  pool_timeout=float(os.getenv('SSS_DB_POOL_TIMEOUT', '30')),
+                                  pool_recycle=int(os.getenv('SSS_DB_POOL_RECYCLE', '3600')))
+
+    if count_queries:
+        @listens_for(db_engine, 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            metrics.count_query()
+
+    if not url.startswith('sqlite') and os.getenv('SSS_DB_PRE_PING', '1') != '0':
+        @listens_for(db_engine, 'engine_connect')
+        def ping_connection(conn, branch):
+            """
+            プールから取り出したコネクションが切れていれば張り直す (MySQLの wait_timeout 対策)
+            """
+            if branch:
+                return
+            should_close_with_result = conn.should_close_with_result
+            conn.should_close_with_result = False
+            try:
+                conn.scalar(select([1]))
+            except exc.DBAPIError as e:
+                # 切れていたコネクションはプールごと捨てられているので，もう一度だけ試す
+                if e.connection_invalidated:
+                    logger.warning("reconnect to the database: {0}".format(e))
+                    conn.scalar(select([1]))
+                else:
+                    raise
+            finally:
+                conn.should_close_with_result = should_close_with_result
+
+    return db_engine
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    エンジンは最初に使うときに作る (import だけではDBドライバを読み込まない)
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_db_engine(db_url)
+    return _engine
+
+
+class LazyEngine(object):
+    """
+    get_engine() のエンジンに属性を渡すだけのもの．db.engine.begin() などはそのまま使える
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_engine(), name)
+
+
+engine = LazyEngine()
+
 #engine.execute("CREATE DATABASE IF NOT EXISTS social_sensor_server")
 #engine.execute("USE social_sensor_server;")
 
 Base = declarative_base()
 
-Session = sessionmaker(bind=engine)
-session = Session()
+class EngineSession(orm.Session):
+
+    def get_bind(self, mapper=None, clause=None):
+        return get_engine()
+
+
+# セッションはスレッドごと．session.query() などはそのスレッドのセッションに渡される
+Session = scoped_session(sessionmaker(class_=EngineSession))
+session = Session
 
 
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (Index('ix_events_site_id', 'site', 'id'),)
     id = Column(Integer, primary_key=True)
     state = Column(Integer)
     created_at = Column(DateTime, default=datetime.now())
     y = Column(Float)
+    site = Column(String(32))
+
+
+class EventSample(Base):
+    """
+    状態が変わらない間の y を一定時間ごとにまとめたもの
+    """
+    __tablename__ = 'event_samples'
+    id = Column(Integer, primary_key=True)
+    site = Column(String(32))
+    state = Column(Integer)
+    started_at = Column(DateTime)
+    ended_at = Column(DateTime)
+    count = Column(Integer)
+    y_min = Column(Float)
+    y_max = Column(Float)
+    y_mean = Column(Float)
+    y_last = Column(Float)
 
 
 class TiltSensor(Base):
     __tablename__ = 'tilt_sensors'
+    __table_args__ = (Index('ux_tilt_sensors_mac', 'mac', unique=True),)
     id = Column(Integer, primary_key=True)
     name = Column(String(20))
     threshold = Column(Float)
@@ -52,8 +210,8 @@ class TiltSensor(Base):
     hysteresis_at = Column(DateTime, default=datetime.now() - timedelta(hours=3))
 
 
-    def save_data(self, data):
-        add_tilt_data(self.id, data)
+    def save_data(self, frame):
+        add_tilt_data(self.id, frame)
         if self.latest_node_state() == 2 and not self.is_hysteresis():
             update_hysteresis(self.id)
         
@@ -65,22 +223,24 @@ class TiltSensor(Base):
 
 
     def latest_data(self):
-        return self.data.order_by(TiltSensorData.id.desc()).first()
+        return state_cache.latest(cache.TILT, self.id)
 
 
     def latest_diff(self):
-        last_two = self.data.order_by(TiltSensorData.id.desc()).limit(2).all()
-        if len(last_two) < 2:
-            return 0.0, 0.0
+        return state_cache.latest_diff(cache.TILT, self.id)
 
-        diff_x = last_two[0].tilt_x - last_two[1].tilt_x
-        diff_y = last_two[0].tilt_y - last_two[1].tilt_y
 
-        return diff_x, diff_y
+    def features(self):
+        return sensor_features.features(cache.TILT, self.id)
 
 
     def is_hysteresis(self):
-        return self.hysteresis_at > datetime.now() - timedelta(hours=2)
+        return self.latest_hysteresis_at() > datetime.now() - timedelta(hours=2)
+
+
+    def latest_hysteresis_at(self):
+        # 書き込み待ちの更新があればそちらが新しい
+        return state_cache.hysteresis_at(self.id) or self.hysteresis_at
 
 
     def latest_node_state(self):
@@ -93,31 +253,8 @@ class TiltSensor(Base):
 
     def change_table(self, val):
         logger.info("change sensor {0} table_id from {1} to {2}".format(self.id, self.latest_table_id(), val))
-        url = os.getenv('SSS_FB_HOST')
-        data = {
-            'TiltPattarnCode': [
-                { 'DeviceId': self.mac, 'Val': val }
-            ]
-        }
-
-        #print("{0}".format(json.dumps(data)))
-	#try:
-        #    response = requests.post(
-        #        url,
-        #        json.dumps(data),
-        #        cert=('./client.crt', './client.key'),
-        #        verify=False,
-        #        headers={'Content-Type': 'application/json'}
-        #    )
-        command = 'curl -vk --key client.key --cert client.crt -H Content-Type:application/json -d \'{{"TiltPattarnCode":[{{"DeviceId":"{0}","Val":{1}}}]}}\' https://54.65.160.111:8443'.format(self.mac, val)
-        logger.info(command)
-        for _ in range(1):
-            os.system(command)
-            time.sleep(0.5)
-        #    print("{0}".format(response))
-	#except requests.exceptions.ConnectionError:
-        #    print("Connection Error()")
-        #    return ""
+        # 送信は別スレッドで行い，ここではすぐに戻る
+        table_dispatcher.submit(self.mac, val)
         update_hysteresis(self.id)
         return True
 
@@ -125,6 +262,11 @@ class TiltSensor(Base):
 
 class TiltSensorData(Base):
     __tablename__ = 'tilt_sensor_data'
+    __table_args__ = (
+        Index('ix_tilt_sensor_data_sensor_id_id', 'sensor_id', 'id'),
+        Index('ix_tilt_sensor_data_received_at', 'received_at'),
+        Index('ux_tilt_sensor_data_sensor_id_observed_at', 'sensor_id', 'observed_at', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     sensor_id = Column(Integer,
                        ForeignKey('tilt_sensors.id'))
@@ -140,6 +282,7 @@ class TiltSensorData(Base):
 
 class SoilSensor(Base):
     __tablename__ = 'soil_sensors'
+    __table_args__ = (Index('ux_soil_sensors_mac', 'mac', unique=True),)
     id = Column(Integer, primary_key=True)
     name = Column(String(20))
     threshold = Column(Float)
@@ -147,8 +290,8 @@ class SoilSensor(Base):
     data = relationship('SoilSensorData', backref='sensor', lazy='dynamic')
 
 
-    def save_data(self, data):
-        add_soil_data(self.id, data)
+    def save_data(self, frame):
+        add_soil_data(self.id, frame)
 
 
     def is_over_threshold(self):
@@ -158,25 +301,30 @@ class SoilSensor(Base):
 
 
     def latest(self):
-        latest = self.data.order_by(SoilSensorData.id.desc()).first()
-        return latest
+        return state_cache.latest(cache.SOIL, self.id)
 
 
     def latest_diff(self):
-        last_two = self.data.order_by(SoilSensorData.id.desc()).limit(2).all()
-        if len(last_two) < 2:
-            return 0.0
+        return state_cache.latest_diff(cache.SOIL, self.id)
 
-        return last_two[0].moisture - last_two[1].moisture
+
+    def features(self):
+        return sensor_features.features(cache.SOIL, self.id)
 
 
     def min(self):
-        min_moisture = self.data.order_by(SoilSensorData.moisture.asc()).first()
-        return min_moisture.moisture
+        return moisture_stats.min(self.id)
 
 
 class SoilSensorData(Base):
     __tablename__ = 'soil_sensor_data'
+    __table_args__ = (
+        Index('ix_soil_sensor_data_sensor_id_id', 'sensor_id', 'id'),
+        Index('ix_soil_sensor_data_sensor_id_moisture', 'sensor_id', 'moisture'),
+        Index('ix_soil_sensor_data_sensor_id_received_at', 'sensor_id', 'received_at'),
+        Index('ix_soil_sensor_data_received_at', 'received_at'),
+        Index('ux_soil_sensor_data_sensor_id_data_get_at', 'sensor_id', 'data_get_at', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     sensor_id = Column(Integer,
                        ForeignKey('soil_sensors.id'))
@@ -191,82 +339,487 @@ class SoilSensorData(Base):
     ec = Column(Float)
 
 
+class WeatherSensor(Base):
+    __tablename__ = 'weather_sensors'
+    __table_args__ = (Index('ux_weather_sensors_mac', 'mac', unique=True),)
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20))
+    mac = Column(String(32))
+    data = relationship('WeatherSensorData', backref='sensor', lazy='dynamic')
+
+
+    def save_data(self, frame):
+        add_weather_data(self.id, frame)
+
+
+    def rainfall(self):
+        """
+        {'1h': 雨量, '3h': 雨量, '24h': 雨量}
+        """
+        return rainfall_totals.totals(self.id)
+
+
+    def over_thresholds(self, frame, thresholds):
+        """
+        しきい値を超えた期間 (と降雨強度 'intensity') のリスト
+        """
+        over = [name for name, total in self.rainfall().items()
+                if name in thresholds and total > thresholds[name]]
+        intensity = frame.measurements.get('R')
+        if 'intensity' in thresholds and intensity is not None and intensity > thresholds['intensity']:
+            over.append('intensity')
+        return over
+
+
+class WeatherSensorData(Base):
+    __tablename__ = 'weather_sensor_data'
+    __table_args__ = (
+        Index('ix_weather_sensor_data_sensor_id_received_at', 'sensor_id', 'received_at'),
+        Index('ix_weather_sensor_data_received_at', 'received_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer,
+                       ForeignKey('weather_sensors.id'))
+    received_at = Column(DateTime)
+    # 積算雨量 (V)，降雨時間 (Z)，降雨強度 (R)
+    rain_accumulation = Column(Float)
+    rain_duration = Column(Float)
+    rain_intensity = Column(Float)
+    # 前回のデータからの雨量
+    rainfall = Column(Float)
+
+
+# 保存期間を過ぎたデータの分 (minute)，時 (hour)，日 (day) ごとの集計値．retention.py が作る
+class TiltSensorRollup(Base):
+    __tablename__ = 'tilt_sensor_rollups'
+    __table_args__ = (
+        UniqueConstraint('sensor_id', 'resolution', 'bucket_at'),
+        Index('ix_tilt_sensor_rollups_resolution_bucket_at', 'resolution', 'bucket_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer, ForeignKey('tilt_sensors.id'))
+    resolution = Column(String(8))
+    bucket_at = Column(DateTime)
+    count = Column(Integer)
+    tilt_x_min = Column(Float)
+    tilt_x_max = Column(Float)
+    tilt_x_mean = Column(Float)
+    tilt_x_last = Column(Float)
+    tilt_y_min = Column(Float)
+    tilt_y_max = Column(Float)
+    tilt_y_mean = Column(Float)
+    tilt_y_last = Column(Float)
+    tempereture_min = Column(Float)
+    tempereture_max = Column(Float)
+    tempereture_mean = Column(Float)
+    tempereture_last = Column(Float)
+
+
+class SoilSensorRollup(Base):
+    __tablename__ = 'soil_sensor_rollups'
+    __table_args__ = (
+        UniqueConstraint('sensor_id', 'resolution', 'bucket_at'),
+        Index('ix_soil_sensor_rollups_resolution_bucket_at', 'resolution', 'bucket_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer, ForeignKey('soil_sensors.id'))
+    resolution = Column(String(8))
+    bucket_at = Column(DateTime)
+    count = Column(Integer)
+    moisture_min = Column(Float)
+    moisture_max = Column(Float)
+    moisture_mean = Column(Float)
+    moisture_last = Column(Float)
+    tempereture_min = Column(Float)
+    tempereture_max = Column(Float)
+    tempereture_mean = Column(Float)
+    tempereture_last = Column(Float)
+
+
+class RollupWatermark(Base):
+    """
+    集計が終わった時刻．この時刻より前のバケットは集計済み
+    """
+    __tablename__ = 'rollup_watermarks'
+    name = Column(String(32), primary_key=True)
+    watermark = Column(DateTime)
+    # 分の集計で読んだ生データの最大のid．これより新しいidで watermark より前の行は遅れて届いた行
+    last_id = Column(Integer)
+
+
+class ReplicationState(Base):
+    """
+    レプリケーション先 (中央のMySQL) に置き，どのゲートウェイのどのテーブルをどのidまで送ったかを記録する
+    """
+    __tablename__ = 'replication_state'
+    name = Column(String(96), primary_key=True)
+    last_id = Column(Integer)
+    replicated_at = Column(DateTime)
+
+
+class SchemaVersion(Base):
+    """
+    適用済みのマイグレーション．migrate.py が管理する
+    """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(128))
+    applied_at = Column(DateTime)
+
+
+def load_readings(kind, sid, limit):
+    """
+    キャッシュの初期化用に，センサの直近limit件のデータを古い順に返す
+    """
+    if kind == cache.TILT:
+        rows = session.query(TiltSensorData).filter(TiltSensorData.sensor_id==sid)\
+                      .order_by(TiltSensorData.id.desc()).limit(limit).all()
+        return [tilt_reading(row) for row in reversed(rows)]
+    else:
+        rows = session.query(SoilSensorData).filter(SoilSensorData.sensor_id==sid)\
+                      .order_by(SoilSensorData.id.desc()).limit(limit).all()
+        return [soil_reading(row) for row in reversed(rows)]
+
+
+def tilt_reading(row):
+    return cache.TiltReading(row.received_at, row.node_state, row.battery_voltage, row.observed_at,
+                             row.tilt_x, row.tilt_y, row.tempereture, row.table_id)
+
+
+def soil_reading(row):
+    return cache.SoilReading(row.received_at, row.data_get_at, row.tempereture, row.moisture, row.ec)
+
+
+def row_reading(reading_type, values):
+    return reading_type(*[values[field] for field in reading_type._fields])
+
+
+# 直近のデータはメモリ上に保持し，検知のたびにDBを参照しない
+state_cache = cache.SensorStateCache(int(os.getenv('SSS_CACHE_SIZE', '16')), load_readings)
+
+
+def load_moisture_stats(sid, window):
+    """
+    土中水分量の集計値を履歴から作り直す
+    """
+    count, total, lo, hi, newest = session.query(
+        func.count(SoilSensorData.id), func.sum(SoilSensorData.moisture),
+        func.min(SoilSensorData.moisture), func.max(SoilSensorData.moisture),
+        func.max(SoilSensorData.received_at)
+    ).filter(SoilSensorData.sensor_id==sid).one()
+    recent = []
+    if window is not None and newest is not None:
+        recent = session.query(SoilSensorData.received_at, SoilSensorData.moisture)\
+                        .filter(SoilSensorData.sensor_id==sid)\
+                        .filter(SoilSensorData.received_at >= aggregate.to_datetime(newest) - window)\
+                        .order_by(SoilSensorData.id.asc()).all()
+    return count, total, lo, hi, recent
+
+
+def load_rainfall(sid, window):
+    """
+    雨量の合計の初期化用に，最後の積算雨量と直近 window の雨量を返す
+    """
+    last = session.query(WeatherSensorData.received_at, WeatherSensorData.rain_accumulation)\
+                  .filter(WeatherSensorData.sensor_id==sid)\
+                  .order_by(WeatherSensorData.id.desc()).first()
+    if last is None:
+        return None, []
+    recent = session.query(WeatherSensorData.received_at, WeatherSensorData.rainfall)\
+                    .filter(WeatherSensorData.sensor_id==sid)\
+                    .filter(WeatherSensorData.received_at > aggregate.to_datetime(last.received_at) - window)\
+                    .order_by(WeatherSensorData.id.asc()).all()
+    return last.rain_accumulation, recent
+
+
+# 1時間・3時間・24時間の雨量は受信するたびに足し引きし，DBを集計し直さない
+rainfall_totals = aggregate.RainfallAggregate(load_rainfall)
+
+# 平均・分散・変化の速さなどは保存時に更新し，キャッシュにあるデータから作り始める
+sensor_features = features.FeatureEngine(state_cache.history,
+                                         int(os.getenv('SSS_FEATURE_WINDOW', '32')),
+                                         float(os.getenv('SSS_FEATURE_ALPHA', '0.2')),
+                                         int(os.getenv('SSS_MOISTURE_RISE_WINDOW', '144')))
+
+# 最小値はテーブル全体をソートせず，保存時に更新する
+moisture_stats = aggregate.MoistureAggregate(load_moisture_stats, int(os.getenv('SOIL_MIN_WINDOW_DAYS', '30')))
+
+# データとイベントはまとめて書き込む．重複した観測データはユニークキーで捨てる
+write_buffer = writer.WriteBehindBuffer(engine,
+                                        int(os.getenv('SSS_WRITE_BATCH_SIZE', '100')),
+                                        float(os.getenv('SSS_WRITE_FLUSH_INTERVAL', '1.0')),
+                                        ignore_duplicates=(TiltSensorData.__table__, SoilSensorData.__table__),
+                                        max_retries=int(os.getenv('SSS_WRITE_MAX_RETRIES', '10')))
+
+# 最近受信した観測データのキー (センサ, observed_at / data_get_at)
+recent_keys = dedupe.RecentKeys(int(os.getenv('SSS_DEDUPE_SIZE', '10000')))
+
+
+def is_duplicate(kind, sid, key):
+    """
+    最近のキーを先に調べ，なければキャッシュにある直近のデータ (DBから読んだもの) と比べる
+    """
+    if recent_keys.seen((kind, sid, key)):
+        return True
+    # 処理に失敗したら，再送されたデータを重複として捨てないように忘れる
+    on_rollback(lambda: recent_keys.forget((kind, sid, key)))
+    field = 'observed_at' if kind == cache.TILT else 'data_get_at'
+    return any(getattr(reading, field) == key for reading in state_cache.history(kind, sid))
+
+
+def remove_duplicates(sid, frame):
+    """
+    受信済みの観測データを除いたフレームを返す．すべて受信済みならNone
+    """
+    if frame.port == payload.TILT_PORT:
+        observations = [o for o in frame.observations if not is_duplicate(cache.TILT, sid, o.observed_at)]
+        suppressed = len(frame.observations) - len(observations)
+        if suppressed:
+            metrics.duplicates.inc(suppressed, ('cache',))
+        if not observations:
+            return None
+        if suppressed:
+            frame = payload.TiltFrame(frame.mac, frame.received_at, frame.node_id, frame.node_state,
+                                      frame.battery_voltage, observations)
+        return frame
+    if frame.port == payload.SOIL_PORT and is_duplicate(cache.SOIL, sid, frame.data_get_at):
+        metrics.duplicates.inc(1, ('cache',))
+        return None
+    return frame
+
+
 def create_table():
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
 
 
 def drop_table():
-    Base.metadata.drop_all(bind=engine)
+    Base.metadata.drop_all(bind=get_engine())
 
 
 def reset_table():
     drop_table()
     create_table()
+    event_states.invalidate()
+
 
 def add_tilt_sensor(name, mac, threshold):
     new_sensor = TiltSensor(name=name, mac=mac.upper(), threshold=threshold)
-    session = Session()
-    session.add(new_sensor)
-    session.commit()
-
-
-# id, mac, receive time, node id, node state, battery voltage, number of observed data,
-# [observed time, tilt axis x, tilt axis y, sensor unit temperetur, tilt threshold] * number of observed data
-def add_tilt_data(sid, data):
-    logger.info("save data: {0}".format(data))
-    num_of_data = int(data[6])
-    logger.info("num of data: {0}".format(num_of_data))
-    for i in range(num_of_data):
-        new_data = TiltSensorData(
+    with unit_of_work() as session:
+        session.add(new_sensor)
+    sensor_registry.forget('52660', mac)
+
+
+def add_tilt_data(sid, frame):
+    """
+    frame: payload.TiltFrame
+    """
+    logger.info("save data: %s", frame, extra=logs.sampled())
+    rows = []
+    for observation in frame.observations:
+        rows.append(dict(
             sensor_id=sid,
-            received_at=data[2],
-            node_state=int(data[4]),
-            battery_voltage=float(data[5]),
-            observed_at=data[7 + 5 * i],
-            tilt_x=float(data[8 + 5 * i]),
-            tilt_y=float(data[9 + 5 * i]),
-            tempereture=float(data[10 + 5 * i]),
-            table_id=int(data[11 + 5 * i])
-        )
-        session.add(new_data)
-    session.commit()
+            received_at=frame.received_at,
+            node_state=frame.node_state,
+            battery_voltage=frame.battery_voltage,
+            observed_at=observation.observed_at,
+            tilt_x=observation.tilt_x,
+            tilt_y=observation.tilt_y,
+            tempereture=observation.tempereture,
+            table_id=observation.table_id
+        ))
+    readings = [row_reading(cache.TiltReading, row) for row in rows]
+    sensor_features.push(cache.TILT, sid, readings)
+    state_cache.push(cache.TILT, sid, readings)
+    write_buffer.insert(TiltSensorData.__table__, rows)
+    on_rollback(lambda: discard_data(cache.TILT, sid, TiltSensorData.__table__, rows, readings))
 
 
 def add_soil_sensor(name, mac, threshold):
-    new_sensor = SoilSensor(name='test', mac='test', threshold=0)
-    session.add(new_sensor)
-    session.commit()
+    new_sensor = SoilSensor(name=name, mac=mac.upper(), threshold=threshold)
+    with unit_of_work() as session:
+        session.add(new_sensor)
+    sensor_registry.forget('52652', mac)
 
 
-# id, mac, received_at, command_id, sensor_type_id, data_size, data_get_time, data_type, tempereture, moisture, ec
-def add_soil_data(sid, data):
-    new_data = SoilSensorData(
+def add_soil_data(sid, frame):
+    """
+    frame: payload.SoilFrame
+    """
+    new_data = dict(
         sensor_id=sid,
-        received_at=data[2],
-        command_id=int(data[3]),
-        sensor_type_id=int(data[4]),
-        data_size=int(data[5]),
-        data_get_at=data[6],
-        data_type=int(data[7]),
-        tempereture=float(data[8]),
-        moisture=float(data[9]),
-        ec=float(data[10])
+        received_at=frame.received_at,
+        command_id=frame.command_id,
+        sensor_type_id=frame.sensor_type_id,
+        data_size=frame.data_size,
+        data_get_at=frame.data_get_at,
+        data_type=frame.data_type,
+        tempereture=frame.tempereture,
+        moisture=frame.moisture,
+        ec=frame.ec
     )
-    session.add(new_data)
-    session.commit()
+    reading = row_reading(cache.SoilReading, new_data)
+    sensor_features.push(cache.SOIL, sid, [reading])
+    state_cache.push(cache.SOIL, sid, [reading])
+    moisture_stats.add(sid, reading.received_at, reading.moisture)
+    write_buffer.insert(SoilSensorData.__table__, [new_data])
+    on_rollback(lambda: discard_data(cache.SOIL, sid, SoilSensorData.__table__, [new_data], [reading]))
+
+
+def add_weather_sensor(name, mac):
+    new_sensor = WeatherSensor(name=name, mac=mac.upper())
+    with unit_of_work() as session:
+        session.add(new_sensor)
+    sensor_registry.forget('0', mac)
+
+
+def add_weather_data(sid, frame):
+    """
+    frame: payload.WeatherFrame ($WIXDR)
+    """
+    measurements = frame.measurements
+    rainfall = rainfall_totals.add(sid, frame.received_at, measurements.get('V'))
+    rows = [dict(
+        sensor_id=sid,
+        received_at=frame.received_at,
+        rain_accumulation=measurements.get('V'),
+        rain_duration=measurements.get('Z'),
+        rain_intensity=measurements.get('R'),
+        rainfall=rainfall
+    )]
+    write_buffer.insert(WeatherSensorData.__table__, rows)
+    on_rollback(lambda: discard_data(None, sid, WeatherSensorData.__table__, rows, []))
+
+
+def add_event(event, y, site=None, flush=False):
+    """
+    イベントを記録し，前回から変わったかを返す．eventsには状態が変わったときだけ書き込む
+    flush=True (警戒イベント) の場合はバッファをすぐに書き込む．書き込めなくても警戒イベントは返し，
+    行はバッファに残して後で再試行する
+    """
+    with metrics.stage_seconds.time(('add_event',)):
+        changed = event_states.update(site, event, y)
+        if flush:
+            write_buffer.try_flush()
+    metrics.event_state.set(event, (site or '',))
+    metrics.event_y.set(y, (site or '',))
+    return changed
+
+
+def load_event_state(site):
+    event = get_previous_event(site)
+    return event.state if event is not None else None
+
+
+def insert_event(site, previous, state, y, at):
+    write_buffer.insert(Event.__table__, [dict(state=state, created_at=at, y=y, site=site)])
 
 
-def add_event(event, y):
-    new_event = Event(state=event, created_at=datetime.now(), y=y)
-    session.add(new_event)
-    session.commit()
+def insert_event_sample(site, sample):
+    write_buffer.insert(EventSample.__table__, [dict(sample, site=site)])
+
+
+# サイトごとの現在のイベント
+event_states = event_state.EventStateMachine(load_event_state, insert_event, insert_event_sample,
+                                             float(os.getenv('SSS_EVENT_SAMPLE_INTERVAL', '60')))
+
+
+def current_event(site=None):
+    return event_states.current(site)
 
 
 def update_hysteresis(sid):
-    sensor = session.query(TiltSensor).filter(TiltSensor.id==sid).first()
-    sensor.hysteresis_at = datetime.now()
-    session.commit()
-    
+    now = datetime.now()
+    state_cache.set_hysteresis_at(sid, now)
+    write_buffer.update(TiltSensor.__table__, sid, {'hysteresis_at': now})
+
+
+# 閾値テーブルの変更コマンドの送信
+table_dispatcher = dispatcher.TableDispatcher(os.getenv('SSS_FB_HOST', 'https://54.65.160.111:8443'),
+                                              (os.getenv('SSS_FB_CERT', './client.crt'),
+                                               os.getenv('SSS_FB_KEY', './client.key')),
+                                              workers=int(os.getenv('SSS_FB_WORKERS', '4')),
+                                              retries=int(os.getenv('SSS_FB_RETRIES', '3')))
+
+
+def end_transaction():
+    """
+    1メッセージの処理の終わりに読み込みのトランザクションを閉じ，このスレッドのセッションを捨てる
+    """
+    Session.remove()
+
+
+# unit_of_work ごとの，ロールバックのときに呼ぶ関数 (スレッドごと)
+_units = threading.local()
+
+
+def on_rollback(undo):
+    """
+    unit_of_work の中で行ったメモリ上の変更を取り消す関数を登録する．外で呼ばれたらなにもしない
+    """
+    undos = getattr(_units, 'undos', None)
+    if undos is not None:
+        undos.append(undo)
+
+
+def replay_pending(table, sid, add):
+    for row in write_buffer.pending(table):
+        if row['sensor_id'] == sid:
+            add(row)
+
+
+def discard_data(kind, sid, table, rows, readings):
+    """
+    ロールバックしたデータをバッファ，キャッシュ，集計値から取り除く．DBに書き込み始めていれば残す
+    """
+    if not write_buffer.discard(table, rows):
+        return
+    if kind is not None:
+        state_cache.discard(kind, sid, readings)
+        # 特徴量はキャッシュにあるデータから作り直す
+        sensor_features.invalidate(kind, sid)
+    # 集計値はDBから作り直し，まだ書き込んでいない行を足す
+    if table is SoilSensorData.__table__:
+        moisture_stats.invalidate(sid)
+        moisture_stats.rebuild(sid)
+        replay_pending(table, sid, lambda row: moisture_stats.add(sid, row['received_at'], row['moisture']))
+    elif table is WeatherSensorData.__table__:
+        rainfall_totals.invalidate(sid)
+        replay_pending(table, sid, lambda row: rainfall_totals.replay(
+            sid, row['received_at'], row['rainfall'], row['rain_accumulation']))
+
+
+@contextmanager
+def unit_of_work():
+    """
+    1メッセージ分の処理の単位．成功すればコミットし，例外ならロールバックする．
+    どちらの場合もセッションを捨てるので，失敗したときの状態が次のメッセージに残らない．
+    ロールバックでは，まだ書き込みを始めていないデータをバッファとキャッシュからも取り除く
+    (送信した閾値テーブルの変更，ヒステリシスとイベントの状態は戻さない)
+
+        with db.unit_of_work():
+            detector.detect(frame)
+    """
+    outer = getattr(_units, 'undos', None)
+    undos = _units.undos = []
+    try:
+        yield Session()
+        Session.commit()
+    except:
+        Session.rollback()
+        for undo in reversed(undos):
+            try:
+                undo()
+            except Exception:
+                logger.exception("failed to roll back")
+        del undos[:]
+        raise
+    finally:
+        _units.undos = outer
+        # 内側が成功しても，外側が失敗すれば取り消す
+        if outer is not None:
+            outer.extend(undos)
+        Session.remove()
+
 
 
 def create_test_sensor():
@@ -302,37 +855,69 @@ def create_test_data():
         '8.83',
         '0'
     ]
-    add_tilt_data(1, tilt_data)
-    add_soil_data(1, soil_data)
+    add_tilt_data(1, payload.parse_fields(tilt_data))
+    add_soil_data(1, payload.parse_fields(soil_data))
 
 
 def get_sensor(type_id, mac):
-    current_sensor = None
-    if type_id == '52660': # tilt sensor
-        current_sensor = session.query(TiltSensor).filter(TiltSensor.mac==mac).first()
-    elif type_id == '52652': # soil sensor
-        current_sensor = session.query(SoilSensor).filter(SoilSensor.mac==mac).first()
-    elif type_id == '0': # weather sernsor
-        raise ValueError("weather sensor is not defined yet")
-        pass
-    else:
+    if type_id not in SENSOR_MODELS:
         raise ValueError("unkonwon sensor port: {0}".format(type_id))
 
+    return sensor_registry.get(type_id, mac)
+
+
+def query_sensor(type_id, mac):
+    model = SENSOR_MODELS[type_id]
+    # 登録するときは大文字にするが，古い行は小文字のこともある (SQLiteでは大文字小文字を区別する)
+    current_sensor = session.query(model).filter(or_(model.mac==registry.normalize_mac(mac), model.mac==mac)).first()
+    if current_sensor is not None:
+        session.expunge(current_sensor)
     return current_sensor
 
 
+def query_all_sensors():
+    sensors = []
+    for type_id, model in SENSOR_MODELS.items():
+        for sensor in session.query(model).all():
+            session.expunge(sensor)
+            sensors.append((type_id, sensor))
+    return sensors
+
+
+# センサはMACアドレスで引けるように起動時に読み込んでおく
+SENSOR_MODELS = {
+    '0': WeatherSensor,
+    '52660': TiltSensor,
+    '52652': SoilSensor,
+}
+sensor_registry = registry.SensorRegistry(query_all_sensors, query_sensor,
+                                          float(os.getenv('SSS_REGISTRY_MISS_TTL', '60')))
+
+
+def get_group(name):
+    return sensor_registry.group(name)
+
+
 def get_all_tilt_sensors():
-    return session.query(TiltSensor).all()
+    return sensor_registry.all('52660')
 
 
 def get_soil_sensor():
-    return session.query(SoilSensor).first()
+    sensors = sensor_registry.all('52652')
+    return sensors[0] if sensors else None
 
 
-def get_previous_event():
-    return session.query(Event).order_by(Event.id.desc()).first()
+def get_previous_event(site=None):
+    pending = [event for event in write_buffer.pending(Event.__table__)
+               if site is None or event['site'] == site]
+    if pending:
+        return Event(**pending[-1])
+    query = session.query(Event)
+    if site is not None:
+        query = query.filter(Event.site==site)
+    return query.order_by(Event.id.desc()).first()
 
 
-def check_event_changed(new_event):
-    prev_event = get_previous_event()
-    return prev_event.state != new_event
+def check_event_changed(new_event, site=None):
+    prev_event = current_event(site)
+    return prev_event is None or prev_event != new_event
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class RecentKeys(object):
+    """
+    最近見たキーの集合 (LRU)．size を超えたら一番古いキーを捨てる
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        with self._lock:
+            if key in self._keys:
+                # 最近見たものとして末尾に移す
+                del self._keys[key]
+                self._keys[key] = True
+                return True
+            self._keys[key] = True
+            if len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
@@ -2,19 +2,24 @@
 
 import os
 import json
+import time
+import atexit
+import threading
 import paho.mqtt.client as mqtt
+import db
+import payload
+import metrics
+import retention
+import replicate
+import feedback
+import migrate
+import cluster
+import snapshot
 # detector
 import detector_v1 as detector
-from logging import getLogger, StreamHandler, FileHandler, DEBUG
-logger = getLogger(__name__)
-if not logger.handlers:
-    fileHandler = FileHandler(r'./log/detector_runner.log')
-    fileHandler.setLevel(DEBUG)
-    streamHander = StreamHandler()
-    streamHander.setLevel(DEBUG)
-    logger.setLevel(DEBUG)
-    logger.addHandler(fileHandler)
-    logger.addHandler(streamHander)
+from pipeline import Pipeline
+import logs
+logger = logs.get_logger(__name__, 'detector_runner')
 
 # MQTT broker server
 host = os.getenv('SSS_MQTT_HOST')
@@ -25,25 +30,77 @@ data_topic = 'sensor/data'
 # publish topic
 event_topic = 'sensor/event'
 
+# 検知ワーカー数．DBのセッションはスレッドごとなので並列に検知できる
+workers = int(os.getenv('SSS_WORKERS', '4'))
+queue_size = int(os.getenv('SSS_QUEUE_SIZE', '1000'))
+queue_policy = os.getenv('SSS_QUEUE_POLICY', 'block')
+stats_interval = float(os.getenv('SSS_STATS_INTERVAL', '60'))
+# 0ならメトリクスのHTTPエンドポイントを起動しない
+metrics_port = int(os.getenv('SSS_METRICS_PORT', '0'))
+
+pipeline = None
+# SSS_CLUSTER_SIZE が2以上ならこのプロセスはサイトの一部だけを受け持つ
+cluster_node = cluster.from_env(detector.site_topology, data_topic)
+
 
 def on_connect(client, data, flags, response_code):
     logger.info('status {0}'.format(response_code))
-    client.subscribe(data_topic)
+    for topic in (cluster_node.topics() if cluster_node is not None else [data_topic]):
+        client.subscribe(topic)
 
 
 def on_message(client, data, msg):
-    logger.info('Received: {0} {1}'.format(msg.topic, msg.payload))
-    new_data = msg.payload.split(',')
-    event = detector.detect(new_data)
-
-    if event == None:
-        logger.info("Event None")
-    elif event['changed']:
-        client.publish(event_topic, json.dumps(event))
+    # 受信スレッドではキューに入れるだけ
+    pipeline.submit(msg)
+
+
+def process(msg):
+    """
+    1メッセージ (バイナリ形式では複数フレーム) を検知して，パブリッシュするイベントのリストを返す
+    """
+    logger.info('Received: %s %r', msg.topic, msg.payload, extra=logs.sampled(topic=msg.topic))
+    try:
+        with metrics.stage_seconds.time(('parse',)):
+            frames = payload.parse(msg.payload)
+    except payload.ParseError as e:
+        metrics.invalid_payloads.inc()
+        logger.warning("invalid payload: {0}".format(e))
+        return None
+    if cluster_node is not None:
+        frames = cluster_node.claim(msg.topic, msg.payload, frames)
+    events = []
+    for frame in frames:
+        metrics.messages.inc(labels=(frame.port,))
+        metrics.start_message()
+        try:
+            with db.unit_of_work():
+                event = detector.detect(frame)
+        except Exception:
+            # 1つのセンサのエラーで同じメッセージの他のフレームを捨てない
+            metrics.failed_frames.inc(labels=(frame.port,))
+            logger.exception("failed to detect {0}".format(frame))
+            continue
+        finally:
+            metrics.finish_message()
+        if event is None:
+            logger.info("Event None", extra=logs.sampled())
+        else:
+            events.append(event)
+    return events
+
+
+def publish(client, event):
+    client.publish(event_topic, json.dumps(event))
+    if event['changed']:
         logger.info("Publisheed: {0}".format(event))
     else:
-        client.publish(event_topic, json.dumps(event))
-        logger.info("Not changed: {0}".format(event))
+        logger.info("Not changed: %s", event, extra=logs.sampled())
+
+
+def log_stats(interval):
+    while True:
+        time.sleep(interval)
+        logger.info("pipeline: {0}".format(json.dumps(pipeline.stats())))
 
 
 def main():
@@ -52,9 +109,52 @@ def main():
     publish: sensor/event
 
     データを受信後，イベント検知してパブリッシュ
+    受信，検知，パブリッシュはそれぞれ別のスレッドで行う
     """
 
+    global pipeline
+    default_site = detector.site_topology.default
+    # 重複データがあってユニークインデックスを作れなくても検知は止めない (migrate.py dedupe で解消する)
+    migrate.upgrade(default_site.name if default_site is not None else None, strict=False)
+    # パーティション化した生データのテーブルはユニークインデックスに received_at が入るので，重複は書き込み前に調べる
+    for table, columns in retention.DEDUPE_KEYS:
+        if retention.is_partitioned(table):
+            db.write_buffer.check_unique(table, columns)
+    # 前回のスナップショットがあれば，キャッシュを履歴から作り直さずに読み込む
+    snapshots = snapshot.from_env()
+    if snapshots is not None:
+        snapshot.warm_start(snapshots.path, int(os.getenv('SSS_SNAPSHOT_MAX_DELTA', '10000')))
+        atexit.register(snapshots.stop)
+        snapshots.start()
+    db.sensor_registry.reload()
+
     client = mqtt.Client(protocol=mqtt.MQTTv311)
+    if cluster_node is not None:
+        cluster_node.publish = client.publish
+        logger.info("cluster node {0} of {1}, subscribes {2}".format(
+            cluster_node.index, cluster_node.size, cluster_node.topics()))
+    pipeline = Pipeline(process, lambda event: publish(client, event),
+                        workers=workers, queue_size=queue_size, policy=queue_policy).start()
+    # 保存期間の処理はクラスタの中で1プロセスだけが行う
+    job = retention.from_env()
+    if job is not None and (cluster_node is None or cluster_node.index == 0):
+        job.start()
+    # 閾値テーブルの見直しは受け持つサイトの分だけ
+    feedback_job = feedback.from_env(detector.site_topology, cluster_node.owns if cluster_node is not None else None)
+    if feedback_job is not None:
+        feedback_job.start()
+    # ローカルのSQLiteに書いた行を中央のDBに送る
+    replication = replicate.from_env()
+    if replication is not None and (cluster_node is None or cluster_node.index == 0):
+        replication.start()
+    if metrics_port:
+        port_offset = cluster_node.index if cluster_node is not None else 0
+        metrics.serve(metrics_port + port_offset)
+        logger.info("metrics on http://127.0.0.1:{0}/metrics".format(metrics_port + port_offset))
+    if stats_interval > 0:
+        thread = threading.Thread(target=log_stats, args=(stats_interval,))
+        thread.daemon = True
+        thread.start()
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(host, port=port, keepalive=60)
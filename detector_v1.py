@@ -2,22 +2,21 @@
 import os
 import db
 import json
+import payload
+import metrics
+import topology
+try:
+    import scoring
+except ImportError:
+    # NumPyがない環境ではまとめて評価する機能は使えない
+    scoring = None
 import paho.mqtt.client as mqtt
 
-from datetime import datetime
 from sqlalchemy import *
 from sqlalchemy.orm import scoped_session, sessionmaker
-from logging import getLogger, FileHandler, StreamHandler, DEBUG
-
-logger = getLogger(__name__)
-if not logger.handlers:
-    fileHandler = FileHandler(r'./log/detector_v1.log')
-    fileHandler.setLevel(DEBUG)
-    streamHander = StreamHandler()
-    streamHander.setLevel(DEBUG)
-    logger.setLevel(DEBUG)
-    logger.addHandler(fileHandler)
-    logger.addHandler(streamHander)
+import logs
+
+logger = logs.get_logger(__name__, 'detector_v1')
 
 Event = {
     'normal': 0L,
@@ -25,219 +24,243 @@ Event = {
     'alert': 2L
 }
 
-FieldTiltSensors = {
-    'A': os.getenv('FIELD_TILT_MAC_A'),
-    'B': os.getenv('FIELD_TILT_MAC_B'),
-    'C': os.getenv('FIELD_TILT_MAC_C'),
-    'D': os.getenv('FIELD_TILT_MAC_D'),
-    'E': os.getenv('FIELD_TILT_MAC_E'),
-}
+# サイトごとのセンサ構成
+site_topology = topology.load()
+for site in site_topology:
+    for group, macs in site.groups.items():
+        db.sensor_registry.define_group(site.group_key(group), '52660', macs)
 
 
 
-def detect(data):
-    logger.info("########## received {0} ##########\n".format(datetime.now()) + str(data))
+def detect(frame):
+    """
+    frame: payload.TiltFrame, SoilFrame or WeatherFrame
+    """
+    logger.info("received %s", frame, extra=logs.sampled(port=frame.port, mac=frame.mac))
     # データからセンサの種類を特定し，データを保存
-    if data[0] == '0':
-        if data[3] == '$WIXDR' and float(data[13]) > 30.0:
-            current_event = Event['alert']
-            changed = db.check_event_changed(current_event)
-            sensor = db.get_sensor('52660', FieldTiltSensors['E'])
-            if sensor is not None:
-                change_sensors_table(sensor, 1)
-            sensor = db.get_sensor('52660', FieldTiltSensors['A'])
-            if sensor is not None:
-                change_sensors_table(sensor, 1)
-            db.add_event(current_event, -1)
-            logger.info('Weather Over the threshold')
-            return { "event": current_event, "changed": changed }
-        else:
-            return { "changed": False }
+    if frame.port == payload.WEATHER_PORT:
+        return detect_weather(frame)
 
-    sensor = db.get_sensor(data[0], data[1])
+    sensor = db.get_sensor(frame.port, frame.mac)
     if sensor is None:
-        if data[0] == '52660':
-            logger.info("New tilt sensor, mac: {0}".format(data[1]))
-            db.add_tilt_sensor('tilt sensor', data[1], 10)
+        if frame.port == payload.TILT_PORT:
+            logger.info("New tilt sensor, mac: {0}".format(frame.mac))
+            db.add_tilt_sensor('tilt sensor', frame.mac, 10)
         else:
-            logger.info("the sensor is unknown, port: {0}, mac: '{1}'".format(data[0], data[1]))
+            logger.info("the sensor is unknown, port: {0}, mac: '{1}'".format(frame.port, frame.mac))
         return None
 
-    sensor.save_data(data)
+    # 再送された観測データは検知しない
+    frame = db.remove_duplicates(sensor.id, frame)
+    if frame is None:
+        logger.info("duplicate data, mac: '%s'", sensor.mac, extra=logs.sampled(mac=sensor.mac))
+        return None
+
+    site, group = site_topology.locate(sensor.mac)
+    if site is None:
+        logger.info("the sensor does not belong to any site, mac: '{0}'".format(sensor.mac))
+        sensor.save_data(frame)
+        return None
+
+    with metrics.stage_seconds.time(('save_data',)):
+        sensor.save_data(frame)
 
     # しきい値を超えていたら強制的に警戒モード
-    if sensor.is_over_threshold():
+    with metrics.stage_seconds.time(('threshold',)):
+        over_threshold = sensor.is_over_threshold()
+    if over_threshold:
         current_event = Event['alert']
-        changed = db.check_event_changed(current_event)
-        change_sensors_table(sensor, 1)
-        db.add_event(current_event, -1)
-        logger.info('Over the threshold')
-        e = { "event": current_event, "changed": changed }
-        if sensor.mac == FieldTiltSensors['E']:
-            e['sensor'] = 'E'
-        else:
-            e['sensor'] = 'ABCD'
-        return e
+        change_group_table(site, group, 1)
+        changed = db.add_event(current_event, -1, site.name, flush=True)
+        logger.info('Over the threshold', extra=logs.fields(site=site.name, group=group, mac=sensor.mac, changed=changed))
+        return { "event": current_event, "changed": changed, "site": site.name, "sensor": group }
 
     # 検知アルゴリズムを用いて状態判定
-    current_event, y = detect_by_algo(sensor)
-    logger.info("event: {0}, y: {1}".format(current_event, y))
-    changed = db.check_event_changed(current_event)
+    with metrics.stage_seconds.time(('detect_by_algo',)):
+        current_event, y = detect_by_algo(site, group)
+    logger.info("event: %s, y: %s", current_event, y, extra=logs.sampled(site=site.name, event=current_event, y=y))
 
     # 前回と同じイベントの場合かつ傾斜センサのデータの場合，傾斜センサの閾値選択をする
-    previous_event = db.get_previous_event().state
-    e = { "event": current_event, "changed": changed }
-    if data[0] == '52660':
-        logger.info("Event: {0} -> {1}, Sensor state: {2}".format(previous_event, current_event, sensor.latest_node_state()))
+    previous_event = db.current_event(site.name)
+    e = { "event": current_event, "site": site.name }
+    if frame.port == payload.TILT_PORT:
+        logger.info("Event: %s -> %s, Sensor state: %s", previous_event, current_event, sensor.latest_node_state(),
+                    extra=logs.sampled())
         if sensor.is_hysteresis():
-            logger.info("Sensor hysteresis at: {0}".format(sensor.hysteresis_at))
-        # センサの閾値テーブルを変更
-        # if current_event == previous_event:
-        #     choose_threshold(sensor, current_event)
-       
+            logger.info("Sensor hysteresis at: %s", sensor.latest_hysteresis_at(), extra=logs.sampled())
+        # センサの閾値テーブルの選択は feedback.py が全センサまとめて定期的に行う
+
         # 傾斜センサの状態を変更
         if sensor.latest_node_state() != current_event:
             if current_event == 2:
-                change_sensors_table(sensor, 1)
+                change_group_table(site, group, 1)
             elif current_event == 1:
-                change_sensors_table(sensor, 2)
+                change_group_table(site, group, 2)
             elif current_event == 0:
-                change_sensors_table(sensor, 8)
-        if sensor.mac == FieldTiltSensors['E']:
-            e['sensor'] = 'E'
-        else:
-            e['sensor'] = 'ABCD'
-    elif data[0] == '52652':
-        logger.info("Event: {0} -> {1}, Soil sensor".format(previous_event, current_event))
+                change_group_table(site, group, 8)
+        e['sensor'] = group
+    elif frame.port == payload.SOIL_PORT:
+        logger.info("Event: %s -> %s, Soil sensor", previous_event, current_event, extra=logs.sampled())
         e['sensor'] = 'SOIL'
 
-    # イベントを保存
-    db.add_event(current_event, y)
+    # イベントを保存 (状態が変わったときだけ書き込まれる)
+    e['changed'] = db.add_event(current_event, y, site.name, flush=current_event == Event['alert'])
+    if e['changed']:
+        logger.info("event changed: {0} -> {1}".format(previous_event, current_event),
+                    extra=logs.fields(site=site.name, sensor=e['sensor'], previous=previous_event, event=current_event, y=y))
     return e
 
 
-def detect_by_algo(sensor):
+def detect_weather(frame):
+    """
+    気象センサのデータを保存し，雨量の合計か降雨強度がしきい値を超えていたらサイト全体を警戒モードにする
+    """
+    if frame.sentence != '$WIXDR':
+        return { "changed": False }
+
+    sensor = db.get_sensor(frame.port, frame.mac)
+    if sensor is None:
+        logger.info("New weather sensor, mac: {0}".format(frame.mac))
+        db.add_weather_sensor('weather sensor', frame.mac)
+        sensor = db.get_sensor(frame.port, frame.mac)
+
+    with metrics.stage_seconds.time(('save_data',)):
+        sensor.save_data(frame)
+
+    site, _ = site_topology.locate(sensor.mac)
+    if site is None:
+        return { "changed": False }
+
+    rainfall = sensor.rainfall()
+    over = sensor.over_thresholds(frame, site.rain_thresholds)
+    logger.info("rainfall: %s", dict(rainfall), extra=logs.sampled(site=site.name, rainfall=dict(rainfall)))
+    if not over:
+        return { "changed": False }
+
+    current_event = Event['alert']
+    for group in site.groups:
+        change_group_table(site, group, 1)
+    changed = db.add_event(current_event, -1, site.name, flush=True)
+    logger.info('Weather Over the threshold',
+                extra=logs.fields(site=site.name, event=current_event, changed=changed, over=over,
+                                  intensity=frame.measurements.get('R'), rainfall=dict(rainfall)))
+    return { "event": current_event, "changed": changed, "site": site.name }
+
+
+def detect_by_algo(site, group, c=1.0, d=1.0, b=1.0, delta=1.0):
     """
     最新のデータを用いて検知アルゴリズムによりイベント検知
+
+    c, d: 傾斜センサの重み, b: 土中水分量の重み, delta: 時間間隔
     """
-    # すべてのアクティブな傾斜センサの合計の重みsを計算
-    s = 0.0
-    delta = 1.0 # 時間間隔
-    c = 1.0 # 傾斜センサの重み
-    d = 1.0 # 同上
-    if sensor.mac == FieldTiltSensors['E']:
-        current_alpha = alpha(sensor, c, d)
-        s += current_alpha / delta
-    else:
-        sensor = db.get_sensor('52660', FieldTiltSensors['A'])
-        if sensor is not None:
-            current_alpha = alpha(sensor, c, d)
-            s += current_alpha / delta
-        sensor = db.get_sensor('52660', FieldTiltSensors['B'])
-        if sensor is not None:
-            current_alpha = alpha(sensor, c, d)
-            s += current_alpha / delta
-        sensor = db.get_sensor('52660', FieldTiltSensors['C'])
-        if sensor is not None:
-            current_alpha = alpha(sensor, c, d)
-            s += current_alpha / delta
-        sensor = db.get_sensor('52660', FieldTiltSensors['D'])
-        if sensor is not None:
-            current_alpha = alpha(sensor, c, d)
-            s += current_alpha / delta
-        s /= 4
+    # グループのすべてのアクティブな傾斜センサの重みの平均sを計算
+    tilts = []
+    for sensor in group_sensors(site, group):
+        last = sensor.latest_data()
+        if last is not None:
+            tilts.append((last, sensor.latest_diff()))
+    s = group_weight(tilts, len(site.groups[group]), c, d, delta)
 
     # a(t): 土中水分による時刻tにおける重みを計算
-    soil_sensor = db.get_sensor('52652', os.getenv('SOIL_MAC'))
-    b = 1.0 # 土中水分量の重み
-    sign = lambda x: 1 if x >= 0.0 else -1.0
-    a = soil_sensor.latest().moisture * (1 + b * sign(soil_sensor.latest_diff()) * (soil_sensor.latest().moisture - soil_sensor.min())) / 100.0
+    soil_sensor = db.get_sensor('52652', site.soil_mac)
+    a = moisture_weight(soil_sensor.latest().moisture, soil_sensor.latest_diff(), soil_sensor.min(), b)
 
     # y: 最終的なアルゴリズムによる値
     y = abs(a * s)
-    logger.info("y: {0}, a: {1}, s: {2}".format(y, a, s))
+    # 平滑化した値などは sensor.features() で参照できる．ログに書くときだけ計算する
+    logger.info("y: %s, a: %s, s: %s", y, a, s,
+                extra=logs.sampled(site=site.name, group=group, y=y, a=a, s=s,
+                                   moisture_rise=logs.Lazy(lambda: soil_sensor.features().rise)))
 
     # yをもちいてイベントを決定
-    logger.info("alert threshold : {0}, caution threshold: {1}".format(os.getenv('Y_ALERT_THRESHOLD'), os.getenv('Y_CAUTION_THRESHOLD')))
-    if y > float(os.getenv('Y_ALERT_THRESHOLD')):
-        logger.info("alert threshold")
-        return Event['alert'], y
-    elif y > float(os.getenv('Y_CAUTION_THRESHOLD')):
-        logger.info("caution threshold")
-        return Event['caution'], y
-    else:
-        return Event['normal'], y
+    logger.info("alert threshold : %s, caution threshold: %s", site.alert_threshold, site.caution_threshold,
+                extra=logs.sampled())
+    if site.alert_threshold is None or site.caution_threshold is None:
+        raise ValueError("thresholds are not configured for site {0}".format(site.name))
+    return classify(y, site.alert_threshold, site.caution_threshold), y
 
 
-# 本来はFeedbackかけるプロセスと検知するプロセスをわけたいが，とりあえずここでフィードバックをかける
-def choose_threshold(sensor, current_event):
-    sensor_state = sensor.latest_node_state()
-    if current_event < sensor_state:
-        # イベント検知結果よりセンサの検知結果の方が厳しく判定している
-        # 閾値をゆるめる方向に進める
-        loose_threshold(sensor)
-    elif current_event > sensor_state:
-        # イベント検知結果よりセンサの検知結果の方がゆるく判定している
-        # 閾値を厳しくする方向に進める
-        bind_threshold(sensor)
+def group_weight(tilts, group_size, c=1.0, d=1.0, delta=1.0):
+    """
+    tilts: [(最新のデータ, (diff_x, diff_y)), ...]
+    """
+    s = 0.0
+    for last, (diff_x, diff_y) in tilts:
+        current_alpha = alpha_of(last, diff_x, diff_y, c, d)
+        s += current_alpha / delta
+    s /= max(group_size, 1)
+    return s
 
 
-def alpha(tilt_sensor, c=1.0, d=1.0):
+def moisture_weight(moisture, diff, min_moisture, b=1.0):
     sign = lambda x: 1 if x >= 0.0 else -1.0
-    last = tilt_sensor.latest_data()
-    diff_x, diff_y = tilt_sensor.latest_diff()
-    alpha_x = 1.0 + c * abs(last.tilt_x) * (1 + d * sign(diff_x))
-    alpha_y = 1.0 + c * abs(last.tilt_y) * (1 + d * sign(diff_y))
+    return moisture * (1 + b * sign(diff) * (moisture - min_moisture)) / 100.0
 
-    return alpha_x * abs(diff_x) + alpha_y * abs(diff_y)
 
+def classify(y, alert_threshold, caution_threshold):
+    if y > alert_threshold:
+        logger.info("alert threshold")
+        return Event['alert']
+    elif y > caution_threshold:
+        logger.info("caution threshold", extra=logs.sampled())
+        return Event['caution']
+    else:
+        return Event['normal']
 
-def loose_threshold(sensor):
-    table_id = sensor.latest_table_id()
-    if table_id == 0:
-        sensor.change_table(4)
-    elif table_id == 4:
-        sensor.change_table(5)
-    elif table_id == 5:
-        sensor.change_table(8)
-    elif table_id == 8:
-        sensor.change_table(9)
 
+def evaluate_all(c=1.0, d=1.0, b=1.0, delta=1.0):
+    """
+    全サイトの全グループの y をまとめて計算する．結果は detect_by_algo と同じ
+    """
+    if scoring is None:
+        raise RuntimeError("numpy is required for batch evaluation")
+    groups, thresholds = [], []
+    for site in site_topology:
+        soil_sensor = db.get_sensor('52652', site.soil_mac)
+        if soil_sensor is None or soil_sensor.latest() is None:
+            continue
+        if site.alert_threshold is None or site.caution_threshold is None:
+            raise ValueError("thresholds are not configured for site {0}".format(site.name))
+        soil = (soil_sensor.latest().moisture, soil_sensor.latest_diff(), soil_sensor.min())
+        for group, macs in site.groups.items():
+            tilts = []
+            for sensor in group_sensors(site, group):
+                last = sensor.latest_data()
+                if last is None:
+                    continue
+                diff_x, diff_y = sensor.latest_diff()
+                tilts.append((last.tilt_x, last.tilt_y, diff_x, diff_y))
+            groups.append(((site.name, group), len(macs), tilts, soil))
+            thresholds.append((site.alert_threshold, site.caution_threshold))
+
+    snapshot = scoring.Snapshot.build(groups)
+    result = scoring.score(snapshot, c, d, b, delta)
+    states = scoring.classify(result['y'], [t[0] for t in thresholds], [t[1] for t in thresholds])
+    return [
+        { "site": key[0], "sensor": key[1], "event": long(state), "y": float(y) }
+        for key, state, y in zip(snapshot.keys, states, result['y'])
+    ]
 
-def bind_threshold(sensor):
-    table_id = sensor.latest_table_id()
-    if table_id == 4:
-        sensor.change_table(0)
-    elif table_id == 5:
-        sensor.change_table(4)
 
-    elif table_id == 8:
-        sensor.change_table(5)
-    elif table_id == 9:
-        sensor.change_table(8)
+def alpha(tilt_sensor, c=1.0, d=1.0):
+    diff_x, diff_y = tilt_sensor.latest_diff()
+    return alpha_of(tilt_sensor.latest_data(), diff_x, diff_y, c, d)
 
 
-def change_sensors_table(sensor, table_id):
-    if sensor.mac == FieldTiltSensors['E']:
-        sensor.change_table(table_id)
-    else:
-        # A~Dすべての状態を変更
-        change_group_table(table_id)
+def alpha_of(last, diff_x, diff_y, c=1.0, d=1.0):
+    sign = lambda x: 1 if x >= 0.0 else -1.0
+    alpha_x = 1.0 + c * abs(last.tilt_x) * (1 + d * sign(diff_x))
+    alpha_y = 1.0 + c * abs(last.tilt_y) * (1 + d * sign(diff_y))
 
+    return alpha_x * abs(diff_x) + alpha_y * abs(diff_y)
 
-def change_group_table(table_id):
-    sensor = db.get_sensor('52660', FieldTiltSensors['A'])
-    if sensor is not None:
-        sensor.change_table(table_id)
 
-    sensor = db.get_sensor('52660', FieldTiltSensors['B'])
-    if sensor is not None:
-        sensor.change_table(table_id)
+def group_sensors(site, group):
+    return db.get_group(site.group_key(group))
 
-    sensor = db.get_sensor('52660', FieldTiltSensors['C'])
-    if sensor is not None:
-        sensor.change_table(table_id)
 
-    sensor = db.get_sensor('52660', FieldTiltSensors['D'])
-    if sensor is not None:
-        sensor.change_table(table_id)
+def change_group_table(site, group, table_id):
+    # グループのすべてのセンサの状態を変更
+    with metrics.stage_seconds.time(('change_table',)):
+        for sensor in group_sensors(site, group):
+            sensor.change_table(table_id)
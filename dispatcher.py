@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+import logs
+
+logger = logs.get_logger(__name__, 'dispatcher')
+
+# ゲートウェイは自己署名証明書 (curl -k と同じ)
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+
+class TableDispatcher(object):
+    """
+    閾値テーブルの変更 (TiltPattarnCode) をゲートウェイに送る
+    submit は記録するだけで，ワーカースレッドがクライアント証明書のHTTPSで送る．
+    まだ送っていない同じデバイスへの変更は最新のものだけを送り，1デバイスには同時に1リクエストしか送らない．
+    2xx だけを送信済みとし，接続エラーと 5xx は retries 回まで待ち時間を倍にしながら再送する．
+    submit_batch は複数のデバイスの変更を1リクエストで送る
+    """
+
+    def __init__(self, url, cert, workers=4, retries=3, backoff=0.5, max_backoff=5.0, timeout=5.0):
+        self.url = url
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.cert = cert
+        self.http.headers['Content-Type'] = 'application/json'
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self._pending = OrderedDict()
+        self._batches = []
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='dispatcher-{0}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, mac, val):
+        self.start()
+        with self._cond:
+            if mac in self._pending:
+                logger.info("merge command for {0}: {1} -> {2}".format(mac, self._pending[mac], val))
+                self.merged += 1
+            # まだ送っていないまとめたコマンドより新しい
+            for commands in self._batches:
+                if any(m == mac for m, _ in commands):
+                    commands[:] = [(m, v) for m, v in commands if m != mac]
+                    self.merged += 1
+            self._batches = [commands for commands in self._batches if commands]
+            self._pending[mac] = val
+            self._cond.notify()
+
+    def submit_batch(self, commands):
+        """
+        commands: [(mac, val)]．1回のリクエストで送る
+        """
+        if not commands:
+            return
+        self.start()
+        with self._cond:
+            for mac, _ in commands:
+                if self._pending.pop(mac, None) is not None:
+                    self.merged += 1
+            self._batches.append(list(commands))
+            self._cond.notify()
+
+    def wait(self, timeout=None):
+        """
+        送信待ちのコマンドがなくなるまで待つ
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._batches or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def _next(self):
+        """
+        次に送るコマンドのリスト．まとめて送るものが先
+        """
+        with self._cond:
+            while True:
+                for i, commands in enumerate(self._batches):
+                    # 同じデバイスへの送信中のリクエストが終わってから送る
+                    if not any(mac in self._in_flight for mac, _ in commands):
+                        del self._batches[i]
+                        self._in_flight.update(mac for mac, _ in commands)
+                        return commands
+                for mac in self._pending:
+                    if mac not in self._in_flight:
+                        self._in_flight.add(mac)
+                        return [(mac, self._pending.pop(mac))]
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            commands = self._next()
+            try:
+                self._send(commands)
+            except Exception:
+                logger.exception("failed to send tables {0}".format(commands))
+                with self._cond:
+                    self.failed += len(commands)
+            finally:
+                with self._cond:
+                    self._in_flight.difference_update(mac for mac, _ in commands)
+                    self._cond.notify_all()
+
+    def _send(self, commands):
+        data = json.dumps({'TiltPattarnCode': [{'DeviceId': mac, 'Val': val} for mac, val in commands]})
+        for attempt in range(self.retries + 1):
+            try:
+                # verifyは環境変数 (REQUESTS_CA_BUNDLE) より優先させるためリクエストごとに渡す
+                response = self.http.post(self.url, data, cert=self.cert, verify=False, timeout=self.timeout)
+                if 200 <= response.status_code < 300:
+                    logger.info("sent tables {0}: {1}".format(commands, response.status_code))
+                    with self._cond:
+                        self.sent += len(commands)
+                    return True
+                if response.status_code < 500:
+                    # 送り直しても同じ結果になるので再送しない
+                    logger.error("gateway rejected tables {0}: {1}".format(commands, response.status_code))
+                    return self._failed(commands)
+                logger.info("gateway error {0} for {1}".format(response.status_code, commands))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                logger.info("connection error for {0}: {1}".format(commands, e))
+            if attempt < self.retries:
+                time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+        logger.error("failed to send tables {0}".format(commands))
+        return self._failed(commands)
+
+    def _failed(self, commands):
+        with self._cond:
+            self.failed += len(commands)
+        return False
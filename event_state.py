@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+
+class SiteState(object):
+    """
+    1サイト分の現在のイベントと，まだ書き込んでいない y の集計
+    """
+    __slots__ = ('state', 'started_at', 'count', 'y_min', 'y_max', 'y_sum', 'y_last')
+
+    def __init__(self, state):
+        self.state = state
+        self.reset(None)
+
+    def reset(self, at):
+        self.started_at = at
+        self.count = 0
+        self.y_min = None
+        self.y_max = None
+        self.y_sum = 0.0
+        self.y_last = None
+
+    def add(self, y, at):
+        if self.started_at is None:
+            self.started_at = at
+        self.count += 1
+        self.y_sum += y
+        self.y_last = y
+        if self.y_min is None or y < self.y_min:
+            self.y_min = y
+        if self.y_max is None or y > self.y_max:
+            self.y_max = y
+
+
+class EventStateMachine(object):
+    """
+    サイトごとの現在のイベントの状態 (メモリ上)
+    最初に使うときに loader(site) でDBの最後の状態を読み，あとはクエリせずに比べる．
+    状態が変わったときだけ on_transition(site, previous, state, y, at) を呼び，
+    その間の y は sample_interval 秒ごとに1つにまとめて on_sample(site, sample) に渡す (0なら書かない)
+    """
+
+    def __init__(self, loader, on_transition, on_sample, sample_interval=60.0):
+        self.loader = loader
+        self.on_transition = on_transition
+        self.on_sample = on_sample
+        self.sample_interval = timedelta(seconds=sample_interval)
+        self._sites = {}
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def _get(self, site):
+        state = self._sites.get(site)
+        if state is None:
+            state = self._sites[site] = SiteState(self.loader(site))
+        return state
+
+    def current(self, site):
+        with self._lock:
+            return self._get(site).state
+
+    def update(self, site, state, y, at=None):
+        """
+        新しいイベントを記録し，前回から変わったかを返す
+        """
+        at = at or datetime.now()
+        with self._lock:
+            current = self._get(site)
+            previous = current.state
+            changed = previous is None or previous != state
+            if changed:
+                self._sample(site, current, at)
+                current.state = state
+                current.reset(at)
+                self.on_transition(site, previous, state, y, at)
+                return changed
+            # しきい値超過による警戒 (y = -1) は集計しない
+            if self.sample_interval and y >= 0:
+                current.add(y, at)
+                if at - current.started_at >= self.sample_interval:
+                    self._sample(site, current, at)
+                    current.reset(at)
+            return changed
+
+    def _sample(self, site, current, at):
+        if not current.count:
+            return
+        self.on_sample(site, {
+            'state': current.state,
+            'started_at': current.started_at,
+            'ended_at': at,
+            'count': current.count,
+            'y_min': current.y_min,
+            'y_max': current.y_max,
+            'y_mean': current.y_sum / current.count,
+            'y_last': current.y_last,
+        })
+
+    def flush(self):
+        """
+        集計途中の y を書き出す
+        """
+        at = datetime.now()
+        with self._lock:
+            for site, current in self._sites.items():
+                self._sample(site, current, at)
+                current.reset(None)
+
+    def snapshot(self):
+        """
+        {サイト: 現在のイベント}
+        """
+        with self._lock:
+            return dict((site, current.state) for site, current in self._sites.items())
+
+    def restore(self, snapshot):
+        with self._lock:
+            for site, state in snapshot.items():
+                self._sites[site] = SiteState(state)
+
+    def invalidate(self, site=None):
+        with self._lock:
+            if site is None:
+                self._sites.clear()
+            else:
+                self._sites.pop(site, None)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+傾斜と土中水分の信号の特徴量 (移動平均・分散，EWMA，速度，加速度，水分の上昇量)
+1データごとに O(1) で更新し，読むときにDBを使わない
+"""
+
+import threading
+from array import array
+from collections import namedtuple
+
+from cache import TILT
+
+SignalSnapshot = namedtuple('SignalSnapshot', [
+    'count', 'last', 'mean', 'variance', 'ewma', 'velocity', 'acceleration'
+])
+
+TiltFeatures = namedtuple('TiltFeatures', ['x', 'y'])
+
+SoilFeatures = namedtuple('SoilFeatures', ['moisture', 'rise'])
+
+
+class RollingWindow(object):
+    """
+    直近 size 件の値の合計と二乗和を保持するリングバッファ
+    """
+    __slots__ = ('values', 'size', 'index', 'count', 'total', 'total_sq', 'pushes')
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self.values = array('d', [0.0]) * self.size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.pushes = 0
+
+    def push(self, value):
+        old = self.values[self.index]
+        if self.count == self.size:
+            self.total -= old
+            self.total_sq -= old * old
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.total_sq += value * value
+        self.index = (self.index + 1) % self.size
+        self.pushes += 1
+        # 足し引きの誤差がたまらないように，一周ごとに合計を計算し直す
+        if self.pushes % self.size == 0:
+            values = self.values[:self.count]
+            self.total = sum(values)
+            self.total_sq = sum(v * v for v in values)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return max((self.total_sq - self.total * self.total / self.count) / (self.count - 1), 0.0)
+
+
+class Signal(object):
+    """
+    1系列分の特徴量
+    """
+    __slots__ = ('window', 'alpha', 'ewma', 'last', 'velocity', 'acceleration')
+
+    def __init__(self, window, alpha):
+        self.window = RollingWindow(window)
+        self.alpha = alpha
+        self.ewma = None
+        self.last = None
+        self.velocity = 0.0
+        self.acceleration = 0.0
+
+    def push(self, value):
+        """
+        値を追加し，前の値からの差を返す
+        """
+        diff = 0.0
+        if self.last is not None:
+            diff = value - self.last
+            self.acceleration = diff - self.velocity
+            self.velocity = diff
+        self.last = value
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        self.window.push(value)
+        return diff
+
+    def snapshot(self):
+        return SignalSnapshot(self.window.count, self.last, self.window.mean(), self.window.variance(),
+                              self.ewma, self.velocity, self.acceleration)
+
+
+class FeatureEngine(object):
+    """
+    センサごとの特徴量．window: 平均と分散のサンプル数，alpha: EWMAの係数，
+    rise_window: 土中水分量の上昇を合計するサンプル数
+    """
+
+    def __init__(self, loader, window=32, alpha=0.2, rise_window=144):
+        self.loader = loader
+        self.window = window
+        self.alpha = alpha
+        self.rise_window = rise_window
+        self._sensors = {}
+        self._lock = threading.RLock()
+
+    def _new(self, kind):
+        if kind == TILT:
+            return (Signal(self.window, self.alpha), Signal(self.window, self.alpha))
+        return (Signal(self.window, self.alpha), RollingWindow(self.rise_window))
+
+    def _update(self, kind, signals, reading):
+        if kind == TILT:
+            signals[0].push(reading.tilt_x)
+            signals[1].push(reading.tilt_y)
+        else:
+            diff = signals[0].push(reading.moisture)
+            signals[1].push(max(diff, 0.0))
+
+    def _get(self, kind, sensor_id):
+        key = (kind, sensor_id)
+        signals = self._sensors.get(key)
+        if signals is None:
+            signals = self._sensors[key] = self._new(kind)
+            for reading in self.loader(kind, sensor_id):
+                self._update(kind, signals, reading)
+        return signals
+
+    def push(self, kind, sensor_id, readings):
+        """
+        新しいデータを追加する．キャッシュに追加する前に呼ぶこと
+        """
+        with self._lock:
+            signals = self._get(kind, sensor_id)
+            for reading in readings:
+                self._update(kind, signals, reading)
+
+    def features(self, kind, sensor_id):
+        with self._lock:
+            signals = self._get(kind, sensor_id)
+            if kind == TILT:
+                return TiltFeatures(signals[0].snapshot(), signals[1].snapshot())
+            return SoilFeatures(signals[0].snapshot(), signals[1].total)
+
+    def invalidate(self, kind=None, sensor_id=None):
+        with self._lock:
+            if kind is None:
+                self._sensors.clear()
+            else:
+                self._sensors.pop((kind, sensor_id), None)
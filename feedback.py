@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+センサの状態とサイトのイベントを比べて，傾斜センサの閾値テーブルを1段ずつ変える
+"""
+
+import os
+import time
+import threading
+from collections import namedtuple, Counter
+
+import db
+import cache
+import metrics
+import logs
+
+logger = logs.get_logger(__name__, 'feedback')
+
+# 閾値テーブルをゆるめる順
+LOOSER = {0: 4, 4: 5, 5: 8, 8: 9}
+STRICTER = dict((looser, table_id) for table_id, looser in LOOSER.items())
+
+Change = namedtuple('Change', ['sensor_id', 'mac', 'site', 'group', 'table_id', 'new_table_id'])
+
+changes_total = metrics.registry.counter('sss_feedback_changes_total',
+                                         'Threshold table changes made by the feedback controller.', ['direction'])
+skipped_total = metrics.registry.counter('sss_feedback_skipped_total',
+                                         'Threshold table changes held back (hysteresis, rate, limit).', ['reason'])
+
+
+def next_table(table_id, node_state, event):
+    """
+    次の閾値テーブル．変えなくてよければNone
+    """
+    if event < node_state:
+        # センサの方が厳しく判定している
+        return LOOSER.get(table_id)
+    if event > node_state:
+        return STRICTER.get(table_id)
+    return None
+
+
+class FeedbackController(object):
+    """
+    全傾斜センサの閾値テーブルを1回でまとめて見直す．owns(site) が偽のサイトは見ない
+    """
+
+    def __init__(self, topology, min_interval=600.0, max_changes=50, owns=None):
+        self.topology = topology
+        self.min_interval = min_interval
+        self.max_changes = max_changes
+        self.owns = owns
+        # 前回のサイトごとのイベントと，センサごとに最後に変えた時刻
+        self._events = {}
+        self._changed_at = {}
+
+    def plan(self, now=None):
+        """
+        このパスで変える Change のリスト
+        """
+        now = now or time.time()
+        events = db.event_states.snapshot()
+        changes, skipped = [], Counter()
+        for site in self.topology:
+            if self.owns is not None and not self.owns(site):
+                continue
+            event, previous = events.get(site.name), self._events.get(site.name)
+            self._events[site.name] = event
+            if event is None or event != previous:
+                continue
+            for group in site.groups:
+                for sensor in db.get_group(site.group_key(group)):
+                    if not db.state_cache.has(cache.TILT, sensor.id):
+                        continue
+                    latest = sensor.latest_data()
+                    if latest is None:
+                        continue
+                    table_id = next_table(latest.table_id, latest.node_state, event)
+                    if table_id is None:
+                        continue
+                    if sensor.is_hysteresis():
+                        skipped['hysteresis'] += 1
+                    elif now - self._changed_at.get(sensor.id, 0) < self.min_interval:
+                        skipped['rate'] += 1
+                    else:
+                        changes.append(Change(sensor.id, sensor.mac, site.name, group, latest.table_id, table_id))
+        if len(changes) > self.max_changes:
+            skipped['limit'] += len(changes) - self.max_changes
+            changes = changes[:self.max_changes]
+        for reason, count in skipped.items():
+            skipped_total.inc(count, (reason,))
+        return changes
+
+    def apply(self, changes, now=None):
+        if not changes:
+            return
+        now = now or time.time()
+        db.table_dispatcher.submit_batch([(change.mac, change.new_table_id) for change in changes])
+        for change in changes:
+            db.update_hysteresis(change.sensor_id)
+            self._changed_at[change.sensor_id] = now
+            changes_total.inc(1, ('looser' if change.new_table_id == LOOSER.get(change.table_id) else 'stricter',))
+            logger.info("change sensor {0} table_id from {1} to {2}".format(
+                change.sensor_id, change.table_id, change.new_table_id),
+                extra=logs.fields(site=change.site, group=change.group, mac=change.mac))
+
+    def run_once(self):
+        changes = self.plan()
+        self.apply(changes)
+        return changes
+
+
+class FeedbackJob(object):
+    """
+    run_once を interval 秒ごとにバックグラウンドで実行する
+    """
+
+    def __init__(self, controller, interval):
+        self.controller = controller
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='feedback')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.controller.run_once()
+            except Exception:
+                logger.exception("feedback failed")
+
+
+def from_env(topology, owns=None):
+    """
+    SSS_FEEDBACK_INTERVAL が0なら作らない
+    """
+    interval = float(os.getenv('SSS_FEEDBACK_INTERVAL', '0'))
+    if interval <= 0:
+        return None
+    return FeedbackJob(FeedbackController(topology,
+                                          float(os.getenv('SSS_FEEDBACK_MIN_INTERVAL', '600')),
+                                          int(os.getenv('SSS_FEEDBACK_MAX_CHANGES', '50')),
+                                          owns), interval)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+閾値テーブルの変更を受け取るゲートウェイ (SSS_FB_HOST) のローカルのHTTPSの代わり
+
+    python feedback_stub.py [port]
+"""
+
+import os
+import ssl
+import sys
+import json
+import threading
+import subprocess
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+def make_certificate(cert, key):
+    """
+    テスト用の自己署名証明書を作る
+    """
+    if os.path.exists(cert) and os.path.exists(key):
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-subj', '/CN=localhost', '-days', '1',
+                               '-keyout', key, '-out', cert], stdout=devnull, stderr=devnull)
+
+
+class StubGateway(object):
+
+    def __init__(self, port=0, cert='./stub_server.crt', key='./stub_server.key', fail_first=0, delay=0.0):
+        self.commands = []
+        self.requests = 0
+        self.fail_first = fail_first
+        self.delay = delay
+        self._lock = threading.Lock()
+        make_certificate(cert, key)
+
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with gateway._lock:
+                    gateway.requests += 1
+                    fail = gateway.requests <= gateway.fail_first
+                    if not fail:
+                        gateway.commands.extend(json.loads(body.decode('utf-8'))['TiltPattarnCode'])
+                if gateway.delay:
+                    threading.Event().wait(gateway.delay)
+                self.send_response(503 if fail else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', port), Handler)
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(cert, key)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        self.url = 'https://127.0.0.1:{0}'.format(self.port)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    stub = StubGateway(int(sys.argv[1]) if len(sys.argv) > 1 else 8443)
+    print("listening on {0}".format(stub.url))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(stub.commands))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+検知器のログ．キューに入れるだけで，別スレッドがファイルとコンソールに書く
+
+    logger = logs.get_logger(__name__, 'db')
+"""
+
+import os
+import json
+import atexit
+import threading
+import logging
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import metrics
+
+LOG_DIR = os.getenv('SSS_LOG_DIR', './log')
+LEVEL = getattr(logging, os.getenv('SSS_LOG_LEVEL', 'DEBUG').upper())
+FORMAT = os.getenv('SSS_LOG_FORMAT', 'json')
+MAX_BYTES = int(os.getenv('SSS_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+BACKUPS = int(os.getenv('SSS_LOG_BACKUPS', '5'))
+SAMPLE_EVERY = int(os.getenv('SSS_LOG_SAMPLE_EVERY', '100'))
+QUEUE_SIZE = int(os.getenv('SSS_LOG_QUEUE_SIZE', '10000'))
+CONSOLE = os.getenv('SSS_LOG_CONSOLE', '1') != '0'
+
+dropped = metrics.registry.counter('sss_log_dropped_total', 'Log records dropped because the log queue was full.')
+
+
+def fields(**values):
+    """
+    extra に渡す構造化した値
+    """
+    return {'fields': values}
+
+
+def sampled(**values):
+    """
+    extra に渡す．1メッセージごとに出るログは間引く
+    """
+    return {'fields': values, 'sampled': True}
+
+
+class Lazy(object):
+    """
+    sampled に渡す値．レコードが書かれるときだけ func() を呼ぶ
+    """
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'at': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, sort_keys=True)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    sampled な INFO 以下のレコードは呼び出し元ごとに `every` 件に1件だけ通す
+    """
+
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno >= logging.WARNING or not getattr(record, 'sampled', False):
+            return True
+        key = (record.name, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+class QueueHandler(logging.Handler):
+    """
+    レコードをキューに入れるだけのハンドラ．書き込みは LogWriter が行う
+    """
+
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+        self._formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # 別のスレッドで書くので，メッセージと例外はここで文字列にしておく
+        record.msg = record.getMessage()
+        record.args = None
+        values = getattr(record, 'fields', None)
+        if values:
+            record.fields = dict((name, value.func() if isinstance(value, Lazy) else value)
+                                 for name, value in values.items())
+        if record.exc_info:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        writer.ensure_started()
+        try:
+            self.records.put_nowait(self.prepare(record))
+        except queue.Full:
+            dropped.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """
+    キューからレコードを取り出し，ロガーごとのローテーションするファイルとコンソールに書く
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.files = {}
+        self.handlers = {}
+        self.console = None
+        if CONSOLE:
+            self.console = logging.StreamHandler()
+            self.console.setFormatter(logging.Formatter('%(message)s'))
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add_file(self, name, filename):
+        self.files[name] = filename
+
+    def file_handler(self, name):
+        handler = self.handlers.get(name)
+        if handler is None:
+            if not os.path.isdir(LOG_DIR):
+                os.makedirs(LOG_DIR)
+            path = os.path.join(LOG_DIR, '{0}.log'.format(self.files.get(name, name)))
+            handler = RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUPS)
+            handler.setFormatter(JsonFormatter() if FORMAT == 'json' else logging.Formatter('%(message)s'))
+            self.handlers[name] = handler
+        return handler
+
+    def ensure_started(self):
+        # fork した子プロセスではスレッドを起動し直す
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self.run, name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self.write(record)
+
+    def write(self, record):
+        for handler in (self.file_handler(record.name), self.console):
+            if handler is None:
+                continue
+            try:
+                handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+
+    def stop(self, timeout=5.0):
+        """
+        キューに残っているレコードを書き終えてから止める
+        """
+        if self._thread is None or self._pid != os.getpid():
+            return
+        try:
+            self.records.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers.clear()
+
+
+records = queue.Queue(QUEUE_SIZE)
+writer = LogWriter(records)
+handler = QueueHandler(records)
+handler.addFilter(SamplingFilter(SAMPLE_EVERY))
+atexit.register(writer.stop)
+
+
+def get_logger(name, filename=None):
+    """
+    ./log/<filename>.log に書くロガー．filename を省略したらロガーの名前にする
+    """
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        writer.add_file(name, filename or name)
+        logger.setLevel(LEVEL)
+        logger.addHandler(handler)
+    return logger
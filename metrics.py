@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus のテキスト形式のメトリクス
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# 秒単位の処理時間のバケット
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def check(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("{0} takes labels {1}, got {2}".format(self.name, self.labels, labels))
+        return tuple(labels)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        for labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(self.name, format_labels(self.labels, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        labels = self.check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    `set_function` で描画時に値を求める関数を登録できる
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self._functions = {}
+
+    def set(self, value, labels=()):
+        labels = self.check(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        labels = self.check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set_function(self, function, labels=()):
+        labels = self.check(labels)
+        with self._lock:
+            self._functions[labels] = function
+
+    def value(self, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            function = self._functions.get(labels)
+            if function is None:
+                return self._values.get(labels, 0)
+        return function()
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self._functions.clear()
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+        for labels, function in functions:
+            values[labels] = function()
+        return sorted(values.items())
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, labels=()):
+        labels = self.check(labels)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, labels)
+
+    def count(self, labels=()):
+        with self._lock:
+            state = self._values.get(tuple(labels))
+            return state[2] if state else 0
+
+    def sum(self, labels=()):
+        with self._lock:
+            state = self._values.get(tuple(labels))
+            return state[1] if state else 0.0
+
+    def samples(self):
+        with self._lock:
+            return sorted((labels, ([c for c in state[0]], state[1], state[2]))
+                          for labels, state in self._values.items())
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        for labels, (counts, total, count) in self.samples():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, format_labels(self.labels, labels, [('le', format_value(bound))]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, format_labels(self.labels, labels), format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, format_labels(self.labels, labels), count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def get(self, name):
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# 検知器のメトリクス
+messages = registry.counter('sss_messages_total', 'Frames received by sensor port.', ['port'])
+invalid_payloads = registry.counter('sss_invalid_payloads_total', 'Payloads rejected by the parser.')
+failed_frames = registry.counter('sss_failed_frames_total', 'Frames whose detection raised, by sensor port.', ['port'])
+duplicates = registry.counter('sss_duplicates_total',
+                              'Duplicate observations suppressed, by where they were caught (cache or db).',
+                              ['layer'])
+write_dropped_rows = registry.counter('sss_write_dropped_rows_total',
+                                     'Rows the write-behind buffer could not write and dropped.', ['table'])
+stage_seconds = registry.histogram('sss_stage_seconds', 'Time spent in each processing stage.', ['stage'])
+db_queries = registry.counter('sss_db_queries_total', 'SQL statements executed.')
+db_queries_per_message = registry.histogram('sss_db_queries_per_message', 'SQL statements executed per message.',
+                                            buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+event_state = registry.gauge('sss_event_state', 'Current event state per site (0 normal, 1 caution, 2 alert).',
+                             ['site'])
+event_y = registry.gauge('sss_event_y', 'Latest detection score per site.', ['site'])
+pipeline_messages = registry.counter('sss_pipeline_messages_total', 'Pipeline messages by outcome.', ['outcome'])
+queue_depth = registry.gauge('sss_queue_depth', 'Messages waiting in the pipeline queues.', ['queue'])
+cluster_frames = registry.counter('sss_cluster_frames_total',
+                                  'Frames by cluster routing outcome (owned, forwarded, skipped).', ['outcome'])
+
+_queries = threading.local()
+
+
+def count_query():
+    db_queries.inc()
+    _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+def start_message():
+    """
+    このスレッドで実行したクエリの数を数え始める
+    """
+    _queries.count = 0
+
+
+def finish_message():
+    db_queries_per_message.observe(getattr(_queries, 'count', 0))
+
+
+def serve(port, host='127.0.0.1', registry=registry):
+    """
+    /metrics を返すHTTPサーバをデーモンスレッドで起動する
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
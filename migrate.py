@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+バージョンごとの，何も消さないスキーマのマイグレーション
+
+    python migrate.py status|upgrade|dedupe|explain
+"""
+
+import sys
+import argparse
+from datetime import datetime
+from sqlalchemy import select, func, inspect, and_
+
+import db
+import logs
+
+logger = logs.get_logger(__name__, 'migrate')
+
+
+class MigrationError(Exception):
+    pass
+
+
+def indexes(conn, table):
+    return set(index['name'] for index in inspect(conn).get_indexes(table.name))
+
+
+def add_indexes(conn, table, names):
+    existing = indexes(conn, table)
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            logger.info("create index {0} on {1}".format(index.name, table.name))
+            index.create(bind=conn)
+
+
+def check_unique(conn, table, columns):
+    """
+    重複している値があればユニークインデックスを作らずにエラーにする
+    """
+    keys = [table.c[column] for column in columns]
+    duplicates = conn.execute(select(keys + [func.count()]).group_by(*keys)
+                              .having(func.count() > 1).limit(10)).fetchall()
+    if duplicates:
+        raise MigrationError("{0} has duplicate ({1}): {2}".format(
+            table.name, ', '.join(columns), ', '.join(str(tuple(row)) for row in duplicates)))
+
+
+def add_event_site(conn, options):
+    """
+    events.site を追加し，既存のイベントはデフォルトのサイトのものにする
+    """
+    columns = [column['name'] for column in inspect(conn).get_columns('events')]
+    if 'site' not in columns:
+        logger.info("add events.site, existing events belong to {0}".format(options.get('default_site')))
+        conn.execute('ALTER TABLE events ADD COLUMN site VARCHAR(32)')
+        conn.execute(db.Event.__table__.update().where(db.Event.site == None)
+                     .values(site=options.get('default_site')))
+
+
+def add_watermark_last_id(conn, options):
+    columns = [column['name'] for column in inspect(conn).get_columns('rollup_watermarks')]
+    if 'last_id' not in columns:
+        conn.execute('ALTER TABLE rollup_watermarks ADD COLUMN last_id INTEGER')
+
+
+def create_tables(*models):
+    """
+    models のテーブルがなければ作るマイグレーション．後から増えたモデルはそれぞれのバージョンで作る
+    """
+    def migration(conn, options):
+        for model in models:
+            model.__table__.create(bind=conn, checkfirst=True)
+    return migration
+
+
+def add_query_indexes(conn, options):
+    add_indexes(conn, db.Event.__table__, ['ix_events_site_id'])
+    add_indexes(conn, db.TiltSensorData.__table__,
+                ['ix_tilt_sensor_data_sensor_id_id', 'ix_tilt_sensor_data_received_at'])
+    add_indexes(conn, db.SoilSensorData.__table__,
+                ['ix_soil_sensor_data_sensor_id_id', 'ix_soil_sensor_data_sensor_id_moisture',
+                 'ix_soil_sensor_data_sensor_id_received_at', 'ix_soil_sensor_data_received_at'])
+    add_indexes(conn, db.TiltSensorRollup.__table__, ['ix_tilt_sensor_rollups_resolution_bucket_at'])
+    add_indexes(conn, db.SoilSensorRollup.__table__, ['ix_soil_sensor_rollups_resolution_bucket_at'])
+
+
+def add_unique_mac(conn, options):
+    for table, name in ((db.TiltSensor.__table__, 'ux_tilt_sensors_mac'),
+                        (db.SoilSensor.__table__, 'ux_soil_sensors_mac')):
+        if name not in indexes(conn, table):
+            check_unique(conn, table, ['mac'])
+            add_indexes(conn, table, [name])
+
+
+def add_unique_observation(conn, options):
+    table = db.TiltSensorData.__table__
+    if 'ux_tilt_sensor_data_sensor_id_observed_at' not in indexes(conn, table):
+        check_unique(conn, table, ['sensor_id', 'observed_at'])
+        add_indexes(conn, table, ['ux_tilt_sensor_data_sensor_id_observed_at'])
+
+
+def add_unique_soil_data(conn, options):
+    table = db.SoilSensorData.__table__
+    if 'ux_soil_sensor_data_sensor_id_data_get_at' not in indexes(conn, table):
+        check_unique(conn, table, ['sensor_id', 'data_get_at'])
+        add_indexes(conn, table, ['ux_soil_sensor_data_sensor_id_data_get_at'])
+
+
+# (バージョン, 説明, 関数)．追加するときは末尾に足す
+MIGRATIONS = [
+    (1, 'add events.site', add_event_site),
+    (2, 'create missing tables', create_tables(db.Event, db.EventSample, db.TiltSensor, db.TiltSensorData,
+                                               db.SoilSensor, db.SoilSensorData, db.TiltSensorRollup,
+                                               db.SoilSensorRollup, db.RollupWatermark)),
+    (3, 'add indexes for the hot queries', add_query_indexes),
+    (4, 'add unique sensor mac', add_unique_mac),
+    (5, 'add unique (sensor_id, observed_at) to tilt_sensor_data', add_unique_observation),
+    (6, 'add unique (sensor_id, data_get_at) to soil_sensor_data', add_unique_soil_data),
+    (7, 'create weather sensor tables', create_tables(db.WeatherSensor, db.WeatherSensorData)),
+    (8, 'create replication state table', create_tables(db.ReplicationState)),
+    (9, 'add rollup_watermarks.last_id', add_watermark_last_id),
+]
+
+
+def applied_versions(conn):
+    if not db.engine.dialect.has_table(conn, db.SchemaVersion.__tablename__):
+        return set()
+    table = db.SchemaVersion.__table__
+    return set(row[0] for row in conn.execute(select([table.c.version])))
+
+
+def upgrade(default_site=None, to=None, strict=True):
+    """
+    未適用のマイグレーションを順に適用する．適用したバージョンのリストを返す．
+    strict=False なら重複があって適用できないマイグレーションは警告して飛ばす (次の起動で再実行)
+    """
+    options = {'default_site': default_site}
+    with db.engine.connect() as conn:
+        if not db.engine.dialect.has_table(conn, db.Event.__tablename__):
+            # 空のDBはモデルどおりに作る
+            db.Base.metadata.create_all(bind=conn)
+        db.SchemaVersion.__table__.create(bind=conn, checkfirst=True)
+        done = applied_versions(conn)
+    applied = []
+    for number, description, migration in MIGRATIONS:
+        if number in done or (to is not None and number > to):
+            continue
+        logger.info("migration {0}: {1}".format(number, description))
+        # MySQLのDDLは暗黙にコミットされるので，失敗したら途中から再実行できるようにしてある
+        try:
+            with db.engine.begin() as conn:
+                migration(conn, options)
+                conn.execute(db.SchemaVersion.__table__.insert().values(
+                    version=number, description=description, applied_at=datetime.now()))
+        except MigrationError as e:
+            if strict:
+                raise
+            logger.warning("migration {0} skipped, run `python migrate.py dedupe --apply` and upgrade: {1}"
+                           .format(number, e))
+            continue
+        applied.append(number)
+    return applied
+
+
+def status():
+    with db.engine.connect() as conn:
+        done = applied_versions(conn)
+    for number, description, _ in MIGRATIONS:
+        print("{0} {1:3d} {2}".format('*' if number in done else ' ', number, description))
+
+
+# ユニークインデックスを妨げる重複
+
+# (テーブル, キー, 削除してよいか)
+UNIQUE_KEYS = [
+    (db.TiltSensor.__table__, ['mac'], False),
+    (db.SoilSensor.__table__, ['mac'], False),
+    (db.TiltSensorData.__table__, ['sensor_id', 'observed_at'], True),
+    (db.SoilSensorData.__table__, ['sensor_id', 'data_get_at'], True),
+]
+
+
+def duplicate_groups(conn, table, columns, limit=1000):
+    keys = [table.c[column] for column in columns]
+    return conn.execute(select(keys + [func.count()]).group_by(*keys)
+                        .having(func.count() > 1).limit(limit)).fetchall()
+
+
+def delete_duplicates(conn, table, columns, groups):
+    """
+    各グループの一番古い行 (idが最小) 以外を消し，消した行数を返す
+    """
+    deleted = 0
+    for group in groups:
+        condition = and_(*[table.c[column] == group[i] for i, column in enumerate(columns)])
+        ids = [row[0] for row in conn.execute(select([table.c.id]).where(condition).order_by(table.c.id))]
+        deleted += conn.execute(table.delete().where(table.c.id.in_(ids[1:]))).rowcount
+    return deleted
+
+
+def dedupe(apply=False):
+    """
+    {テーブル: 重複しているキーの数 (apply なら消した行数)}
+    """
+    result = {}
+    for table, columns, deletable in UNIQUE_KEYS:
+        total = 0
+        while True:
+            with db.engine.begin() as conn:
+                groups = duplicate_groups(conn, table, columns)
+                if not groups:
+                    break
+                if not (apply and deletable):
+                    for group in groups:
+                        print("{0} ({1}) = {2}: {3} rows".format(
+                            table.name, ', '.join(columns), tuple(group[:-1]), group[-1]))
+                    total += len(groups)
+                    break
+                total += delete_duplicates(conn, table, columns, groups)
+        if total:
+            logger.info("{0}: {1} {2}".format(table.name, total, 'rows deleted' if apply and deletable
+                                              else 'duplicate keys'))
+        result[table.name] = total
+    return result
+
+
+# EXPLAINで確認する検知器のクエリ
+
+def hot_queries():
+    tilt = db.TiltSensorData.__table__
+    soil = db.SoilSensorData.__table__
+    events = db.Event.__table__
+    weather = db.WeatherSensorData.__table__
+    since = datetime(2017, 1, 1)
+    return [
+        ('latest tilt data', select([tilt]).where(tilt.c.sensor_id == 1).order_by(tilt.c.id.desc()).limit(16)),
+        ('latest soil data', select([soil]).where(soil.c.sensor_id == 1).order_by(soil.c.id.desc()).limit(16)),
+        ('moisture stats', select([func.count(soil.c.id), func.sum(soil.c.moisture),
+                                   func.min(soil.c.moisture), func.max(soil.c.moisture),
+                                   func.max(soil.c.received_at)])
+                           .where(soil.c.sensor_id == 1)),
+        ('moisture window', select([soil.c.received_at, soil.c.moisture])
+                            .where(soil.c.sensor_id == 1).where(soil.c.received_at >= since)
+                            .order_by(soil.c.id)),
+        ('rainfall window', select([weather.c.received_at, weather.c.rainfall])
+                            .where(weather.c.sensor_id == 1).where(weather.c.received_at > since)
+                            .order_by(weather.c.id)),
+        ('tilt sensor by mac', select([db.TiltSensor.__table__]).where(db.TiltSensor.mac == 'AA')),
+        ('soil sensor by mac', select([db.SoilSensor.__table__]).where(db.SoilSensor.mac == 'AA')),
+        ('previous event', select([events]).where(events.c.site == 'default').order_by(events.c.id.desc()).limit(1)),
+        ('tilt rollup range', select([tilt]).where(tilt.c.received_at >= since).where(tilt.c.received_at < datetime.now())),
+        ('soil rollup range', select([soil]).where(soil.c.received_at >= since).where(soil.c.received_at < datetime.now())),
+    ]
+
+
+def explain(conn, query):
+    """
+    [(テーブル, 全件走査か, 詳細)]．インデックスを全部読む場合も全件走査とみなす
+    """
+    compiled = query.compile(dialect=conn.dialect)
+    processors = compiled._bind_processors
+    params = dict((name, processors[name](value) if name in processors else value)
+                  for name, value in compiled.params.items())
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if conn.dialect.name == 'sqlite':
+        result = []
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + str(compiled), params):
+            words = row[-1].split()
+            table = words[2] if len(words) > 2 and words[1] == 'TABLE' else words[1]
+            result.append((table, words[0] == 'SCAN', row[-1]))
+        return result
+    return [(row['table'], row['type'] in ('ALL', 'index'),
+             "type={0} key={1} rows={2}".format(row['type'], row['key'], row['rows']))
+            for row in conn.execute('EXPLAIN ' + str(compiled), params)]
+
+
+def check_queries():
+    """
+    全件走査するクエリがあればFalse
+    """
+    ok = True
+    with db.engine.connect() as conn:
+        for name, query in hot_queries():
+            for table, full_scan, detail in explain(conn, query):
+                print("{0:4} {1:22} {2:20} {3}".format('FULL' if full_scan else 'ok', name, table, detail))
+                ok = ok and not full_scan
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='schema migrations')
+    parser.add_argument('command', choices=['status', 'upgrade', 'dedupe', 'explain'])
+    parser.add_argument('--to', type=int, help='upgrade: stop at this version')
+    parser.add_argument('--default-site', help='upgrade: site of the events stored before sites existed')
+    parser.add_argument('--apply', action='store_true', help='dedupe: delete the duplicate rows')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        status()
+    elif args.command == 'upgrade':
+        default_site = args.default_site
+        if default_site is None:
+            import topology
+            site = topology.load().default
+            default_site = site.name if site is not None else None
+        applied = upgrade(default_site, args.to)
+        print("applied {0}".format(applied) if applied else "up to date")
+    elif args.command == 'dedupe':
+        print(dedupe(args.apply))
+    else:
+        sys.exit(0 if check_queries() else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+センサのペイロード (CSV とバイナリ) のパーサ．形式は README.md
+"""
+
+import struct
+from datetime import datetime
+
+from aggregate import to_datetime
+
+TILT_PORT = '52660'
+SOIL_PORT = '52652'
+WEATHER_PORT = '0'
+
+MAGIC = b'SSB'
+VERSION = 1
+
+HEADER = struct.Struct('<3sBH')
+FRAME = struct.Struct('<HB8s6B')
+MAC_SIZE = 8
+TILT = struct.Struct('<BfB')
+OBSERVATION = struct.Struct('<IfffB')
+SOIL = struct.Struct('<HHH6BHfff')
+WEATHER = struct.Struct('<B')
+MEASUREMENT = struct.Struct('<cf')
+
+
+class ParseError(ValueError):
+    pass
+
+
+class TiltObservation(object):
+    __slots__ = ('observed_at', 'tilt_x', 'tilt_y', 'tempereture', 'table_id')
+
+    def __init__(self, observed_at, tilt_x, tilt_y, tempereture, table_id):
+        self.observed_at = observed_at
+        self.tilt_x = tilt_x
+        self.tilt_y = tilt_y
+        self.tempereture = tempereture
+        self.table_id = table_id
+
+    def __repr__(self):
+        return "TiltObservation({0}, {1}, {2}, {3}, {4})".format(
+            self.observed_at, self.tilt_x, self.tilt_y, self.tempereture, self.table_id)
+
+
+class TiltFrame(object):
+    __slots__ = ('port', 'mac', 'received_at', 'node_id', 'node_state', 'battery_voltage', 'observations')
+
+    def __init__(self, mac, received_at, node_id, node_state, battery_voltage, observations):
+        self.port = TILT_PORT
+        self.mac = mac
+        self.received_at = received_at
+        self.node_id = node_id
+        self.node_state = node_state
+        self.battery_voltage = battery_voltage
+        self.observations = observations
+
+    def __repr__(self):
+        return "TiltFrame({0}, {1}, state {2}, battery {3}, {4})".format(
+            self.mac, self.received_at, self.node_state, self.battery_voltage, self.observations)
+
+
+class SoilFrame(object):
+    __slots__ = ('port', 'mac', 'received_at', 'command_id', 'sensor_type_id', 'data_size',
+                 'data_get_at', 'data_type', 'tempereture', 'moisture', 'ec')
+
+    def __init__(self, mac, received_at, command_id, sensor_type_id, data_size,
+                 data_get_at, data_type, tempereture, moisture, ec):
+        self.port = SOIL_PORT
+        self.mac = mac
+        self.received_at = received_at
+        self.command_id = command_id
+        self.sensor_type_id = sensor_type_id
+        self.data_size = data_size
+        self.data_get_at = data_get_at
+        self.data_type = data_type
+        self.tempereture = tempereture
+        self.moisture = moisture
+        self.ec = ec
+
+    def __repr__(self):
+        return "SoilFrame({0}, {1}, temperature {2}, moisture {3}, ec {4})".format(
+            self.mac, self.received_at, self.tempereture, self.moisture, self.ec)
+
+
+class WeatherFrame(object):
+    __slots__ = ('port', 'mac', 'received_at', 'sentence', 'measurements')
+
+    def __init__(self, mac, received_at, sentence, measurements):
+        self.port = WEATHER_PORT
+        self.mac = mac
+        self.received_at = received_at
+        self.sentence = sentence
+        # {'V': 雨量, 'Z': 降雨時間, 'R': 雨の強さ, ...}
+        self.measurements = measurements
+
+    def __repr__(self):
+        return "WeatherFrame({0}, {1}, {2}, {3})".format(
+            self.mac, self.received_at, self.sentence, self.measurements)
+
+
+def convert(kind, value, name):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise ParseError("invalid {0}: {1!r}".format(name, value))
+
+
+def timestamp(value, name='received_at'):
+    try:
+        return to_datetime(value)
+    except (TypeError, ValueError):
+        raise ParseError("invalid {0}: {1!r}".format(name, value))
+
+
+def parse_tilt(fields):
+    if len(fields) < 7:
+        raise ParseError("tilt payload has {0} fields".format(len(fields)))
+    count = convert(int, fields[6], 'number of observed data')
+    if count < 0 or len(fields) != 7 + 5 * count:
+        raise ParseError("tilt payload has {0} fields for {1} observations".format(len(fields), count))
+    observations = []
+    for i in range(7, len(fields), 5):
+        observations.append(TiltObservation(convert(int, fields[i], 'observed time'),
+                                            convert(float, fields[i + 1], 'tilt x'),
+                                            convert(float, fields[i + 2], 'tilt y'),
+                                            convert(float, fields[i + 3], 'temperature'),
+                                            convert(int, fields[i + 4], 'table id')))
+    return TiltFrame(fields[1], timestamp(fields[2]), fields[3],
+                     convert(int, fields[4], 'node state'),
+                     convert(float, fields[5], 'battery voltage'),
+                     observations)
+
+
+def parse_soil(fields):
+    if len(fields) != 11:
+        raise ParseError("soil payload has {0} fields".format(len(fields)))
+    return SoilFrame(fields[1], timestamp(fields[2]),
+                     convert(int, fields[3], 'command id'),
+                     convert(int, fields[4], 'sensor type id'),
+                     convert(int, fields[5], 'data size'),
+                     fields[6],
+                     convert(int, fields[7], 'data type'),
+                     convert(float, fields[8], 'temperature'),
+                     convert(float, fields[9], 'moisture'),
+                     convert(float, fields[10], 'ec'))
+
+
+def parse_weather(fields):
+    if len(fields) < 4:
+        raise ParseError("weather payload has {0} fields".format(len(fields)))
+    measurements = {}
+    if fields[3] == '$WIXDR':
+        if (len(fields) - 4) % 4:
+            raise ParseError("weather payload has {0} fields".format(len(fields)))
+        for i in range(4, len(fields), 4):
+            value = convert(float, fields[i + 1], fields[i])
+            # 雨の後に同じ種類の雹の値が来るので，最初の値を使う
+            measurements.setdefault(fields[i], value)
+    return WeatherFrame(fields[1], timestamp(fields[2]), fields[3], measurements)
+
+
+PARSERS = {
+    TILT_PORT: parse_tilt,
+    SOIL_PORT: parse_soil,
+    WEATHER_PORT: parse_weather,
+}
+
+
+def parse_fields(fields):
+    """
+    カンマで区切ったフィールドのリストを1フレームにする
+    """
+    parser = PARSERS.get(fields[0]) if fields else None
+    if parser is None:
+        raise ParseError("unknown port: {0!r}".format(fields[0] if fields else None))
+    return parser(fields)
+
+
+def format_mac(raw):
+    return ':'.join('{0:02x}'.format(b) for b in bytearray(raw))
+
+
+def binary_timestamp(values, name='received_at'):
+    year, month, day, hour, minute, second = values
+    try:
+        return datetime(2000 + year, month, day, hour, minute, second)
+    except ValueError:
+        raise ParseError("invalid {0}: {1!r}".format(name, values))
+
+
+def parse_binary(data):
+    """
+    バイナリ形式のペイロードをフレームのリストにする．memoryviewで読むのでコピーしない
+    """
+    view = memoryview(data)
+    try:
+        magic, version, count = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ParseError("unsupported binary payload: {0!r} version {1}".format(magic, version))
+        offset = HEADER.size
+        frames = []
+        for _ in range(count):
+            values = FRAME.unpack_from(view, offset)
+            offset += FRAME.size
+            port, size, received_at = str(values[0]), values[1], binary_timestamp(values[3:])
+            if size > MAC_SIZE:
+                raise ParseError("invalid mac length: {0}".format(size))
+            mac = format_mac(values[2][:size])
+            if port == TILT_PORT:
+                node_state, battery_voltage, n = TILT.unpack_from(view, offset)
+                offset += TILT.size
+                observations = []
+                for _ in range(n):
+                    observations.append(TiltObservation(*OBSERVATION.unpack_from(view, offset)))
+                    offset += OBSERVATION.size
+                frames.append(TiltFrame(mac, received_at, mac.replace(':', ''), node_state,
+                                        battery_voltage, observations))
+            elif port == SOIL_PORT:
+                values = SOIL.unpack_from(view, offset)
+                offset += SOIL.size
+                data_get_at = binary_timestamp(values[3:9], 'data_get_time').strftime('%y%m%d%H%M%S')
+                frames.append(SoilFrame(mac, received_at, values[0], values[1], values[2],
+                                        data_get_at, *values[9:]))
+            elif port == WEATHER_PORT:
+                n, = WEATHER.unpack_from(view, offset)
+                offset += WEATHER.size
+                measurements = {}
+                for _ in range(n):
+                    kind, value = MEASUREMENT.unpack_from(view, offset)
+                    offset += MEASUREMENT.size
+                    measurements[str(kind.decode('ascii'))] = value
+                frames.append(WeatherFrame(mac, received_at, '$WIXDR', measurements))
+            else:
+                raise ParseError("unknown port: {0!r}".format(port))
+    except struct.error as e:
+        raise ParseError("truncated binary payload: {0}".format(e))
+    if offset != len(view):
+        raise ParseError("{0} trailing bytes in binary payload".format(len(view) - offset))
+    return frames
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def parse(data):
+    """
+    MQTTのペイロードをフレームのリストにする
+    """
+    if is_binary(data):
+        return parse_binary(data)
+    if not isinstance(data, str):
+        data = data.decode('ascii', 'replace')
+    return [parse_fields(data.strip().split(','))]
+
+
+def sensor_key(data):
+    """
+    ペイロードを振り分けるためのキー (最初のフレームのMACアドレス)
+    """
+    if is_binary(data):
+        start = HEADER.size + 3
+        size = bytearray(data[start - 1:start])
+        return data[start:start + size[0]] if size else data
+    fields = data.split(b',' if isinstance(data, bytes) else ',', 2)
+    return fields[1] if len(fields) > 1 else data
+
+
+def pack_timestamp(at):
+    return (at.year - 2000, at.month, at.day, at.hour, at.minute, at.second)
+
+
+def pack(frames):
+    """
+    フレームのリストをバイナリ形式にする (ゲートウェイとベンチマーク用)
+    """
+    chunks = [HEADER.pack(MAGIC, VERSION, len(frames))]
+    for frame in frames:
+        mac = bytes(bytearray(int(b, 16) for b in frame.mac.split(':')))
+        if len(mac) > MAC_SIZE:
+            raise ValueError("mac too long for a binary frame: {0}".format(frame.mac))
+        chunks.append(FRAME.pack(int(frame.port), len(mac), mac, *pack_timestamp(frame.received_at)))
+        if frame.port == TILT_PORT:
+            chunks.append(TILT.pack(frame.node_state, frame.battery_voltage, len(frame.observations)))
+            for o in frame.observations:
+                chunks.append(OBSERVATION.pack(o.observed_at, o.tilt_x, o.tilt_y, o.tempereture, o.table_id))
+        elif frame.port == SOIL_PORT:
+            data_get_at = pack_timestamp(to_datetime(frame.data_get_at))
+            chunks.append(SOIL.pack(frame.command_id, frame.sensor_type_id, frame.data_size,
+                                    *(data_get_at + (frame.data_type, frame.tempereture, frame.moisture, frame.ec))))
+        else:
+            chunks.append(WEATHER.pack(len(frame.measurements)))
+            for kind, value in sorted(frame.measurements.items()):
+                chunks.append(MEASUREMENT.pack(kind.encode('ascii'), value))
+    return b''.join(chunks)
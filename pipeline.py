@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+import threading
+import metrics
+from payload import sensor_key
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import logs
+
+logger = logs.get_logger(__name__, 'pipeline')
+
+# キューが一杯のときの動作
+BLOCK = 'block'              # 受信スレッドを待たせる (バックプレッシャ)
+DROP_NEWEST = 'drop_newest'  # 新しいメッセージを捨てる
+DROP_OLDEST = 'drop_oldest'  # 一番古いメッセージを捨てる
+
+
+class StageStats(object):
+    """
+    1ステージ分の処理時間 (秒)．metrics の sss_stage_seconds にも記録する
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        metrics.stage_seconds.observe(seconds, (self.name,))
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self._lock:
+            mean = self.total / self.count if self.count else 0.0
+            return {'count': self.count, 'mean': mean, 'max': self.max}
+
+
+def partition_key(data):
+    """
+    センサのMACアドレス (バイナリ形式では最初のフレームのMACアドレス)
+    """
+    return sensor_key(data)
+
+
+class Pipeline(object):
+    """
+    受信 -> 検知ワーカー -> パブリッシュ のパイプライン
+    submit はMQTTのスレッドから呼ばれ，キューに入れるだけ．メッセージはMACでワーカーに振り分けるので，
+    1センサのメッセージは1つのワーカーが順に処理する．handler(msg) はイベント，イベントのリストかNoneを返し，
+    イベントは別スレッドの publisher(event) に渡す．キューが一杯のときの動作は policy で決める
+    """
+
+    def __init__(self, handler, publisher, workers=1, queue_size=1000, policy=BLOCK):
+        self.handler = handler
+        self.publisher = publisher
+        self.policy = policy
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.publish_queue = queue.Queue(queue_size)
+        self.stages = {
+            'queue': StageStats('queue'),
+            'detect': StageStats('detect'),
+            'publish_queue': StageStats('publish_queue'),
+            'publish': StageStats('publish'),
+        }
+        self.received = 0
+        self.dropped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            metrics.queue_depth.set_function(q.qsize, ('detector-{0}'.format(i),))
+            self._spawn(self._work, 'detector-{0}'.format(i), q)
+        metrics.queue_depth.set_function(self.publish_queue.qsize, ('publisher',))
+        self._spawn(self._publish, 'publisher', self.publish_queue)
+        return self
+
+    def _spawn(self, target, name, q):
+        thread = threading.Thread(target=target, name=name, args=(q,))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, msg):
+        q = self.queues[zlib.crc32(partition_key(msg.payload)) % len(self.queues)]
+        item = (time.time(), msg)
+        metrics.pipeline_messages.inc(labels=('received',))
+        with self._lock:
+            self.received += 1
+        if self.policy == BLOCK:
+            q.put(item)
+            return True
+        try:
+            q.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self.policy == DROP_OLDEST:
+            try:
+                q.get_nowait()
+                q.put_nowait(item)
+            except (queue.Empty, queue.Full):
+                pass
+        self._drop()
+        return False
+
+    def _drop(self):
+        metrics.pipeline_messages.inc(labels=('dropped',))
+        with self._lock:
+            self.dropped += 1
+            dropped = self.dropped
+        if dropped == 1 or dropped % 100 == 0:
+            logger.info("queue full, {0} messages dropped".format(dropped))
+
+    def _work(self, q):
+        while True:
+            queued_at, msg = q.get()
+            started = time.time()
+            self.stages['queue'].add(started - queued_at)
+            try:
+                event = self.handler(msg)
+            except Exception:
+                logger.exception("failed to process message: {0}".format(msg.payload))
+                metrics.pipeline_messages.inc(labels=('failed',))
+                with self._lock:
+                    self.failed += 1
+                event = None
+            finished = time.time()
+            self.stages['detect'].add(finished - started)
+            if event is None:
+                continue
+            for e in (event if isinstance(event, list) else [event]):
+                self.publish_queue.put((finished, e))
+
+    def _publish(self, q):
+        while True:
+            queued_at, event = q.get()
+            started = time.time()
+            self.stages['publish_queue'].add(started - queued_at)
+            try:
+                self.publisher(event)
+            except Exception:
+                logger.exception("failed to publish event: {0}".format(event))
+            self.stages['publish'].add(time.time() - started)
+
+    def stats(self):
+        return {
+            'workers': len(self.queues),
+            'queue_depth': [q.qsize() for q in self.queues],
+            'publish_queue_depth': self.publish_queue.qsize(),
+            'received': self.received,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'latency': dict((name, stage.snapshot()) for name, stage in self.stages.items()),
+        }
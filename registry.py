@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+
+def normalize_mac(mac):
+    return mac.upper() if mac else mac
+
+
+class SensorRegistry(object):
+    """
+    MACアドレス -> センサ の索引 (DBから1回だけ読む)
+    登録されていないMACは miss_ttl 秒覚えてから読み直すので，他のプロセスが登録したセンサも再起動せずに使える．
+    このプロセスで登録したセンサは forget ですぐ使える．グループは名前 -> MACのリスト で，登録済みのセンサを返す
+    """
+
+    def __init__(self, load_all, load_one, miss_ttl=60.0):
+        self.load_all = load_all
+        self.load_one = load_one
+        self.miss_ttl = miss_ttl
+        self._sensors = None
+        self._misses = {}
+        self._groups = {}
+        self._lock = threading.RLock()
+
+    def _index(self):
+        if self._sensors is None:
+            self.reload()
+        return self._sensors
+
+    def reload(self):
+        sensors = {}
+        for type_id, sensor in self.load_all():
+            sensors[(type_id, normalize_mac(sensor.mac))] = sensor
+        with self._lock:
+            self._sensors = sensors
+            self._misses = {}
+
+    def get(self, type_id, mac):
+        key = (type_id, normalize_mac(mac))
+        sensor = self._index().get(key)
+        if sensor is not None:
+            return sensor
+        with self._lock:
+            missed_at = self._misses.get(key)
+            if missed_at is not None and time.time() - missed_at < self.miss_ttl:
+                return None
+            sensor = self.load_one(type_id, mac)
+            if sensor is None:
+                self._misses[key] = time.time()
+            else:
+                self._sensors[key] = sensor
+            return sensor
+
+    def forget(self, type_id, mac):
+        """
+        新しく登録したセンサを次の参照時にDBから読む
+        """
+        with self._lock:
+            self._misses.pop((type_id, normalize_mac(mac)), None)
+
+    def all(self, type_id):
+        sensors = [sensor for key, sensor in self._index().items() if key[0] == type_id]
+        return sorted(sensors, key=lambda sensor: sensor.id)
+
+    def define_group(self, name, type_id, macs):
+        with self._lock:
+            self._groups[name] = (type_id, [mac for mac in macs if mac])
+
+    def group(self, name):
+        type_id, macs = self._groups[name]
+        sensors = [self.get(type_id, mac) for mac in macs]
+        return [sensor for sensor in sensors if sensor is not None]
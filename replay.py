@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+保存した履歴を検知アルゴリズムに通して，閾値の組み合わせを比べる
+"""
+
+import os
+import json
+import heapq
+import logging
+import argparse
+import itertools
+import multiprocessing
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import select
+
+import db
+import cache
+import aggregate
+import detector_v1 as detector
+from registry import normalize_mac
+
+
+class Config(object):
+
+    def __init__(self, name, alert=None, caution=None, c=1.0, d=1.0, b=1.0, delta=1.0):
+        self.name = name
+        # Noneの場合はサイトごとのしきい値を使う
+        self.alert = alert
+        self.caution = caution
+        self.c = c
+        self.d = d
+        self.b = b
+        self.delta = delta
+
+    @classmethod
+    def grid(cls, alerts, cautions, cs, ds, bs):
+        configs = []
+        for alert, caution, c, d, b in itertools.product(alerts, cautions, cs, ds, bs):
+            name = "alert{0}_caution{1}_c{2}_d{3}_b{4}".format(alert, caution, c, d, b)
+            configs.append(cls(name, alert, caution, c, d, b))
+        return configs
+
+
+class Run(object):
+    """
+    1つの設定でのリプレイ結果
+    """
+
+    def __init__(self, config, out):
+        self.config = config
+        self.states = {}
+        self.counts = Counter()
+        self.changes = 0
+        self.commands = 0
+        self.timeline = open(os.path.join(out, config.name + '.jsonl'), 'w')
+
+    def thresholds(self, site):
+        alert = self.config.alert if self.config.alert is not None else site.alert_threshold
+        caution = self.config.caution if self.config.caution is not None else site.caution_threshold
+        return alert, caution
+
+    def record(self, site, at, state, y):
+        self.counts[state] += 1
+        previous = self.states.get(site.name)
+        if previous != state:
+            self.states[site.name] = state
+            self.changes += 1
+            self.timeline.write(json.dumps({
+                'at': at.isoformat() if at else None, 'site': site.name,
+                'from': previous, 'to': state, 'y': y
+            }) + '\n')
+
+    def summary(self):
+        self.timeline.close()
+        return {
+            'name': self.config.name,
+            'alert': self.counts[detector.Event['alert']],
+            'caution': self.counts[detector.Event['caution']],
+            'normal': self.counts[detector.Event['normal']],
+            'changes': self.changes,
+            'table_commands': self.commands,
+        }
+
+
+class Replayer(object):
+    """
+    detect と同じ判定を，DBへの書き込みとテーブル変更なしで行う
+    """
+
+    def __init__(self, runs, topology, sensors):
+        self.runs = runs
+        self.topology = topology
+        self.sensors = dict(((type_id, sensor.id), sensor) for type_id, sensor in sensors)
+        self.soil_ids = dict((normalize_mac(sensor.mac), sensor.id)
+                             for type_id, sensor in sensors if type_id == '52652')
+        self.tilt_ids = dict((normalize_mac(sensor.mac), sensor.id)
+                             for type_id, sensor in sensors if type_id == '52660')
+        self.state = cache.SensorStateCache(2, lambda kind, sid, limit: [])
+        self.moisture = aggregate.MoistureAggregate(lambda sid, window: (0, 0.0, None, None, []),
+                                                    db.moisture_stats.window.days if db.moisture_stats.window else 0)
+
+    def tilt_message(self, sid, rows):
+        sensor = self.sensors.get(('52660', sid))
+        if sensor is None:
+            return
+        self.state.push(cache.TILT, sid, [db.tilt_reading(row) for row in rows])
+        site, group = self.topology.locate(sensor.mac)
+        if site is None:
+            return
+        at = rows[-1].received_at
+        latest = self.state.latest(cache.TILT, sid)
+        if abs(latest.tilt_x) > sensor.threshold or abs(latest.tilt_y) > sensor.threshold:
+            for run in self.runs:
+                run.record(site, at, detector.Event['alert'], -1)
+                run.commands += len(site.groups.get(group, []))
+            return
+        for run in self.runs:
+            state, y = self.evaluate(run, site, group)
+            if state is None:
+                continue
+            run.record(site, at, state, y)
+            if latest.node_state != state:
+                run.commands += len(site.groups.get(group, []))
+
+    def soil_message(self, sid, row):
+        sensor = self.sensors.get(('52652', sid))
+        if sensor is None:
+            return
+        self.state.push(cache.SOIL, sid, [db.soil_reading(row)])
+        self.moisture.add(sid, row.received_at, row.moisture)
+        site, group = self.topology.locate(sensor.mac)
+        if site is None:
+            return
+        # detect と同じく，しきい値を超えていたら強制的に警戒
+        if row.moisture > sensor.threshold:
+            for run in self.runs:
+                run.record(site, row.received_at, detector.Event['alert'], -1)
+                run.commands += len(site.groups.get(group, []))
+            return
+        for run in self.runs:
+            state, y = self.evaluate(run, site, group)
+            if state is not None:
+                run.record(site, row.received_at, state, y)
+
+    def evaluate(self, run, site, group):
+        soil_id = self.soil_ids.get(normalize_mac(site.soil_mac))
+        soil = self.state.latest(cache.SOIL, soil_id) if soil_id is not None else None
+        if soil is None or group not in site.groups:
+            return None, None
+        tilts = []
+        for mac in site.groups[group]:
+            sid = self.tilt_ids.get(normalize_mac(mac))
+            last = self.state.latest(cache.TILT, sid) if sid is not None else None
+            if last is not None:
+                tilts.append((last, self.state.latest_diff(cache.TILT, sid)))
+        config = run.config
+        s = detector.group_weight(tilts, len(site.groups[group]), config.c, config.d, config.delta)
+        a = detector.moisture_weight(soil.moisture, self.state.latest_diff(cache.SOIL, soil_id),
+                                     self.moisture.min(soil_id), config.b)
+        y = abs(a * s)
+        alert, caution = run.thresholds(site)
+        return detector.classify(y, alert, caution), y
+
+
+def read_chunks(table, since=None, until=None, chunk_size=10000):
+    """
+    idの昇順にchunk_size行ずつ読む
+    """
+    last_id = 0
+    while True:
+        query = select([table]).where(table.c.id > last_id)
+        if since is not None:
+            query = query.where(table.c.received_at >= since)
+        if until is not None:
+            query = query.where(table.c.received_at < until)
+        rows = db.engine.execute(query.order_by(table.c.id).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_id = rows[-1].id
+
+
+def history(since=None, until=None, chunk_size=10000):
+    """
+    傾斜センサと土中水分センサのデータを received_at の順に返す
+    """
+    def keyed(kind, order, rows):
+        for row in rows:
+            yield (row.received_at or datetime.min, order, row.id, kind, row)
+
+    tilt = keyed(cache.TILT, 0, read_chunks(db.TiltSensorData.__table__, since, until, chunk_size))
+    soil = keyed(cache.SOIL, 1, read_chunks(db.SoilSensorData.__table__, since, until, chunk_size))
+    for _, _, _, kind, row in heapq.merge(tilt, soil):
+        yield kind, row
+
+
+def replay(configs, out, since=None, until=None, chunk_size=10000):
+    runs = [Run(config, out) for config in configs]
+    replayer = Replayer(runs, detector.site_topology, db.query_all_sensors())
+    # 1メッセージの複数の観測データは同じ受信時刻で連続して保存されている
+    message = []
+    for kind, row in history(since, until, chunk_size):
+        if message and (kind != cache.TILT or row.sensor_id != message[0].sensor_id
+                        or row.received_at != message[0].received_at):
+            replayer.tilt_message(message[0].sensor_id, message)
+            message = []
+        if kind == cache.TILT:
+            message.append(row)
+        else:
+            replayer.soil_message(row.sensor_id, row)
+    if message:
+        replayer.tilt_message(message[0].sensor_id, message)
+    return [run.summary() for run in runs]
+
+
+def replay_worker(args):
+    # fork元の接続は使わない
+    db.engine.dispose()
+    return replay(*args)
+
+
+def sweep(configs, out, processes=1, since=None, until=None, chunk_size=10000):
+    if not os.path.exists(out):
+        os.makedirs(out)
+    processes = max(1, min(processes, len(configs)))
+    chunks = [configs[i::processes] for i in range(processes)]
+    if processes == 1:
+        results = [replay(configs, out, since, until, chunk_size)]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(replay_worker, [(chunk, out, since, until, chunk_size) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+    summary = sorted(itertools.chain.from_iterable(results), key=lambda result: result['name'])
+    with open(os.path.join(out, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def floats(value):
+    return [float(v) for v in value.split(',')] if value else [None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay sensor history through the detector')
+    parser.add_argument('--configs', help='JSON file with a list of configurations')
+    parser.add_argument('--alert', type=floats, default=[None])
+    parser.add_argument('--caution', type=floats, default=[None])
+    parser.add_argument('--c', type=floats, default=[1.0])
+    parser.add_argument('--d', type=floats, default=[1.0])
+    parser.add_argument('--b', type=floats, default=[1.0])
+    parser.add_argument('--since', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+    parser.add_argument('--until', type=lambda v: datetime.strptime(v, '%Y-%m-%d'))
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--out', default='replay_out')
+    args = parser.parse_args()
+    # 1件ごとの判定ログは出さない
+    detector.logger.setLevel(logging.WARNING)
+
+    if args.configs:
+        with open(args.configs) as f:
+            configs = [Config(**config) for config in json.load(f)]
+    else:
+        configs = Config.grid(args.alert, args.caution, args.c, args.d, args.b)
+    summary = sweep(configs, args.out, args.processes, args.since, args.until, args.chunk_size)
+    for result in summary:
+        print("{name}: alert {alert}, caution {caution}, changes {changes}, table commands {table_commands}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+ゲートウェイのSQLiteに書いた行を中央のMySQLに非同期で送る
+"""
+
+import os
+import socket
+import argparse
+import threading
+from datetime import datetime
+from sqlalchemy import select, func
+
+import db
+import metrics
+import writer
+import logs
+
+logger = logs.get_logger(__name__, 'replicate')
+
+replicated_rows = metrics.registry.counter('sss_replicated_rows_total', 'Rows sent to the central database.',
+                                           ['table'])
+replication_lag = metrics.registry.gauge('sss_replication_lag_rows',
+                                         'Rows not yet sent to the central database.', ['table'])
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def replicated_tables():
+    """
+    [(テーブル, sensor_id のセンサのモデル)]．送る順
+    """
+    return [
+        (db.TiltSensorData.__table__, db.TiltSensor),
+        (db.SoilSensorData.__table__, db.SoilSensor),
+        (db.WeatherSensorData.__table__, db.WeatherSensor),
+        (db.Event.__table__, None),
+        (db.EventSample.__table__, None),
+    ]
+
+
+class Replicator(object):
+    """
+    source (ローカルのDB) の新しい行を target (中央のDB) に送る
+    """
+
+    def __init__(self, source, target, name, batch_size=500):
+        self.source = source
+        self.target = target
+        self.name = name
+        self.batch_size = batch_size
+        # (センサのテーブル, ローカルのid) -> 中央のid
+        self._sensors = {}
+
+    def state_name(self, table):
+        return '{0}/{1}'.format(self.name, table.name)
+
+    def last_id(self, conn, table):
+        state = db.ReplicationState.__table__
+        return conn.execute(select([state.c.last_id]).where(state.c.name == self.state_name(table))).scalar()
+
+    def remote_sensor_id(self, model, local_id):
+        """
+        中央のDBでの同じMACのセンサのid．なければ作る
+        """
+        key = (model.__tablename__, local_id)
+        remote_id = self._sensors.get(key)
+        if remote_id is not None:
+            return remote_id
+        table = model.__table__
+        with self.source.connect() as conn:
+            sensor = conn.execute(select([table]).where(table.c.id == local_id)).first()
+        if sensor is None:
+            raise ReplicationError("{0} {1} does not exist".format(table.name, local_id))
+        with self.target.begin() as conn:
+            remote_id = conn.execute(select([table.c.id]).where(table.c.mac == sensor.mac)).scalar()
+            if remote_id is None:
+                values = dict((column, value) for column, value in sensor.items() if column != 'id')
+                remote_id = conn.execute(table.insert(), values).inserted_primary_key[0]
+                logger.info("created {0} {1} on the central database".format(table.name, sensor.mac))
+        self._sensors[key] = remote_id
+        return remote_id
+
+    def rows(self, table, sensor_model, rows):
+        values = []
+        for row in rows:
+            value = dict((column, v) for column, v in row.items() if column != 'id')
+            if sensor_model is not None and value.get('sensor_id') is not None:
+                value['sensor_id'] = self.remote_sensor_id(sensor_model, value['sensor_id'])
+            values.append(value)
+        return values
+
+    def replicate_batch(self, table, sensor_model):
+        """
+        1回分を送り，送った行数を返す
+        """
+        with self.target.connect() as conn:
+            last_id = self.last_id(conn, table)
+        with self.source.connect() as conn:
+            rows = conn.execute(select([table]).where(table.c.id > (last_id or 0))
+                                .order_by(table.c.id).limit(self.batch_size)).fetchall()
+        if not rows:
+            return 0
+        values = self.rows(table, sensor_model, rows)
+        state = db.ReplicationState.__table__
+        with self.target.begin() as conn:
+            # 他のプロセスが先に送っていたら何もしない
+            if self.last_id(conn, table) != last_id:
+                return 0
+            conn.execute(writer.insert_ignore(table), values)
+            progress = dict(last_id=rows[-1].id, replicated_at=datetime.now())
+            if last_id is None:
+                conn.execute(state.insert().values(name=self.state_name(table), **progress))
+            else:
+                conn.execute(state.update().where(state.c.name == self.state_name(table)).values(**progress))
+        replicated_rows.inc(len(rows), (table.name,))
+        return len(rows)
+
+    def lag(self, table):
+        with self.target.connect() as conn:
+            last_id = self.last_id(conn, table) or 0
+        with self.source.connect() as conn:
+            return conn.execute(select([func.count()]).where(table.c.id > last_id)).scalar()
+
+    def run_once(self):
+        """
+        追いつくまで送り，テーブルごとの送った行数を返す
+        """
+        sent = {}
+        for table, sensor_model in replicated_tables():
+            total = 0
+            while True:
+                count = self.replicate_batch(table, sensor_model)
+                total += count
+                if count < self.batch_size:
+                    break
+            sent[table.name] = total
+            replication_lag.set(self.lag(table), (table.name,))
+        if any(sent.values()):
+            logger.info("replicated {0}".format(sent))
+        return sent
+
+
+class ReplicationJob(object):
+    """
+    run_once を interval 秒ごとにバックグラウンドで実行する
+    """
+
+    def __init__(self, replicator, interval):
+        self.replicator = replicator
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='replicate')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.replicator.run_once()
+            except Exception as e:
+                # 中央のDBにつながらない間はローカルにためておく
+                logger.warning("replication failed, retry in {0}s: {1}".format(self.interval, e))
+            self._stop.wait(self.interval)
+
+
+def replicator_from_env():
+    """
+    SSS_REPLICA_URL が設定されていなければNone
+    """
+    url = os.getenv('SSS_REPLICA_URL', '')
+    if not url:
+        return None
+    return Replicator(db.get_engine(), db.create_db_engine(url, count_queries=False),
+                      os.getenv('SSS_REPLICA_SOURCE') or socket.gethostname(),
+                      int(os.getenv('SSS_REPLICA_BATCH_SIZE', '500')))
+
+
+def from_env():
+    replicator = replicator_from_env()
+    if replicator is None:
+        return None
+    return ReplicationJob(replicator, float(os.getenv('SSS_REPLICA_INTERVAL', '5')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replicate the local database to the central database')
+    parser.add_argument('command', choices=['once', 'run', 'status'])
+    parser.add_argument('--interval', type=float, default=float(os.getenv('SSS_REPLICA_INTERVAL', '5')))
+    args = parser.parse_args()
+
+    replicator = replicator_from_env()
+    if replicator is None:
+        parser.error('SSS_REPLICA_URL is not set')
+    if args.command == 'once':
+        print(replicator.run_once())
+    elif args.command == 'run':
+        job = ReplicationJob(replicator, args.interval)
+        job._run()
+    else:
+        for table, _ in replicated_tables():
+            print("{0:22} {1} rows behind".format(table.name, replicator.lag(table)))
+
+
+if __name__ == '__main__':
+    main()
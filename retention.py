@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+"""
+センサのデータの集計と保存期間
+
+    python retention.py once|run|partition
+"""
+
+import os
+import re
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import select, and_, text, func, inspect
+
+import db
+from aggregate import to_datetime
+import logs
+
+logger = logs.get_logger(__name__, 'retention')
+
+MINUTE = 'minute'
+HOUR = 'hour'
+DAY = 'day'
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+# 1回に読む範囲
+STEPS = {
+    MINUTE: timedelta(hours=1),
+    HOUR: timedelta(days=1),
+    DAY: timedelta(days=30),
+}
+
+
+def floor(at, resolution):
+    if resolution == MINUTE:
+        return at.replace(second=0, microsecond=0)
+    if resolution == HOUR:
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class Series(object):
+    """
+    集計するテーブルと列
+    """
+
+    def __init__(self, name, raw, rollup, fields):
+        self.name = name
+        self.raw = raw
+        self.rollup = rollup
+        self.fields = fields
+
+
+TILT = Series('tilt', db.TiltSensorData.__table__, db.TiltSensorRollup.__table__, ('tilt_x', 'tilt_y', 'tempereture'))
+SOIL = Series('soil', db.SoilSensorData.__table__, db.SoilSensorRollup.__table__, ('moisture', 'tempereture'))
+
+# 生データの重複のキー．パーティション化するとユニークインデックスだけでは弾けない
+DEDUPE_KEYS = (
+    (TILT.raw, ('sensor_id', 'observed_at')),
+    (SOIL.raw, ('sensor_id', 'data_get_at')),
+)
+
+
+class Bucket(object):
+    __slots__ = ('count', 'stats')
+
+    def __init__(self, fields):
+        self.count = 0
+        # 列ごとの [min, max, sum, last]
+        self.stats = dict((field, [None, None, 0.0, None]) for field in fields)
+
+    def add(self, count, values):
+        """
+        values: {field: (min, max, mean, last)}．生データなら count=1 で4つとも同じ値
+        """
+        for field, (lo, hi, mean, last) in values.items():
+            stat = self.stats[field]
+            if lo is not None and (stat[0] is None or lo < stat[0]):
+                stat[0] = lo
+            if hi is not None and (stat[1] is None or hi > stat[1]):
+                stat[1] = hi
+            if mean is not None:
+                stat[2] += mean * count
+            if last is not None:
+                stat[3] = last
+        self.count += count
+
+    def row(self, sensor_id, resolution, bucket_at):
+        row = dict(sensor_id=sensor_id, resolution=resolution, bucket_at=bucket_at, count=self.count)
+        for field, (lo, hi, total, last) in self.stats.items():
+            row[field + '_min'] = lo
+            row[field + '_max'] = hi
+            row[field + '_mean'] = total / self.count if self.count else None
+            row[field + '_last'] = last
+        return row
+
+
+def watermark_name(series, resolution):
+    return '{0}/{1}'.format(series.name, resolution)
+
+
+def get_watermark(conn, name):
+    table = db.RollupWatermark.__table__
+    return conn.execute(select([table.c.watermark]).where(table.c.name == name)).scalar()
+
+
+def get_last_id(conn, name):
+    table = db.RollupWatermark.__table__
+    return conn.execute(select([table.c.last_id]).where(table.c.name == name)).scalar()
+
+
+def set_watermark(conn, name, at, exists, last_id=None):
+    table = db.RollupWatermark.__table__
+    values = dict(watermark=at)
+    if last_id is not None:
+        values['last_id'] = last_id
+    if exists:
+        conn.execute(table.update().where(table.c.name == name).values(**values))
+    else:
+        conn.execute(table.insert().values(name=name, **values))
+
+
+def source(series, resolution):
+    """
+    (テーブル, 時刻の列, 条件) 分は生データ，時と日は1つ細かい集計値から作る
+    """
+    if resolution == MINUTE:
+        return series.raw, series.raw.c.received_at, None
+    finer = RESOLUTIONS[RESOLUTIONS.index(resolution) - 1]
+    return series.rollup, series.rollup.c.bucket_at, series.rollup.c.resolution == finer
+
+
+def first_bucket(conn, series, resolution):
+    table, at, condition = source(series, resolution)
+    query = select([func.min(at)])
+    if condition is not None:
+        query = query.where(condition)
+    first = conn.execute(query).scalar()
+    return floor(to_datetime(first), resolution) if first is not None else None
+
+
+def read_range(conn, series, resolution, start, stop, max_id=None, sensor_id=None):
+    table, at, condition = source(series, resolution)
+    query = select([table]).where(and_(at >= start, at < stop))
+    if condition is not None:
+        query = query.where(condition)
+    if max_id is not None:
+        query = query.where(table.c.id <= max_id)
+    if sensor_id is not None:
+        query = query.where(table.c.sensor_id == sensor_id)
+    return conn.execute(query.order_by(table.c.sensor_id, at, table.c.id)).fetchall()
+
+
+def bucket_values(series, row):
+    """
+    集計値の行の {field: (min, max, mean, last)}
+    """
+    return dict((field, tuple(row['{0}_{1}'.format(field, stat)] for stat in ('min', 'max', 'mean', 'last')))
+                for field in series.fields)
+
+
+def aggregate_rows(series, resolution, rows):
+    buckets = {}
+    for row in rows:
+        if resolution == MINUTE:
+            at = to_datetime(row.received_at)
+            count = 1
+            values = dict((field, (row[field],) * 4) for field in series.fields)
+        else:
+            at = to_datetime(row.bucket_at)
+            count = row.count
+            values = bucket_values(series, row)
+        key = (row.sensor_id, floor(at, resolution))
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = Bucket(series.fields)
+        bucket.add(count, values)
+    return [bucket.row(sensor_id, resolution, at) for (sensor_id, at), bucket in sorted(buckets.items())]
+
+
+# 時と日のバケットの長さ
+SIZES = {
+    HOUR: timedelta(hours=1),
+    DAY: timedelta(days=1),
+}
+
+
+def rebuild_bucket(conn, series, resolution, sensor_id, bucket_at):
+    """
+    集計済みの時・日のバケットを1つ細かい集計値から作り直す
+    """
+    rows = aggregate_rows(series, resolution, read_range(conn, series, resolution, bucket_at,
+                                                         bucket_at + SIZES[resolution], sensor_id=sensor_id))
+    rollup = series.rollup
+    conn.execute(rollup.delete().where(and_(rollup.c.sensor_id == sensor_id, rollup.c.resolution == resolution,
+                                            rollup.c.bucket_at == bucket_at)))
+    if rows:
+        conn.execute(rollup.insert(), rows)
+
+
+def merge_late_rows(conn, series, watermark, last_id, max_id):
+    """
+    分の集計が済んだ後に届いた行をバケットに足し，その上の時・日のバケットを作り直す．足した行数を返す
+    """
+    raw, rollup = series.raw, series.rollup
+    rows = conn.execute(select([raw]).where(and_(raw.c.id > last_id, raw.c.id <= max_id,
+                                                 raw.c.received_at < watermark))
+                        .order_by(raw.c.sensor_id, raw.c.received_at, raw.c.id)).fetchall()
+    if not rows:
+        return 0
+    changed = set()
+    for late in aggregate_rows(series, MINUTE, rows):
+        key = and_(rollup.c.sensor_id == late['sensor_id'], rollup.c.resolution == MINUTE,
+                   rollup.c.bucket_at == late['bucket_at'])
+        existing = conn.execute(select([rollup]).where(key)).first()
+        if existing is None:
+            conn.execute(rollup.insert(), [late])
+        else:
+            bucket = Bucket(series.fields)
+            bucket.add(late['count'], bucket_values(series, late))
+            # last は集計済みの値を残す
+            bucket.add(existing.count, bucket_values(series, existing))
+            conn.execute(rollup.update().where(rollup.c.id == existing.id)
+                         .values(**bucket.row(late['sensor_id'], MINUTE, late['bucket_at'])))
+        changed.add((late['sensor_id'], late['bucket_at']))
+    for resolution in (HOUR, DAY):
+        done = get_watermark(conn, watermark_name(series, resolution))
+        buckets = set((sensor_id, floor(at, resolution)) for sensor_id, at in changed)
+        for sensor_id, bucket_at in sorted(buckets):
+            if done is not None and bucket_at < done:
+                rebuild_bucket(conn, series, resolution, sensor_id, bucket_at)
+        changed = buckets
+    logger.info("merged {0} late rows of {1}".format(len(rows), series.name))
+    return len(rows)
+
+
+def rollup(series, resolution, now=None, lag=300):
+    """
+    ウォーターマーク以降の完了したバケットを集計する．書き込んだバケット数を返す
+    """
+    now = now or datetime.now()
+    name = watermark_name(series, resolution)
+    max_id = None
+    with db.engine.connect() as conn:
+        watermark = get_watermark(conn, name)
+        exists = watermark is not None
+        if resolution == MINUTE:
+            # この回で読む生データ．これより後に書かれた行は次の回に遅れた行として足す
+            max_id = conn.execute(select([func.max(series.raw.c.id)])).scalar() or 0
+            last_id = get_last_id(conn, name)
+        if watermark is None:
+            watermark = first_bucket(conn, series, resolution)
+            if watermark is None:
+                return 0
+        end = floor(now - timedelta(seconds=lag), resolution)
+        if resolution != MINUTE:
+            # 1つ細かい集計が終わったところまで
+            finer = get_watermark(conn, watermark_name(series, RESOLUTIONS[RESOLUTIONS.index(resolution) - 1]))
+            if finer is None:
+                return 0
+            end = min(end, floor(finer, resolution))
+    if resolution == MINUTE and exists:
+        with db.engine.begin() as conn:
+            if last_id is not None:
+                merge_late_rows(conn, series, watermark, last_id, max_id)
+            set_watermark(conn, name, watermark, exists, max_id)
+    written = 0
+    while watermark < end:
+        stop = min(end, watermark + STEPS[resolution])
+        with db.engine.begin() as conn:
+            rows = aggregate_rows(series, resolution, read_range(conn, series, resolution, watermark, stop, max_id))
+            if rows:
+                conn.execute(series.rollup.insert(), rows)
+            set_watermark(conn, name, stop, exists, max_id)
+        exists = True
+        written += len(rows)
+        watermark = stop
+    if written:
+        logger.info("rolled up {0} {1} buckets of {2} up to {3}".format(written, resolution, series.name, watermark))
+    return written
+
+
+def newest_ids(table):
+    """
+    センサごとの最新の行．検知器のキャッシュの初期化に使うので消さない
+    """
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(select([func.max(table.c.id)]).group_by(table.c.sensor_id))]
+
+
+def oldest_received_at(table, ids):
+    if not ids:
+        return None
+    with db.engine.connect() as conn:
+        return conn.execute(select([func.min(table.c.received_at)]).where(table.c.id.in_(ids))).scalar()
+
+
+def expire(table, column, before, batch_size=1000, pause=0.0, keep=(), max_id=None):
+    """
+    before より古い行を batch_size 行ずつ消す．keep のidと max_id より新しいidは消さない．消した行数を返す
+    """
+    deleted = 0
+    query = select([table.c.id]).where(column < before)
+    if keep:
+        query = query.where(~table.c.id.in_(keep))
+    if max_id is not None:
+        query = query.where(table.c.id <= max_id)
+    while True:
+        with db.engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(query.order_by(table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            conn.execute(table.delete().where(table.c.id.in_(ids)))
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+    if deleted:
+        logger.info("deleted {0} rows of {1} before {2}".format(deleted, table.name, before))
+    return deleted
+
+
+def raw_cutoff(series, raw_days, now):
+    """
+    (生データを消してよい時刻, 分の集計で読んだ最大のid)．分の集計が済んでいない行は消さない
+    """
+    with db.engine.connect() as conn:
+        watermark = get_watermark(conn, watermark_name(series, MINUTE))
+        last_id = get_last_id(conn, watermark_name(series, MINUTE))
+    if watermark is None or last_id is None:
+        return None, None
+    days = raw_days
+    if series is SOIL and db.moisture_stats.window is not None:
+        days = max(days, db.moisture_stats.window.days)
+    return min(now - timedelta(days=days), watermark), last_id
+
+
+def run_once(raw_days=0, sample_days=0, lag=300, batch_size=1000, pause=0.0, now=None):
+    now = now or datetime.now()
+    for series in (TILT, SOIL):
+        for resolution in RESOLUTIONS:
+            rollup(series, resolution, now, lag)
+        if raw_days > 0:
+            before, last_id = raw_cutoff(series, raw_days, now)
+            if before is not None:
+                keep = newest_ids(series.raw)
+                drop_partitions(series.raw, min(before, oldest_received_at(series.raw, keep) or before))
+                expire(series.raw, series.raw.c.received_at, before, batch_size, pause, keep, last_id)
+    if sample_days > 0:
+        samples = db.EventSample.__table__
+        expire(samples, samples.c.ended_at, now - timedelta(days=sample_days), batch_size, pause)
+
+
+class RetentionJob(object):
+    """
+    run_once を interval 秒ごとにバックグラウンドで実行する
+    """
+
+    def __init__(self, interval, **options):
+        self.interval = interval
+        self.options = options
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='retention')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_once(**self.options)
+            except Exception:
+                logger.exception("retention failed")
+            self._stop.wait(self.interval)
+
+
+def from_env():
+    """
+    環境変数の設定でジョブを作る．SSS_RETENTION_INTERVAL が0なら作らない
+    """
+    interval = float(os.getenv('SSS_RETENTION_INTERVAL', '0'))
+    if interval <= 0:
+        return None
+    return RetentionJob(interval,
+                        raw_days=int(os.getenv('SSS_RETENTION_RAW_DAYS', '0')),
+                        sample_days=int(os.getenv('SSS_RETENTION_SAMPLE_DAYS', '0')),
+                        lag=int(os.getenv('SSS_ROLLUP_LAG', '300')),
+                        batch_size=int(os.getenv('SSS_RETENTION_BATCH_SIZE', '1000')))
+
+
+# MySQLの月ごとのパーティション
+
+def month_start(at):
+    return at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(at):
+    return month_start(month_start(at) + timedelta(days=32))
+
+
+def partition_clause(at):
+    return "PARTITION p{0} VALUES LESS THAN (TO_DAYS('{1}'))".format(at.strftime('%Y%m'), next_month(at).date())
+
+
+def is_partitioned(table):
+    with db.engine.connect() as conn:
+        return bool(partitions(conn, table))
+
+
+def partition_ddl(table, foreign_keys, unique_indexes, first, months):
+    """
+    received_at の月ごとに RANGE パーティションを切るDDL
+
+    パーティションのキーは主キーとユニークインデックスに含める必要があり，
+    パーティション化したInnoDBのテーブルは外部キーを持てないので，それも変更する
+    ユニークインデックスに received_at が入ると (sensor_id, observed_at) の重複をDBが弾かなくなるので，
+    検知器は DEDUPE_KEYS のキーを書き込み時に調べる
+    unique_indexes: [(名前, 列のリスト)]
+    """
+    statements = ['ALTER TABLE {0} DROP FOREIGN KEY {1}'.format(table.name, fk) for fk in foreign_keys]
+    statements.append('ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY (id, received_at)'.format(table.name))
+    for name, columns in unique_indexes:
+        if 'received_at' not in columns:
+            statements.append('ALTER TABLE {0} DROP INDEX {1}, ADD UNIQUE INDEX {1} ({2})'.format(
+                table.name, name, ', '.join(list(columns) + ['received_at'])))
+    partitions = []
+    at = month_start(first)
+    for _ in range(months):
+        partitions.append(partition_clause(at))
+        at = next_month(at)
+    partitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+    statements.append('ALTER TABLE {0} PARTITION BY RANGE (TO_DAYS(received_at)) (\n    {1}\n)'.format(
+        table.name, ',\n    '.join(partitions)))
+    return statements
+
+
+def partitions(conn, table):
+    """
+    [(パーティション名, 月の初め)]．パーティション化されていなければ空
+    """
+    if db.engine.dialect.name != 'mysql':
+        return []
+    rows = conn.execute(text("SELECT partition_name FROM information_schema.partitions "
+                             "WHERE table_schema = DATABASE() AND table_name = :table "
+                             "AND partition_name IS NOT NULL ORDER BY partition_ordinal_position"),
+                        table=table.name).fetchall()
+    result = []
+    for (name,) in rows:
+        match = re.match(r'^p(\d{6})$', name)
+        if match:
+            result.append((name, datetime.strptime(match.group(1), '%Y%m')))
+    return result
+
+
+def drop_partitions(table, before):
+    """
+    全体が before より古い月のパーティションを DROP PARTITION で消す
+    """
+    with db.engine.connect() as conn:
+        old = [name for name, at in partitions(conn, table) if next_month(at) <= before]
+        if old:
+            conn.execute('ALTER TABLE {0} DROP PARTITION {1}'.format(table.name, ', '.join(old)))
+            logger.info("dropped partitions {0} of {1}".format(', '.join(old), table.name))
+    return old
+
+
+def add_partitions(table, until):
+    """
+    pmax を分割して until の月までのパーティションを作る
+    """
+    with db.engine.connect() as conn:
+        existing = partitions(conn, table)
+        if not existing:
+            return []
+        at = next_month(existing[-1][1])
+        new = []
+        while at <= month_start(until):
+            new.append(partition_clause(at))
+            at = next_month(at)
+        if new:
+            conn.execute('ALTER TABLE {0} REORGANIZE PARTITION pmax INTO ({1}, PARTITION pmax VALUES LESS THAN MAXVALUE)'
+                         .format(table.name, ', '.join(new)))
+    return new
+
+
+def foreign_keys(table):
+    return [fk['name'] for fk in inspect(db.get_engine()).get_foreign_keys(table.name) if fk.get('name')]
+
+
+def unique_indexes(table):
+    return [(index['name'], index['column_names'])
+            for index in inspect(db.get_engine()).get_indexes(table.name) if index.get('unique')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='roll up and expire sensor data')
+    parser.add_argument('command', choices=['once', 'run', 'partition'])
+    parser.add_argument('--interval', type=float, default=600)
+    parser.add_argument('--raw-days', type=int, default=int(os.getenv('SSS_RETENTION_RAW_DAYS', '0')))
+    parser.add_argument('--sample-days', type=int, default=int(os.getenv('SSS_RETENTION_SAMPLE_DAYS', '0')))
+    parser.add_argument('--lag', type=int, default=int(os.getenv('SSS_ROLLUP_LAG', '300')))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between delete batches')
+    parser.add_argument('--months', type=int, default=24, help='partition: months to create from the oldest row')
+    parser.add_argument('--apply', action='store_true', help='partition: execute the DDL instead of printing it')
+    args = parser.parse_args()
+
+    if args.command == 'partition':
+        if db.engine.dialect.name != 'mysql':
+            parser.error('partitioning needs MySQL')
+        for table in (TILT.raw, SOIL.raw):
+            with db.engine.connect() as conn:
+                if partitions(conn, table):
+                    add_partitions(table, datetime.now() + timedelta(days=62))
+                    continue
+                first = conn.execute(select([func.min(table.c.received_at)])).scalar() or datetime.now()
+            for statement in partition_ddl(table, foreign_keys(table), unique_indexes(table), first, args.months):
+                if args.apply:
+                    logger.info(statement)
+                    db.engine.execute(statement)
+                else:
+                    print(statement + ';')
+        return
+
+    options = dict(raw_days=args.raw_days, sample_days=args.sample_days, lag=args.lag,
+                   batch_size=args.batch_size, pause=args.pause)
+    if args.command == 'once':
+        run_once(**options)
+    else:
+        RetentionJob(args.interval, **options)._run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+検知のスコアを NumPy で複数の傾斜センサのグループについてまとめて求める
+detector_v1.alpha, detect_by_algo と同じ順に計算するので，結果はビット単位で同じ
+"""
+
+import numpy as np
+
+
+class Snapshot(object):
+    """
+    複数の傾斜センサのグループの最新データの配列
+    傾斜の配列はセンサごと，group はセンサが属するグループの番号．
+    グループの配列はグループごとで，size は合計を割るセンサの数
+    """
+
+    def __init__(self, keys, tilt_x, tilt_y, diff_x, diff_y, group, size,
+                 moisture, moisture_diff, moisture_min):
+        self.keys = keys
+        self.tilt_x = np.asarray(tilt_x, dtype=np.float64)
+        self.tilt_y = np.asarray(tilt_y, dtype=np.float64)
+        self.diff_x = np.asarray(diff_x, dtype=np.float64)
+        self.diff_y = np.asarray(diff_y, dtype=np.float64)
+        self.group = np.asarray(group, dtype=np.intp)
+        self.size = np.asarray(size, dtype=np.float64)
+        self.moisture = np.asarray(moisture, dtype=np.float64)
+        self.moisture_diff = np.asarray(moisture_diff, dtype=np.float64)
+        self.moisture_min = np.asarray(moisture_min, dtype=np.float64)
+
+    @classmethod
+    def build(cls, groups):
+        """
+        groups: [(key, size, [(tilt_x, tilt_y, diff_x, diff_y), ...], (moisture, diff, min)), ...]
+        """
+        keys, size, moisture, moisture_diff, moisture_min = [], [], [], [], []
+        tilt_x, tilt_y, diff_x, diff_y, group = [], [], [], [], []
+        for i, (key, group_size, tilts, soil) in enumerate(groups):
+            keys.append(key)
+            size.append(group_size)
+            moisture.append(soil[0])
+            moisture_diff.append(soil[1])
+            moisture_min.append(soil[2])
+            for x, y, dx, dy in tilts:
+                tilt_x.append(x)
+                tilt_y.append(y)
+                diff_x.append(dx)
+                diff_y.append(dy)
+                group.append(i)
+        return cls(keys, tilt_x, tilt_y, diff_x, diff_y, group, size,
+                   moisture, moisture_diff, moisture_min)
+
+
+def sign(values):
+    return np.where(values >= 0.0, 1.0, -1.0)
+
+
+def alpha(snapshot, c=1.0, d=1.0):
+    alpha_x = 1.0 + c * np.abs(snapshot.tilt_x) * (1 + d * sign(snapshot.diff_x))
+    alpha_y = 1.0 + c * np.abs(snapshot.tilt_y) * (1 + d * sign(snapshot.diff_y))
+    return alpha_x, alpha_y, alpha_x * np.abs(snapshot.diff_x) + alpha_y * np.abs(snapshot.diff_y)
+
+
+def score(snapshot, c=1.0, d=1.0, b=1.0, delta=1.0):
+    """
+    各グループの alpha_x, alpha_y, s, a, y を計算する
+    """
+    alpha_x, alpha_y, alphas = alpha(snapshot, c, d)
+    s = np.zeros(len(snapshot.keys), dtype=np.float64)
+    # 足す順番をスカラー版と揃えるためセンサごとに順に加算する
+    np.add.at(s, snapshot.group, alphas / delta)
+    s /= np.maximum(snapshot.size, 1.0)
+    a = snapshot.moisture * (1 + b * sign(snapshot.moisture_diff) * (snapshot.moisture - snapshot.moisture_min)) / 100.0
+    y = np.abs(a * s)
+    return {'alpha_x': alpha_x, 'alpha_y': alpha_y, 'alpha': alphas, 's': s, 'a': a, 'y': y}
+
+
+def classify(y, alert_threshold, caution_threshold):
+    """
+    0: normal, 1: caution, 2: alert. しきい値はスカラーでもグループごとの配列でもよい
+    """
+    return np.where(y > alert_threshold, 2, np.where(y > caution_threshold, 1, 0))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+検知器のメモリ上の状態のスナップショット．起動時にキャッシュを履歴から作り直さずに読み込む
+"""
+
+import os
+import time
+import zlib
+import argparse
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from datetime import datetime
+from sqlalchemy import select, func
+
+import db
+import cache
+import logs
+
+logger = logs.get_logger(__name__, 'snapshot')
+
+VERSION = 1
+# Python 2 と 3 のどちらでも読める形式
+PICKLE_PROTOCOL = 2
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def data_tables():
+    return [db.TiltSensorData.__table__, db.SoilSensorData.__table__,
+            db.WeatherSensorData.__table__, db.Event.__table__]
+
+
+def high_water_marks(conn):
+    return dict((table.name, conn.execute(select([func.max(table.c.id)])).scalar() or 0)
+                for table in data_tables())
+
+
+def capture():
+    """
+    キャッシュの内容と，それがどの行まで反映しているか
+    """
+    # バッファに残っている行を書き込んでから最大のidを読む
+    db.write_buffer.flush()
+    with db.engine.connect() as conn:
+        marks = high_water_marks(conn)
+    return {
+        'version': VERSION,
+        'created_at': datetime.now(),
+        'db': repr(db.engine.url),
+        'marks': marks,
+        'readings': db.state_cache.snapshot(),
+        'moisture': db.moisture_stats.snapshot(),
+        'rainfall': db.rainfall_totals.snapshot(),
+        'events': db.event_states.snapshot(),
+    }
+
+
+def save(path):
+    """
+    スナップショットを書き，そのバイト数を返す
+    """
+    started = time.time()
+    data = zlib.compress(pickle.dumps(capture(), PICKLE_PROTOCOL))
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.rename(temporary, path)
+    logger.info("saved snapshot {0}: {1} bytes in {2:.3f}s".format(path, len(data), time.time() - started))
+    return len(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        state = pickle.loads(zlib.decompress(data))
+    except Exception as e:
+        raise SnapshotError("unreadable snapshot {0}: {1}".format(path, e))
+    if not isinstance(state, dict) or state.get('version') != VERSION:
+        raise SnapshotError("unsupported snapshot version in {0}".format(path))
+    return state
+
+
+def count_delta(conn, marks):
+    return sum(conn.execute(select([func.count()]).where(table.c.id > marks.get(table.name, 0))).scalar()
+               for table in data_tables())
+
+
+def restore(state):
+    db.state_cache.restore(state['readings'])
+    db.moisture_stats.restore(state['moisture'])
+    db.rainfall_totals.restore(state['rainfall'])
+    db.event_states.restore(state['events'])
+
+
+def rows_after(conn, table, marks):
+    return conn.execute(select([table]).where(table.c.id > marks.get(table.name, 0)).order_by(table.c.id))
+
+
+def apply_delta(conn, marks):
+    """
+    スナップショットの後に書かれた行をキャッシュに反映し，反映した行数を返す．
+    スナップショットにないセンサは最初に使うときにDBから読まれるので飛ばす
+    """
+    applied = 0
+    for row in rows_after(conn, db.TiltSensorData.__table__, marks):
+        sid = row.sensor_id
+        if not db.state_cache.has(cache.TILT, sid):
+            continue
+        if any(reading.observed_at == row.observed_at for reading in db.state_cache.history(cache.TILT, sid)):
+            continue
+        db.state_cache.push(cache.TILT, sid, [db.tilt_reading(row)])
+        applied += 1
+    for row in rows_after(conn, db.SoilSensorData.__table__, marks):
+        sid = row.sensor_id
+        if not db.state_cache.has(cache.SOIL, sid):
+            continue
+        if any(reading.data_get_at == row.data_get_at for reading in db.state_cache.history(cache.SOIL, sid)):
+            continue
+        db.state_cache.push(cache.SOIL, sid, [db.soil_reading(row)])
+        if db.moisture_stats.has(sid):
+            db.moisture_stats.add(sid, row.received_at, row.moisture)
+        applied += 1
+    for row in rows_after(conn, db.WeatherSensorData.__table__, marks):
+        if db.rainfall_totals.has(row.sensor_id):
+            db.rainfall_totals.replay(row.sensor_id, row.received_at, row.rainfall, row.rain_accumulation)
+            applied += 1
+    # イベントが書かれていたら現在のイベントはDBから読み直す
+    events = db.Event.__table__
+    if conn.execute(select([func.count()]).where(events.c.id > marks.get(events.name, 0))).scalar():
+        db.event_states.invalidate()
+    return applied
+
+
+def invalidate():
+    db.state_cache.invalidate()
+    db.moisture_stats.invalidate()
+    db.rainfall_totals.invalidate()
+    db.event_states.invalidate()
+
+
+def load(path, max_delta=10000):
+    """
+    スナップショットからキャッシュを作り，DBとの差分を反映する．使えなければ SnapshotError
+    """
+    state = read(path)
+    if state['db'] != repr(db.engine.url):
+        raise SnapshotError("snapshot {0} is for {1}".format(path, state['db']))
+    with db.engine.connect() as conn:
+        delta = count_delta(conn, state['marks'])
+        if delta > max_delta:
+            raise SnapshotError("{0} rows were written after snapshot {1}".format(delta, path))
+        restore(state)
+        try:
+            applied = apply_delta(conn, state['marks'])
+        except Exception:
+            invalidate()
+            raise
+    logger.info("loaded snapshot {0} of {1}, {2} newer rows applied".format(path, state['created_at'], applied))
+    return applied
+
+
+def warm_start(path, max_delta=10000):
+    """
+    起動時に呼ぶ．スナップショットが使えなければ今までどおりDBから読む
+    """
+    if not os.path.exists(path):
+        logger.info("no snapshot at {0}, starting cold".format(path))
+        return False
+    try:
+        load(path, max_delta)
+        return True
+    except Exception as e:
+        invalidate()
+        logger.warning("snapshot not used, starting cold: {0}".format(e))
+        return False
+
+
+class SnapshotJob(object):
+    """
+    interval 秒ごとと停止時にスナップショットを書く
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+    def save(self):
+        try:
+            save(self.path)
+        except Exception:
+            logger.exception("snapshot failed")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+
+
+def path_from_env():
+    return os.getenv('SSS_SNAPSHOT_PATH', '')
+
+
+def from_env():
+    """
+    SSS_SNAPSHOT_PATH が設定されていなければNone
+    """
+    path = path_from_env()
+    if not path:
+        return None
+    return SnapshotJob(path, float(os.getenv('SSS_SNAPSHOT_INTERVAL', '60')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='detector state snapshots')
+    parser.add_argument('command', choices=['save', 'load', 'info'])
+    parser.add_argument('--path', default=path_from_env() or './state/detector.snapshot')
+    parser.add_argument('--max-delta', type=int, default=int(os.getenv('SSS_SNAPSHOT_MAX_DELTA', '10000')))
+    args = parser.parse_args()
+
+    if args.command == 'save':
+        print("{0} bytes".format(save(args.path)))
+    elif args.command == 'load':
+        started = time.time()
+        applied = load(args.path, args.max_delta)
+        print("loaded in {0:.3f}s, {1} newer rows applied".format(time.time() - started, applied))
+    else:
+        state = read(args.path)
+        print("created at {0} for {1}".format(state['created_at'], state['db']))
+        print("marks: {0}".format(state['marks']))
+        print("{0} sensors, {1} moisture, {2} rainfall, {3} sites".format(
+            len(state['readings']['states']), len(state['moisture']), len(state['rainfall']), len(state['events'])))
+
+
+if __name__ == '__main__':
+    main()
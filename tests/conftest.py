@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+python -m pytest tests
+
+The modules are imported from the repository root. The tests use a
+throwaway SQLite database and log directory instead of MySQL and ./log.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix='sss-tests-')
+os.environ.setdefault('SSS_DB_URL', 'sqlite:///' + os.path.join(WORKDIR, 'test.db'))
+os.environ.setdefault('SSS_LOG_DIR', os.path.join(WORKDIR, 'log'))
+os.environ.setdefault('SSS_LOG_CONSOLE', '0')
+os.environ.setdefault('SSS_FB_HOST', 'https://127.0.0.1:1')
+
+
+class Dispatcher(object):
+    """
+    閾値テーブルの変更を送らずに記録する
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def submit(self, mac, val):
+        self.commands.append((mac, val))
+
+    def submit_batch(self, commands):
+        self.commands.extend(commands)
+
+
+def invalidate_caches():
+    import db
+    db.state_cache.invalidate()
+    db.sensor_features.invalidate()
+    db.event_states.invalidate()
+    db.moisture_stats.invalidate()
+    db.rainfall_totals.invalidate()
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """
+    db モジュールを空のインメモリSQLiteにつなぎ替える．書き込みはバッファにためずにすぐ行う
+    """
+    import db
+    import dedupe
+    import writer
+    engine = db.create_db_engine('sqlite://', count_queries=False)
+    monkeypatch.setattr(db, '_engine', engine)
+    monkeypatch.setattr(db, 'write_buffer', writer.WriteBehindBuffer(
+        db.engine, 100, 0, ignore_duplicates=(db.TiltSensorData.__table__, db.SoilSensorData.__table__)))
+    monkeypatch.setattr(db, 'recent_keys', dedupe.RecentKeys())
+    monkeypatch.setattr(db, 'table_dispatcher', Dispatcher())
+    monkeypatch.setattr(db.sensor_registry, '_sensors', None)
+    monkeypatch.setattr(db.sensor_registry, '_misses', {})
+    invalidate_caches()
+    db.create_table()
+    yield engine
+    db.Session.remove()
+    invalidate_caches()
+    engine.dispose()
+
+
+@pytest.fixture
+def held_writes(memory_db, monkeypatch):
+    """
+    memory_db の書き込みを flush を呼ぶまでバッファにためる
+    """
+    import db
+    import writer
+    buffer = writer.WriteBehindBuffer(db.engine, 100, 3600, ignore_duplicates=(
+        db.TiltSensorData.__table__, db.SoilSensorData.__table__))
+    monkeypatch.setattr(buffer, 'start', lambda: None)
+    monkeypatch.setattr(db, 'write_buffer', buffer)
+    return buffer
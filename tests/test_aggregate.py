@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+The running moisture minimum and the rainfall windows must give the same
+values as computing them again from the whole history.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import aggregate
+
+START = datetime(2017, 3, 1)
+
+
+def test_windowed_min_matches_a_full_scan():
+    rng = random.Random(0)
+    window = timedelta(days=2)
+    stats = aggregate.MoistureStats(window)
+    history = []
+    for i in range(500):
+        at = START + timedelta(hours=i)
+        moisture = rng.uniform(0, 100)
+        history.append((at, moisture))
+        stats.add(at, moisture)
+        assert stats.windowed_min() == min(m for t, m in history if t >= at - window)
+    assert stats.min == min(m for _, m in history)
+    assert stats.max == max(m for _, m in history)
+    assert stats.mean() == pytest.approx(sum(m for _, m in history) / len(history))
+
+
+def test_aggregate_loads_history_once_then_adds():
+    calls = []
+
+    def loader(sensor_id, window):
+        calls.append(sensor_id)
+        return 2, 30.0, 10.0, 20.0, [(START, 10.0), (START + timedelta(days=20), 20.0)]
+
+    moisture = aggregate.MoistureAggregate(loader, window_days=30)
+    assert moisture.min(1) == 10.0
+    moisture.add(1, START + timedelta(days=31), 15.0)
+    # START の 10.0 は窓から出た
+    assert moisture.min(1) == 15.0
+    assert moisture.stats(1).min == 10.0
+    assert moisture.stats(1).count == 3
+    assert calls == [1]
+
+
+def test_string_received_at_is_accepted():
+    moisture = aggregate.MoistureAggregate(lambda sensor_id, window: (0, 0.0, None, None, []), window_days=1)
+    moisture.add(1, '170301000000', 5.0)
+    moisture.add(1, '170303000000', 7.0)
+    assert moisture.min(1) == 7.0
+
+
+def test_rainfall_windows_match_a_full_scan():
+    rng = random.Random(1)
+    rain = aggregate.RainfallAggregate(lambda sensor_id, window: (None, []))
+    accumulation, history = 0.0, []
+    for i in range(300):
+        at = START + timedelta(minutes=10 * i)
+        if i == 150:
+            # 積算雨量がリセットされた
+            accumulation = 0.0
+        step = rng.choice([0.0, 0.0, 0.5, 2.0])
+        accumulation += step
+        rainfall = rain.add(1, at, accumulation)
+        history.append((at, rainfall))
+        for name, window in aggregate.RAIN_WINDOWS:
+            expected = sum(r for t, r in history if t > at - window)
+            assert rain.totals(1)[name] == pytest.approx(expected)
+    assert history[0][1] == 0.0
+
+
+def test_rainfall_snapshot_and_replay():
+    rain = aggregate.RainfallAggregate(lambda sensor_id, window: (1.0, [(START, 1.0)]))
+    rain.add(1, START + timedelta(minutes=30), 3.0)
+    restored = aggregate.RainfallAggregate(lambda sensor_id, window: (None, []))
+    restored.restore(rain.snapshot())
+    assert restored.totals(1) == rain.totals(1)
+    # スナップショットより古いデータは足さない
+    restored.replay(1, START, 5.0, 10.0)
+    restored.replay(1, START + timedelta(hours=2), 1.0, 4.0)
+    assert restored.totals(1)['1h'] == 1.0
+    assert restored.totals(1)['3h'] == 4.0
+    assert restored.add(1, START + timedelta(hours=3), 4.5) == 0.5
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Every synced row is archived once, in the column of its sensor, and
+`range` returns the rows of the given time range whether or not they
+arrived in time order.
+"""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import db
+import cache
+import archive
+
+TILT = '00:00:00:00:00:00:00:01'
+START = datetime(2017, 3, 1)
+
+
+@pytest.fixture
+def root():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory)
+
+
+def add_rows(sensor_id, hours, tilt_x=None):
+    db.engine.execute(db.TiltSensorData.__table__.insert(), [dict(
+        sensor_id=sensor_id, received_at=START + timedelta(hours=h), node_state=0, battery_voltage=3.3,
+        observed_at=h, tilt_x=float(h) if tilt_x is None else tilt_x, tilt_y=None, tempereture=20.0, table_id=8)
+        for h in hours])
+
+
+def test_sync_appends_each_row_once(memory_db, root):
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    sid = db.get_sensor('52660', TILT).id
+    add_rows(sid, range(10))
+    store = archive.Archive(root)
+    assert store.sync(memory_db, chunk_size=3)[cache.TILT] == 10
+    add_rows(sid, range(10, 15))
+    assert store.sync(memory_db)[cache.TILT] == 5
+    assert store.sync(memory_db)[cache.TILT] == 0
+
+    series = store.series(cache.TILT, sid)
+    assert len(series) == 15
+    assert series.meta['mac'] == TILT.upper()
+    assert list(series['observed_at']) == list(range(15))
+    # NULL の浮動小数点は NaN
+    assert np.isnan(series['tilt_y']).all()
+    columns = series.range(START + timedelta(hours=3), START + timedelta(hours=6))
+    assert list(columns['tilt_x']) == [3.0, 4.0, 5.0]
+    assert isinstance(columns['tilt_x'], np.memmap)
+    assert store.sensors(cache.TILT) == [sid]
+
+
+def test_late_rows_are_found_by_mask(memory_db, root):
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    sid = db.get_sensor('52660', TILT).id
+    add_rows(sid, [0, 1, 5, 6])
+    store = archive.Archive(root)
+    store.sync(memory_db)
+    # 遅れて届いた行
+    add_rows(sid, [2, 3])
+    store.sync(memory_db)
+    series = store.series(cache.TILT, sid)
+    assert not series.meta['ordered']
+    columns = series.range(START + timedelta(hours=1), START + timedelta(hours=4))
+    assert sorted(columns['observed_at']) == [1, 2, 3]
+
+
+def test_interrupted_append_is_overwritten(root):
+    store = archive.Archive(root)
+
+    class Row(object):
+
+        def __init__(self, id, hour):
+            self.id = id
+            self.received_at = START + timedelta(hours=hour)
+            self.data_get_at = '17030100000{0}'.format(hour)
+            self.moisture = float(hour)
+            self.tempereture = None
+            self.ec = 0.0
+
+    store.append(cache.SOIL, 1, [Row(1, 0), Row(2, 1)])
+    # meta.json を書く前に止まった append の残り
+    with open(os.path.join(store.sensor_path(cache.SOIL, 1), 'moisture'), 'ab') as f:
+        f.write(np.array([99.0]).tobytes())
+    store.append(cache.SOIL, 1, [Row(2, 1), Row(3, 2)])
+    series = store.series(cache.SOIL, 1)
+    assert list(series['moisture']) == [0.0, 1.0, 2.0]
+    assert list(series['data_get_at']) == [b'170301000000', b'170301000001', b'170301000002']
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+The direct benchmark detects every frame in its own unit of work, so a
+frame that fails leaves nothing to write behind.
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select, func
+
+import db
+import payload
+import benchmark
+import detector_runner
+import detector_v1 as detector
+from topology import Topology
+
+AT = datetime(2017, 1, 1)
+
+
+@pytest.fixture
+def site(held_writes, monkeypatch):
+    topology = Topology.from_dict(benchmark.topology(1, 2))
+    monkeypatch.setattr(detector, 'site_topology', topology)
+    for each in topology:
+        for group, macs in each.groups.items():
+            db.sensor_registry.define_group(each.group_key(group), payload.TILT_PORT, macs)
+    for k in range(2):
+        db.add_tilt_sensor('bench', benchmark.tilt_mac(0, k), 1000)
+    db.add_soil_sensor('bench', benchmark.soil_mac(0), 1000)
+    db.sensor_registry.reload()
+
+
+def message(data):
+    return 'tilt', benchmark.Message('sensor/data', data)
+
+
+def count(model):
+    return db.engine.execute(select([func.count()]).select_from(model.__table__)).scalar()
+
+
+def test_frames_are_committed_per_unit_of_work(site):
+    workload = [message(benchmark.soil_payload(benchmark.soil_mac(0), AT))]
+    frames = [benchmark.tilt_payload(benchmark.tilt_mac(0, k), AT) for k in range(2)]
+    workload.append(message(payload.pack([payload.parse(data)[0] for data in frames])))
+    elapsed, stages = benchmark.run_direct(None, db, detector_runner, workload)
+    assert stages['unit_of_work']['count'] == 3
+    assert stages['detect']['count'] == 3
+    assert (count(db.SoilSensorData), count(db.TiltSensorData)) == (1, 2)
+
+
+def test_failed_frame_is_rolled_back(site, monkeypatch):
+    benchmark.run_direct(None, db, detector_runner, [message(benchmark.soil_payload(benchmark.soil_mac(0), AT))])
+
+    def fail(*args):
+        raise RuntimeError("detection failed")
+
+    monkeypatch.setattr(detector, 'detect_by_algo', fail)
+    with pytest.raises(RuntimeError):
+        benchmark.run_direct(None, db, detector_runner, [message(benchmark.tilt_payload(benchmark.tilt_mac(0, 0), AT))])
+    assert db.write_buffer.pending(db.TiltSensorData.__table__) == []
+    db.write_buffer.flush()
+    assert count(db.TiltSensorData) == 0
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+The state cache reads a sensor from the database once and then answers
+from the readings pushed to it, including the ones not written yet.
+"""
+
+from datetime import datetime
+
+import cache
+from cache import TILT, SOIL, TiltReading, SoilReading
+
+AT = datetime(2017, 3, 2, 18, 53, 39)
+
+
+def tilt(x, y=0.0):
+    return TiltReading(AT, 0, 3.3, 1, x, y, 20.0, 8)
+
+
+class Loader(object):
+
+    def __init__(self, readings):
+        self.readings = readings
+        self.calls = []
+
+    def __call__(self, kind, sensor_id, limit):
+        self.calls.append((kind, sensor_id, limit))
+        return self.readings.get((kind, sensor_id), [])[-limit:]
+
+
+def test_loads_each_sensor_once():
+    loader = Loader({(TILT, 1): [tilt(1.0), tilt(2.0), tilt(4.0, 1.0)]})
+    states = cache.SensorStateCache(2, loader)
+    assert states.latest(TILT, 1).tilt_x == 4.0
+    assert states.latest_diff(TILT, 1) == (2.0, 1.0)
+    assert [reading.tilt_x for reading in states.history(TILT, 1)] == [2.0, 4.0]
+    assert states.latest(SOIL, 1) is None
+    assert states.latest_diff(SOIL, 1) == 0.0
+    states.latest(TILT, 1)
+    assert loader.calls == [(TILT, 1, 2), (SOIL, 1, 2)]
+
+
+def test_pushed_readings_are_read_without_the_loader():
+    loader = Loader({})
+    states = cache.SensorStateCache(3, loader)
+    states.push(TILT, 1, [tilt(1.0), tilt(1.5)])
+    states.push(TILT, 1, [tilt(3.0)])
+    assert states.latest(TILT, 1).tilt_x == 3.0
+    assert states.latest_diff(TILT, 1) == (1.5, 0.0)
+    assert len(loader.calls) == 1
+
+
+def test_discard_removes_only_the_given_readings():
+    states = cache.SensorStateCache(4, Loader({}))
+    kept, dropped = SoilReading(AT, '170302185339', 20.0, 10.0, 0.0), SoilReading(AT, '170302185340', 20.0, 30.0, 0.0)
+    states.push(SOIL, 1, [kept])
+    states.push(SOIL, 1, [dropped])
+    assert states.latest_diff(SOIL, 1) == 20.0
+    states.discard(SOIL, 1, [dropped])
+    assert states.history(SOIL, 1) == [kept]
+    assert states.latest_diff(SOIL, 1) == 0.0
+
+
+def test_snapshot_restores_readings_and_hysteresis():
+    states = cache.SensorStateCache(2, Loader({}))
+    states.push(TILT, 1, [tilt(1.0), tilt(2.0)])
+    states.set_hysteresis_at(1, AT)
+    restored = cache.SensorStateCache(2, Loader({}))
+    restored.restore(states.snapshot())
+    assert restored.has(TILT, 1)
+    assert restored.history(TILT, 1) == states.history(TILT, 1)
+    assert restored.latest_diff(TILT, 1) == (1.0, 0.0)
+    assert restored.hysteresis_at(1) == AT
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Several cluster nodes behind LocalBroker, each running the real
+detector_runner.process on one in-memory SQLite database: every site must be
+detected by one node only, and a forwarded frame must not be detected twice.
+"""
+
+import time
+from collections import OrderedDict, Counter
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pytest
+
+import db
+import payload
+import cluster
+import detector_runner
+import detector_v1 as detector
+from topology import Site, Topology
+
+NODES = 3
+SITES = 6
+TILTS = 4
+
+
+def make_topology():
+    demo = cluster.demo_topology(SITES, TILTS)
+    return Topology([Site(site.name, site.groups, soil_mac=site.soil_mac,
+                          alert_threshold=50.0, caution_threshold=10.0) for site in demo])
+
+
+@pytest.fixture
+def site_topology(memory_db, monkeypatch):
+    topology = make_topology()
+    monkeypatch.setattr(detector, 'site_topology', topology)
+    for site in topology:
+        for group, macs in site.groups.items():
+            db.sensor_registry.define_group(site.group_key(group), payload.TILT_PORT, macs)
+            for mac in macs:
+                db.add_tilt_sensor('tilt sensor', mac, 10)
+        db.add_soil_sensor('soil sensor', site.soil_mac, 50)
+    db.sensor_registry.reload()
+    return topology
+
+
+def soil_payload(mac, i):
+    return ','.join(['52652', mac, '170301000000', '4002', '1001', '14',
+                     '000101{0:06d}'.format(i), '0003', '-5.45', '20.0', '0'])
+
+
+def frame_key(frame):
+    if frame.port == payload.SOIL_PORT:
+        return frame.mac, frame.data_get_at
+    return frame.mac, frame.observations[0].observed_at
+
+
+def test_each_site_is_detected_by_one_node(site_topology, monkeypatch):
+    broker = cluster.LocalBroker()
+    gateway = broker.client('gateway')
+    clients = [broker.client('detector-{0}'.format(i)) for i in range(NODES)]
+    nodes = [cluster.Node(i, NODES, site_topology, publish=clients[i].publish) for i in range(NODES)]
+    broker.start()
+    for node, client in zip(nodes, clients):
+        for topic in node.topics():
+            client.subscribe(topic)
+
+    # どのノードがどのフレームを検知したか
+    detected = []
+    detect = detector.detect
+
+    def recording_detect(frame):
+        detected.append((detector_runner.cluster_node.index, frame_key(frame)))
+        return detect(frame)
+
+    monkeypatch.setattr(detector, 'detect', recording_detect)
+
+    events, forwarded = [], Counter()
+
+    def run(workload):
+        for _, data in workload:
+            gateway.publish(cluster.DATA_TOPIC, data)
+        idle = 0
+        # 転送されたフレームが届かなくなるまで各ノードのメッセージを処理する
+        while idle < 5:
+            idle += 1
+            for node, client in zip(nodes, clients):
+                try:
+                    topic, data = client.outbox.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                idle = 0
+                if topic == node.topic:
+                    forwarded[node.index] += 1
+                monkeypatch.setattr(detector_runner, 'cluster_node', node)
+                for event in detector_runner.process(cluster.Message(topic, data)) or []:
+                    events.append((node.index, event))
+        return sum(count for count, _ in workload)
+
+    try:
+        while broker.subscribed() < NODES * 2:
+            time.sleep(0.01)
+        # 土中水分のデータがないと傾斜センサのデータを評価できないので先に送る
+        expected = run([(1, soil_payload(site.soil_mac, i)) for i, site in enumerate(site_topology)])
+        expected += run(list(cluster.demo_messages(site_topology, 200, seed=1)))
+    finally:
+        broker.stop()
+
+    # 持ち主でないノードに届いたフレームは転送され，転送先で1回だけ検知された
+    assert sum(forwarded.values()) > 0
+    keys = Counter(key for _, key in detected)
+    assert len(detected) == expected
+    assert all(count == 1 for count in keys.values())
+
+    owners = OrderedDict()
+    for index, event in events:
+        if 'site' in event:
+            owners.setdefault(event['site'], set()).add(index)
+    assert sorted(owners) == sorted(site.name for site in site_topology)
+    for site in site_topology:
+        assert owners[site.name] == set([cluster.owner(site.name, NODES)])
+    # 各ノードは自分のサイトのフレームだけを検知した
+    for index, (mac, _) in detected:
+        site, _ = site_topology.locate(mac)
+        assert nodes[index].owns(site)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Duplicate observations are dropped by the recent keys, by the readings in
+the state cache and, for what is left, by the unique keys of the database.
+A frame whose unit of work fails is not a duplicate when it is redelivered.
+"""
+
+from collections import OrderedDict
+
+import pytest
+from sqlalchemy import select, func
+
+import db
+import cache
+import dedupe
+import metrics
+import payload
+import detector_v1 as detector
+from topology import Site, Topology
+
+TILT = '00:00:00:00:00:00:00:01'
+SOIL = '00:00:00:00:00:00:01:00'
+
+
+def tilt_frame(*observed_at):
+    fields = ['52660', TILT, '170302185339', TILT.replace(':', ''), '00', '3.3', str(len(observed_at))]
+    for at in observed_at:
+        fields.extend([str(at), '0.1', '0.2', '20', '8'])
+    return payload.parse_fields(fields)
+
+
+def count(engine, model):
+    return engine.execute(select([func.count()]).select_from(model.__table__)).scalar()
+
+
+def test_recent_keys_are_bounded():
+    keys = dedupe.RecentKeys(size=2)
+    assert not keys.seen('a')
+    assert keys.seen('a')
+    assert not keys.seen('b')
+    assert not keys.seen('c')
+    # 'a' が一番古いので押し出された
+    assert len(keys) == 2
+    assert not keys.seen('a')
+    keys.forget('a')
+    assert not keys.seen('a')
+
+
+@pytest.fixture
+def sensor(memory_db, monkeypatch):
+    site = Site('site0', OrderedDict([('A', [TILT])]), soil_mac=SOIL, alert_threshold=50.0, caution_threshold=10.0)
+    monkeypatch.setattr(detector, 'site_topology', Topology([site]))
+    db.sensor_registry.define_group(site.group_key('A'), payload.TILT_PORT, [TILT])
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    return db.get_sensor(payload.TILT_PORT, TILT)
+
+
+def test_repeated_observations_are_removed(sensor):
+    db.add_tilt_data(sensor.id, tilt_frame(1, 2))
+    frame = db.remove_duplicates(sensor.id, tilt_frame(2, 3))
+    assert [o.observed_at for o in frame.observations] == [3]
+    assert db.remove_duplicates(sensor.id, tilt_frame(1, 2)) is None
+
+
+def test_cached_readings_are_duplicates(sensor, monkeypatch):
+    # 再起動した後のように，最近のキーは空でキャッシュはDBから読む
+    db.add_tilt_data(sensor.id, tilt_frame(1))
+    monkeypatch.setattr(db, 'recent_keys', dedupe.RecentKeys())
+    db.state_cache.invalidate()
+    assert db.remove_duplicates(sensor.id, tilt_frame(1)) is None
+
+
+def test_database_ignores_duplicate_rows(sensor, memory_db):
+    before = metrics.duplicates.value(('db',))
+    db.add_tilt_data(sensor.id, tilt_frame(1))
+    db.add_tilt_data(sensor.id, tilt_frame(1, 2))
+    db.write_buffer.flush()
+    assert count(memory_db, db.TiltSensorData) == 2
+    assert metrics.duplicates.value(('db',)) - before == 1
+
+
+def test_failed_frame_is_detected_when_redelivered(sensor, held_writes):
+    # 土中水分センサが登録されていないので検知は失敗する
+    with pytest.raises(AttributeError):
+        with db.unit_of_work():
+            detector.detect(tilt_frame(1))
+    assert db.remove_duplicates(sensor.id, tilt_frame(1)) is not None
+
+
+def test_written_frame_stays_a_duplicate(sensor):
+    # すぐに書き込まれたデータは取り消せないので，再送されても重複
+    with pytest.raises(AttributeError):
+        with db.unit_of_work():
+            detector.detect(tilt_frame(1))
+    assert db.remove_duplicates(sensor.id, tilt_frame(1)) is None
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Only 2xx responses count as sent; only 5xx and connection errors are retried.
+"""
+
+import pytest
+import requests
+
+import dispatcher
+
+
+class Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Gateway(object):
+    """
+    決めた順にレスポンスを返す (例外なら投げる)
+    """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.posts = 0
+
+    def post(self, url, data, **kwargs):
+        self.posts += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return Response(result)
+
+
+def make(*results):
+    tables = dispatcher.TableDispatcher('https://gateway', None, retries=2, backoff=0)
+    tables.http = Gateway(*results)
+    return tables
+
+
+def test_2xx_is_sent():
+    tables = make(204)
+    assert tables._send([('AA', 1), ('BB', 1)])
+    assert (tables.sent, tables.failed, tables.http.posts) == (2, 0, 1)
+
+
+@pytest.mark.parametrize('status', [302, 400, 404])
+def test_other_statuses_fail_without_retry(status):
+    tables = make(status)
+    assert not tables._send([('AA', 1)])
+    assert (tables.sent, tables.failed, tables.http.posts) == (0, 1, 1)
+
+
+def test_5xx_and_connection_errors_are_retried():
+    tables = make(503, requests.exceptions.ConnectionError('refused'), 200)
+    assert tables._send([('AA', 1)])
+    assert (tables.sent, tables.failed, tables.http.posts) == (1, 0, 3)
+
+
+def test_retries_are_capped():
+    tables = make(500, 502, requests.exceptions.Timeout('slow'))
+    assert not tables._send([('AA', 1)])
+    assert (tables.sent, tables.failed, tables.http.posts) == (0, 1, 3)
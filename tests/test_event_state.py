@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+The event state machine reads a site from the database once, reports only
+transitions, and summarizes the y values in between into samples.
+"""
+
+from datetime import datetime, timedelta
+
+import event_state
+
+START = datetime(2017, 3, 1, 12, 0)
+
+
+class Recorder(object):
+
+    def __init__(self, stored=None, sample_interval=60.0):
+        self.loads = []
+        self.transitions = []
+        self.samples = []
+        self.stored = stored or {}
+        self.machine = event_state.EventStateMachine(self.load, self.transition, self.sample, sample_interval)
+
+    def load(self, site):
+        self.loads.append(site)
+        return self.stored.get(site)
+
+    def transition(self, site, previous, state, y, at):
+        self.transitions.append((site, previous, state, y))
+
+    def sample(self, site, sample):
+        self.samples.append((site, sample))
+
+
+def at(seconds):
+    return START + timedelta(seconds=seconds)
+
+
+def test_only_transitions_are_reported():
+    recorder = Recorder({'site0': 'normal'})
+    machine = recorder.machine
+    assert not machine.update('site0', 'normal', 1.0, at(0))
+    assert machine.update('site0', 'caution', 12.0, at(10))
+    assert not machine.update('site0', 'caution', 13.0, at(20))
+    assert machine.update('site0', 'alert', 60.0, at(30))
+    assert machine.current('site0') == 'alert'
+    assert recorder.transitions == [('site0', 'normal', 'caution', 12.0), ('site0', 'caution', 'alert', 60.0)]
+    assert recorder.loads == ['site0']
+
+
+def test_a_site_without_history_starts_with_a_transition():
+    recorder = Recorder()
+    assert recorder.machine.update('site1', 'normal', 0.0, at(0))
+    assert recorder.transitions == [('site1', None, 'normal', 0.0)]
+
+
+def test_y_is_summarized_per_interval():
+    recorder = Recorder({'site0': 'normal'})
+    machine = recorder.machine
+    for i, y in enumerate([1.0, 3.0, -1, 2.0]):
+        machine.update('site0', 'normal', y, at(20 * i))
+    # 60秒たったので1つにまとめた．警戒の y = -1 は数えない
+    (site, sample), = recorder.samples
+    assert site == 'site0'
+    assert (sample['count'], sample['y_min'], sample['y_max'], sample['y_mean'], sample['y_last']) == \
+        (3, 1.0, 3.0, 2.0, 2.0)
+    assert (sample['started_at'], sample['ended_at']) == (at(0), at(60))
+    machine.update('site0', 'normal', 5.0, at(70))
+    # イベントが変わると，それまでの y を書き出す
+    machine.update('site0', 'caution', 15.0, at(80))
+    assert recorder.samples[-1][1]['count'] == 1
+    assert recorder.samples[-1][1]['state'] == 'normal'
+    machine.update('site0', 'caution', 16.0, at(90))
+    machine.flush()
+    assert recorder.samples[-1][1]['y_last'] == 16.0
+    assert recorder.samples[-1][1]['state'] == 'caution'
+
+
+def test_no_samples_without_interval():
+    recorder = Recorder({'site0': 'normal'}, sample_interval=0)
+    for i in range(10):
+        recorder.machine.update('site0', 'normal', 1.0, at(60 * i))
+    recorder.machine.flush()
+    assert recorder.samples == []
+
+
+def test_snapshot_restores_the_current_events():
+    recorder = Recorder()
+    recorder.machine.update('site0', 'alert', 60.0, at(0))
+    restored = Recorder()
+    restored.machine.restore(recorder.machine.snapshot())
+    assert not restored.machine.update('site0', 'alert', 61.0, at(10))
+    assert restored.loads == []
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+The threshold table ladder 0 -> 4 -> 5 -> 8 -> 9 of the feedback controller.
+"""
+
+import feedback
+
+
+def test_stricter_sensor_moves_looser():
+    assert [feedback.next_table(table_id, 2, 0) for table_id in (0, 4, 5, 8, 9)] == [4, 5, 8, 9, None]
+
+
+def test_looser_sensor_moves_stricter():
+    assert [feedback.next_table(table_id, 0, 2) for table_id in (0, 4, 5, 8, 9)] == [None, 0, 4, 5, 8]
+
+
+def test_agreeing_sensor_stays():
+    assert feedback.next_table(5, 1, 1) is None
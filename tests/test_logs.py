@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Sampled records that the filter leaves out must never be formatted.
+"""
+
+import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logs
+
+
+class Frame(object):
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'frame'
+
+
+def test_sampled_records_are_formatted_only_when_written():
+    records = queue.Queue()
+    handler = logs.QueueHandler(records)
+    handler.addFilter(logs.SamplingFilter(10))
+    logger = logging.getLogger('tests.sampled')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    frame = Frame()
+    try:
+        for _ in range(100):
+            logger.info("received %s", frame, extra=logs.sampled())
+    finally:
+        logger.removeHandler(handler)
+    assert records.qsize() == 10
+    assert frame.formatted == 10
+    assert records.get_nowait().msg == 'received frame'
+
+
+def test_lazy_values_are_computed_only_when_written():
+    records = queue.Queue()
+    handler = logs.QueueHandler(records)
+    handler.addFilter(logs.SamplingFilter(10))
+    logger = logging.getLogger('tests.lazy')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    calls = []
+    try:
+        for i in range(100):
+            logger.info("y", extra=logs.sampled(y=i, rise=logs.Lazy(lambda: calls.append(1) or 0.5)))
+    finally:
+        logger.removeHandler(handler)
+    assert len(calls) == 10
+    assert records.get_nowait().fields == {'y': 0, 'rise': 0.5}
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics are rendered in the Prometheus text format and served over HTTP,
+and the queries of a message are counted per thread.
+"""
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+import pytest
+
+import db
+import metrics
+
+
+@pytest.fixture
+def registry():
+    registry = metrics.Registry()
+    frames = registry.counter('test_frames_total', 'Frames.', ['port'])
+    depth = registry.gauge('test_depth', 'Depth.')
+    seconds = registry.histogram('test_seconds', 'Seconds.', buckets=(0.1, 1))
+    frames.inc(labels=('52660',))
+    frames.inc(2, ('0',))
+    depth.set_function(lambda: 7)
+    for value in (0.05, 0.5, 5):
+        seconds.observe(value)
+    return registry
+
+
+def test_render(registry):
+    lines = registry.render().splitlines()
+    assert '# TYPE test_frames_total counter' in lines
+    assert 'test_frames_total{port="0"} 2.0' in lines
+    assert 'test_frames_total{port="52660"} 1.0' in lines
+    assert 'test_depth 7.0' in lines
+    assert [line for line in lines if line.startswith('test_seconds_bucket')] == [
+        'test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1.0"} 2', 'test_seconds_bucket{le="+Inf"} 3']
+    assert 'test_seconds_count 3' in lines
+    registry.reset()
+    assert registry.get('test_seconds').count() == 0
+
+
+def test_label_count_is_checked(registry):
+    with pytest.raises(ValueError):
+        registry.get('test_frames_total').inc(labels=('52660', 'extra'))
+
+
+def test_serve(registry):
+    server = metrics.serve(0, registry=registry)
+    try:
+        body = urlopen('http://127.0.0.1:{0}/metrics'.format(server.server_address[1])).read().decode('utf-8')
+    finally:
+        server.shutdown()
+    assert 'test_depth 7.0' in body.splitlines()
+
+
+def test_queries_are_counted_per_message():
+    engine = db.create_db_engine('sqlite://', count_queries=True)
+    count = metrics.db_queries_per_message.count()
+    total = metrics.db_queries_per_message.sum()
+    metrics.start_message()
+    engine.execute('SELECT 1')
+    engine.execute('SELECT 2')
+    metrics.finish_message()
+    engine.dispose()
+    assert metrics.db_queries_per_message.count() == count + 1
+    assert metrics.db_queries_per_message.sum() == total + 2
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Migrations on a database made by an older version, and the duplicates that
+block the unique indexes.
+"""
+
+import pytest
+from sqlalchemy import inspect
+
+import db
+import migrate
+
+# user-015 より前のDB (events.site もインデックスもない)
+LEGACY = [
+    'CREATE TABLE events (id INTEGER PRIMARY KEY, state INTEGER, y FLOAT, created_at DATETIME)',
+    'CREATE TABLE tilt_sensors (id INTEGER PRIMARY KEY, name VARCHAR(32), mac VARCHAR(32), threshold FLOAT, '
+    'hysteresis_at DATETIME)',
+    'CREATE TABLE tilt_sensor_data (id INTEGER PRIMARY KEY, sensor_id INTEGER, received_at DATETIME, '
+    'node_state INTEGER, battery_voltage FLOAT, observed_at BIGINT, tilt_x FLOAT, tilt_y FLOAT, '
+    'tempereture FLOAT, table_id INTEGER)',
+]
+
+
+@pytest.fixture
+def legacy_db(memory_db):
+    db.drop_table()
+    for statement in LEGACY:
+        memory_db.execute(statement)
+    return memory_db
+
+
+def tables(engine):
+    return set(inspect(engine).get_table_names())
+
+
+def test_fresh_database_gets_every_version(memory_db):
+    db.drop_table()
+    assert migrate.upgrade('default') == [number for number, _, _ in migrate.MIGRATIONS]
+    assert migrate.upgrade('default') == []
+
+
+def test_numbered_migrations_create_only_their_tables(legacy_db):
+    migrate.upgrade('default', to=2)
+    created = tables(legacy_db)
+    assert 'soil_sensor_data' in created
+    assert 'weather_sensor_data' not in created
+    assert 'replication_state' not in created
+    migrate.upgrade('default', to=7)
+    assert 'weather_sensor_data' in tables(legacy_db)
+    assert 'replication_state' not in tables(legacy_db)
+    migrate.upgrade('default')
+    assert 'replication_state' in tables(legacy_db)
+    columns = [column['name'] for column in inspect(legacy_db).get_columns('events')]
+    assert 'site' in columns
+
+
+def test_duplicates_block_only_their_migration(legacy_db):
+    rows = [(1, 1, 100), (2, 1, 100), (3, 1, 101)]
+    for row in rows:
+        legacy_db.execute('INSERT INTO tilt_sensor_data (id, sensor_id, observed_at) VALUES (?, ?, ?)', row)
+    with pytest.raises(migrate.MigrationError):
+        migrate.upgrade('default')
+    applied = migrate.upgrade('default', strict=False)
+    assert 5 not in applied and 8 in applied
+    assert migrate.dedupe(apply=True)['tilt_sensor_data'] == 1
+    assert migrate.upgrade('default') == [5]
+    ids = [row[0] for row in legacy_db.execute('SELECT id FROM tilt_sensor_data ORDER BY id')]
+    assert ids == [1, 3]
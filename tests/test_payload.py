@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+A $WIXDR sentence carries the V, Z and R of rain and then of hail; the
+weather frame must keep the rain values. Frames must survive the binary
+format with their 6 or 8 byte MAC.
+"""
+
+import pytest
+
+import payload
+
+SENTENCE = ('0,00:11:22:33:44:55,170302185339,$WIXDR,'
+            'V,12.50,M,1,Z,30,s,1,R,4.2,M,1,'
+            'V,0.0,M,2,Z,0,s,2,R,0.0,M,2,'
+            'C,11.3,C,2,U,12.1,N,2')
+
+
+def test_weather_keeps_rain_measurements():
+    frame, = payload.parse(SENTENCE)
+    assert frame.port == payload.WEATHER_PORT
+    assert frame.mac == '00:11:22:33:44:55'
+    assert frame.sentence == '$WIXDR'
+    assert frame.measurements == {'V': 12.5, 'Z': 30.0, 'R': 4.2, 'C': 11.3, 'U': 12.1}
+
+
+def test_weather_survives_binary_round_trip():
+    frame, = payload.parse(SENTENCE)
+    packed, = payload.parse(payload.pack([frame]))
+    assert packed.mac == '00:11:22:33:44:55'
+    assert sorted(packed.measurements) == sorted(frame.measurements)
+    for kind, value in frame.measurements.items():
+        assert packed.measurements[kind] == pytest.approx(value, rel=1e-6)
+
+
+def test_weather_rejects_bad_hail_value():
+    with pytest.raises(payload.ParseError):
+        payload.parse(SENTENCE.replace('R,0.0,M,2', 'R,x,M,2'))
+
+
+TILT = '52660,00:00:00:00:00:00:00:0a,170302185339,000000000000000a,00,3.3,1,1488484419,0.1,0.2,20,8'
+
+
+def test_tilt_survives_binary_round_trip():
+    frame, = payload.parse(TILT)
+    packed, = payload.parse(payload.pack([frame]))
+    assert packed.mac == frame.mac == '00:00:00:00:00:00:00:0a'
+    assert packed.node_id == frame.node_id
+    assert packed.observations[0].observed_at == 1488484419
+
+
+def test_mixed_mac_lengths_in_one_payload():
+    frames = payload.parse(TILT) + payload.parse(SENTENCE)
+    data = payload.pack(frames)
+    assert [frame.mac for frame in payload.parse(data)] == [frame.mac for frame in frames]
+    assert payload.sensor_key(data) == b'\x00' * 7 + b'\x0a'
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The pipeline keeps the messages of one sensor in order, survives a failing
+handler and applies its policy when a worker queue is full.
+"""
+
+import threading
+from collections import namedtuple
+
+import pipeline
+
+Message = namedtuple('Message', ['topic', 'payload'])
+
+MACS = ['00:00:00:00:00:00:00:{0:02x}'.format(i) for i in range(8)]
+
+
+def message(mac, i):
+    return Message('sensor/data', '52660,{0},{1}'.format(mac, i))
+
+
+class Collector(object):
+
+    def __init__(self, expected):
+        self.events = []
+        self.expected = expected
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+            if len(self.events) == self.expected:
+                self.done.set()
+
+
+def test_messages_of_one_sensor_stay_in_order():
+    published = Collector(len(MACS) * 50)
+
+    def handler(msg):
+        _, mac, i = msg.payload.split(',')
+        return [(mac, int(i))]
+
+    pipe = pipeline.Pipeline(handler, published, workers=4).start()
+    for i in range(50):
+        for mac in MACS:
+            pipe.submit(message(mac, i))
+    assert published.done.wait(10)
+    for mac in MACS:
+        assert [i for m, i in published.events if m == mac] == list(range(50))
+    stats = pipe.stats()
+    assert (stats['received'], stats['dropped'], stats['failed']) == (len(MACS) * 50, 0, 0)
+    assert stats['latency']['detect']['count'] == len(MACS) * 50
+
+
+def test_failing_handler_does_not_stop_the_worker():
+    published = Collector(2)
+
+    def handler(msg):
+        if msg.payload.endswith(',1'):
+            raise ValueError('bad message')
+        return msg.payload
+
+    pipe = pipeline.Pipeline(handler, published).start()
+    for i in range(3):
+        pipe.submit(message(MACS[0], i))
+    assert published.done.wait(10)
+    assert published.events == [message(MACS[0], 0).payload, message(MACS[0], 2).payload]
+    assert pipe.stats()['failed'] == 1
+
+
+def test_full_queue_drops_by_policy():
+    # ワーカーを動かさないので，キューは2件で一杯になる
+    newest = pipeline.Pipeline(None, None, queue_size=2, policy=pipeline.DROP_NEWEST)
+    oldest = pipeline.Pipeline(None, None, queue_size=2, policy=pipeline.DROP_OLDEST)
+    for pipe in (newest, oldest):
+        assert [pipe.submit(message(MACS[0], i)) for i in range(3)] == [True, True, False]
+        assert pipe.stats()['dropped'] == 1
+    assert [msg.payload[-1] for _, msg in newest.queues[0].queue] == ['0', '1']
+    assert [msg.payload[-1] for _, msg in oldest.queues[0].queue] == ['1', '2']
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+A new tilt sensor is registered by its first frame and found by the next
+ones, whatever the case of its MAC.
+"""
+
+from sqlalchemy import select, func
+
+import db
+import payload
+import detector_v1 as detector
+from topology import Topology
+
+MAC = '00:1d:12:90:00:03:a5:13'
+
+
+def tilt_frame(observed_at):
+    return payload.parse_fields(['52660', MAC, '170302185339', MAC.replace(':', ''), '00', '3.3', '1',
+                                 str(observed_at), '0.1', '0.2', '20', '8'])
+
+
+def select_count(model):
+    return select([func.count()]).select_from(model.__table__)
+
+
+def test_new_lowercase_mac_is_found_after_registration(memory_db, monkeypatch):
+    monkeypatch.setattr(detector, 'site_topology', Topology([]))
+    with db.unit_of_work():
+        assert detector.detect(tilt_frame(1)) is None
+    sensor = db.get_sensor(payload.TILT_PORT, MAC)
+    assert sensor is not None
+    assert sensor.mac == MAC.upper()
+    with db.unit_of_work():
+        detector.detect(tilt_frame(2))
+    db.write_buffer.flush()
+    assert memory_db.execute(select_count(db.TiltSensor)).scalar() == 1
+    assert memory_db.execute(select_count(db.TiltSensorData)).scalar() == 1
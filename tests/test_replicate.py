@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Replication copies the new rows of the local database to the central one
+once each, with the sensor ids of the central database.
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+import db
+import replicate
+
+TILT = '00:00:00:00:00:00:00:01'
+OTHER = '00:00:00:00:00:00:00:02'
+AT = datetime(2017, 3, 2, 18, 53, 39)
+
+
+@pytest.fixture
+def central():
+    engine = db.create_db_engine('sqlite://', count_queries=False)
+    db.Base.metadata.create_all(bind=engine)
+    # 中央のDBには別のゲートウェイのセンサが先にある
+    engine.execute(db.TiltSensor.__table__.insert(), [dict(name='other', mac=OTHER, threshold=10)])
+    yield engine
+    engine.dispose()
+
+
+def add_rows(engine, sensor_id, observed_at):
+    engine.execute(db.TiltSensorData.__table__.insert(), [dict(
+        sensor_id=sensor_id, received_at=AT, node_state=0, battery_voltage=3.3, observed_at=i,
+        tilt_x=0.1 * i, tilt_y=0.2, tempereture=20.0, table_id=8) for i in observed_at])
+
+
+def tilt_rows(engine):
+    table = db.TiltSensorData.__table__
+    return [tuple(row) for row in engine.execute(select([table.c.sensor_id, table.c.observed_at])
+                                                 .order_by(table.c.observed_at))]
+
+
+def test_rows_are_sent_once_with_central_sensor_ids(memory_db, central):
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    local_id = db.get_sensor('52660', TILT).id
+    add_rows(memory_db, local_id, range(1, 6))
+    # 同じ観測が中央のDBに既にある
+    central.execute(db.TiltSensor.__table__.insert(), [dict(name='tilt sensor', mac=TILT, threshold=10)])
+    remote_id = central.execute(select([db.TiltSensor.__table__.c.id])
+                                .where(db.TiltSensor.__table__.c.mac == TILT)).scalar()
+    assert remote_id != local_id
+    add_rows(central, remote_id, [3])
+
+    replicator = replicate.Replicator(memory_db, central, 'gateway1', batch_size=2)
+    assert replicator.run_once()['tilt_sensor_data'] == 5
+    assert tilt_rows(central) == [(remote_id, i) for i in range(1, 6)]
+    assert replicator.lag(db.TiltSensorData.__table__) == 0
+
+    add_rows(memory_db, local_id, [6])
+    assert replicator.run_once()['tilt_sensor_data'] == 1
+    assert replicate.Replicator(memory_db, central, 'gateway1').run_once()['tilt_sensor_data'] == 0
+    assert tilt_rows(central)[-1] == (remote_id, 6)
+
+
+def test_missing_sensor_is_created_by_mac(memory_db, central):
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    add_rows(memory_db, db.get_sensor('52660', TILT).id, [1])
+    replicator = replicate.Replicator(memory_db, central, 'gateway1')
+    replicator.run_once()
+    sensors = db.TiltSensor.__table__
+    remote_id = central.execute(select([sensors.c.id]).where(sensors.c.mac == TILT)).scalar()
+    assert remote_id is not None
+    assert tilt_rows(central) == [(remote_id, 1)]
+    # 別の名前のゲートウェイは最初から送る
+    assert replicate.Replicator(memory_db, central, 'gateway2').lag(db.TiltSensorData.__table__) == 1
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Rows that arrive after their bucket was rolled up must still be counted,
+and raw rows must not be expired before the minute rollup has read them.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, func
+
+import db
+import retention
+from retention import TILT, MINUTE, HOUR, DAY
+
+START = datetime(2017, 3, 1, 10, 0)
+
+
+@pytest.fixture
+def sensor(memory_db):
+    db.add_tilt_sensor('tilt sensor', '00:00:00:00:00:00:00:01', 10)
+    return db.engine.execute(select([db.TiltSensor.__table__.c.id])).scalar()
+
+
+def add_rows(sid, rows):
+    db.engine.execute(TILT.raw.insert(), [dict(sensor_id=sid, received_at=at, observed_at=observed_at,
+                                               tilt_x=x, tilt_y=0.0, tempereture=20.0)
+                                          for observed_at, (at, x) in rows])
+
+
+def run(now):
+    for resolution in (MINUTE, HOUR, DAY):
+        retention.rollup(TILT, resolution, now=now)
+
+
+def bucket(resolution, at):
+    rollup = TILT.rollup
+    return db.engine.execute(select([rollup]).where(rollup.c.resolution == resolution)
+                             .where(rollup.c.bucket_at == at)).first()
+
+
+def test_late_row_is_merged_into_rolled_up_buckets(sensor):
+    add_rows(sensor, [(1, (START + timedelta(seconds=10), 1.0)), (2, (START + timedelta(seconds=20), 3.0))])
+    run(START + timedelta(days=2))
+    minute = bucket(MINUTE, START)
+    assert (minute.count, minute.tilt_x_mean, minute.tilt_x_last) == (2, 2.0, 3.0)
+    assert bucket(HOUR, START).count == 2
+    assert bucket(DAY, START.replace(hour=0)).count == 2
+
+    # 集計が済んだ分のバケットに遅れて届いた行
+    add_rows(sensor, [(3, (START + timedelta(seconds=30), 8.0))])
+    run(START + timedelta(days=2, minutes=10))
+    minute = bucket(MINUTE, START)
+    assert (minute.count, minute.tilt_x_min, minute.tilt_x_max, minute.tilt_x_mean) == (3, 1.0, 8.0, 4.0)
+    assert minute.tilt_x_last == 3.0
+    for resolution, at in ((HOUR, START), (DAY, START.replace(hour=0))):
+        row = bucket(resolution, at)
+        assert (row.count, row.tilt_x_max, row.tilt_x_mean) == (3, 8.0, 4.0)
+    # 次の回には足し直さない
+    run(START + timedelta(days=2, minutes=20))
+    assert bucket(MINUTE, START).count == 3
+
+
+def test_late_row_in_a_new_minute_makes_a_bucket(sensor):
+    add_rows(sensor, [(1, (START, 1.0))])
+    run(START + timedelta(hours=2))
+    add_rows(sensor, [(2, (START + timedelta(minutes=5), 2.0))])
+    run(START + timedelta(hours=2, minutes=10))
+    assert bucket(MINUTE, START + timedelta(minutes=5)).count == 1
+    assert bucket(HOUR, START).count == 2
+
+
+def test_unread_rows_are_not_expired(sensor):
+    add_rows(sensor, [(1, (START, 1.0)), (2, (START + timedelta(seconds=1), 1.0))])
+    now = START + timedelta(days=10)
+    run(now)
+    # 集計の後に届いた古い行は，次の集計が読むまで消さない
+    add_rows(sensor, [(3, (START + timedelta(seconds=2), 1.0))])
+    raw = TILT.raw
+    before, last_id = retention.raw_cutoff(TILT, 1, now)
+    retention.expire(raw, raw.c.received_at, before, max_id=last_id)
+    assert [row.observed_at for row in db.engine.execute(select([raw.c.observed_at]))] == [3]
+    run(now)
+    assert bucket(MINUTE, START).count == 3
+    before, last_id = retention.raw_cutoff(TILT, 1, now)
+    retention.expire(raw, raw.c.received_at, before, max_id=last_id)
+    assert db.engine.execute(select([func.count()]).select_from(raw)).scalar() == 0
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+A frame whose detection raises does not drop the other frames of its message.
+"""
+
+from datetime import datetime
+
+import payload
+import metrics
+import cluster
+import detector_runner
+import detector_v1 as detector
+
+
+def tilt_frame(mac):
+    return payload.TiltFrame(mac, datetime(2017, 3, 1), mac.replace(':', ''), 0, 3.3,
+                             [payload.TiltObservation(1, 0.1, 0.2, 20.0, 8)])
+
+
+def test_failing_frame_does_not_drop_the_batch(memory_db, monkeypatch):
+    macs = ['00:00:00:00:00:00:00:0{0}'.format(i) for i in range(3)]
+
+    def detect(frame):
+        if frame.mac == macs[1]:
+            raise RuntimeError("broken sensor")
+        return {'event': 0, 'changed': False, 'site': frame.mac}
+
+    monkeypatch.setattr(detector, 'detect', detect)
+    monkeypatch.setattr(detector_runner, 'cluster_node', None)
+    before = metrics.failed_frames.value((payload.TILT_PORT,))
+    events = detector_runner.process(cluster.Message('sensor/data', payload.pack([tilt_frame(mac) for mac in macs])))
+    assert [event['site'] for event in events] == [macs[0], macs[2]]
+    assert metrics.failed_frames.value((payload.TILT_PORT,)) - before == 1
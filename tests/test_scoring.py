@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+The NumPy batch evaluation must give exactly the same y and state as the
+scalar detection path.
+"""
+
+import random
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import cache
+import features
+import scoring
+import topology
+import detector_v1 as detector
+
+
+def tilt_reading(x, y):
+    return cache.TiltReading(None, 0, 3.3, 0, x, y, 20.0, 0)
+
+
+def random_groups(rng, count):
+    """
+    [(key, group_size, [(last, (diff_x, diff_y))], (moisture, diff, min))]．
+    センサが欠けているグループ，センサが1台もないグループ，group_size 1 を含む
+    """
+    groups = []
+    for i in range(count):
+        size = rng.choice([1, 1, 2, 3, 5, 8])
+        present = rng.randint(0, size)
+        tilts = [(tilt_reading(rng.uniform(-5, 5), rng.uniform(-5, 5)),
+                  (rng.choice([-1, 1]) * rng.uniform(0, 2), rng.choice([-1, 1]) * rng.uniform(0, 2)))
+                 for _ in range(present)]
+        moisture = rng.uniform(0, 60)
+        soil = (moisture, rng.choice([-1, 0, 1]) * rng.uniform(0, 3), moisture - rng.uniform(0, 20))
+        groups.append((i, size, tilts, soil))
+    # 差分が0ちょうどのセンサ (sign の境界)
+    groups.append((count, 1, [(tilt_reading(-1.5, 2.5), (0.0, -0.0))], (30.0, 0.0, 30.0)))
+    return groups
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_score_matches_scalar_path(seed):
+    rng = random.Random(seed)
+    groups = random_groups(rng, 200)
+    c, d, b, delta = rng.uniform(0.5, 2), rng.uniform(0.5, 2), rng.uniform(0.5, 2), rng.choice([1.0, 0.5, 3.0])
+    alert, caution = 30.0, 5.0
+
+    snapshot = scoring.Snapshot.build([
+        (key, size, [(last.tilt_x, last.tilt_y, dx, dy) for last, (dx, dy) in tilts], soil)
+        for key, size, tilts, soil in groups])
+    result = scoring.score(snapshot, c, d, b, delta)
+    states = scoring.classify(result['y'], alert, caution)
+
+    for i, (key, size, tilts, soil) in enumerate(groups):
+        s = detector.group_weight(tilts, size, c, d, delta)
+        a = detector.moisture_weight(soil[0], soil[1], soil[2], b)
+        y = abs(a * s)
+        assert result['s'][i] == s, key
+        assert result['a'][i] == a, key
+        assert result['y'][i] == y, key
+        assert states[i] == detector.classify(y, alert, caution), key
+
+
+class FakeTiltSensor(object):
+
+    def __init__(self, last, diff):
+        self.last = last
+        self.diff = diff
+
+    def latest_data(self):
+        return self.last
+
+    def latest_diff(self):
+        return self.diff
+
+
+class FakeSoilSensor(object):
+
+    def __init__(self, moisture, diff, min_moisture):
+        self.reading = cache.SoilReading(None, None, 20.0, moisture, 0.0)
+        self.diff = diff
+        self.min_moisture = min_moisture
+
+    def latest(self):
+        return self.reading
+
+    def latest_diff(self):
+        return self.diff
+
+    def min(self):
+        return self.min_moisture
+
+    def features(self):
+        return features.SoilFeatures(None, 0.0)
+
+
+def test_evaluate_all_matches_detect_by_algo(monkeypatch):
+    rng = random.Random(42)
+    sites, soils, members = [], {}, {}
+    for i in range(20):
+        groups = OrderedDict()
+        for g in range(rng.randint(1, 4)):
+            size = rng.choice([1, 2, 4])
+            macs = ['{0:02x}:{1:02x}:{2:02x}'.format(i, g, k) for k in range(size)]
+            groups['g{0}'.format(g)] = macs
+            # 一部のセンサはまだデータがない
+            members[(i, 'g{0}'.format(g))] = [
+                FakeTiltSensor(tilt_reading(rng.uniform(-5, 5), rng.uniform(-5, 5)),
+                               (rng.uniform(-2, 2), rng.uniform(-2, 2)))
+                if rng.random() < 0.8 else FakeTiltSensor(None, None)
+                for _ in macs]
+        soil_mac = 'soil{0}'.format(i)
+        moisture = rng.uniform(0, 60)
+        soils[soil_mac] = FakeSoilSensor(moisture, rng.uniform(-3, 3), moisture - rng.uniform(0, 20))
+        sites.append(topology.Site('site{0}'.format(i), groups, soil_mac=soil_mac,
+                                   alert_threshold=rng.uniform(5, 40), caution_threshold=rng.uniform(0.5, 5)))
+    site_topology = topology.Topology(sites)
+    index = dict((site.name, i) for i, site in enumerate(sites))
+
+    monkeypatch.setattr(detector, 'site_topology', site_topology)
+    monkeypatch.setattr(detector, 'group_sensors', lambda site, group: members[(index[site.name], group)])
+    monkeypatch.setattr(detector.db, 'get_sensor', lambda type_id, mac: soils.get(mac))
+
+    results = detector.evaluate_all(1.2, 0.8, 1.5, 1.0)
+    assert len(results) == sum(len(site.groups) for site in sites)
+    for result in results:
+        site = site_topology.sites[result['site']]
+        state, y = detector.detect_by_algo(site, result['sensor'], 1.2, 0.8, 1.5, 1.0)
+        assert result['y'] == y
+        assert result['event'] == state
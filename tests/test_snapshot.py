@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+A snapshot restores the caches as they were, plus the rows written after
+it, to the same state as rebuilding them from the database.
+"""
+
+import os
+import tempfile
+from collections import OrderedDict
+
+import pytest
+
+import db
+import cache
+import payload
+import snapshot
+import detector_v1 as detector
+from topology import Site, Topology
+
+TILT = '00:00:00:00:00:00:00:01'
+SOIL = '00:00:00:00:00:00:01:00'
+WEATHER = '00:11:22:33:44:55'
+
+
+def tilt_frame(observed_at, tilt_x=0.1):
+    return payload.parse_fields(['52660', TILT, '170302185339', TILT.replace(':', ''), '00', '3.3', '1',
+                                 str(observed_at), str(tilt_x), '0.2', '20', '8'])
+
+
+def soil_frame(data_get_at, moisture):
+    return payload.parse_fields(['52652', SOIL, '170302185339', '4002', '1001', '14',
+                                 '000101{0:06d}'.format(data_get_at), '0003', '-5.45', str(moisture), '0'])
+
+
+def weather_frame(received_at, accumulation):
+    return payload.parse_fields(['0', WEATHER, received_at, '$WIXDR', 'V', str(accumulation), 'M', '1',
+                                 'Z', '30', 's', '1', 'R', '4.2', 'M', '1'])
+
+
+def detect(frame):
+    with db.unit_of_work():
+        return detector.detect(frame)
+
+
+@pytest.fixture
+def site(memory_db, monkeypatch):
+    site = Site('site0', OrderedDict([('A', [TILT])]), soil_mac=SOIL, weather_mac=WEATHER,
+                alert_threshold=50.0, caution_threshold=10.0)
+    monkeypatch.setattr(detector, 'site_topology', Topology([site]))
+    db.sensor_registry.define_group(site.group_key('A'), payload.TILT_PORT, [TILT])
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    db.add_soil_sensor('soil sensor', SOIL, 50)
+    db.add_weather_sensor('weather sensor', WEATHER)
+    detect(soil_frame(1, 20.0))
+    detect(soil_frame(2, 15.0))
+    for i in range(1, 4):
+        detect(tilt_frame(i, 0.1 * i))
+    detect(weather_frame('170302180000', 1.0))
+    detect(weather_frame('170302183000', 3.5))
+    return site
+
+
+@pytest.fixture
+def path():
+    return os.path.join(tempfile.mkdtemp(), 'state', 'detector.snapshot')
+
+
+def state(tilt, soil, weather):
+    return (db.state_cache.history(cache.TILT, tilt), db.state_cache.history(cache.SOIL, soil),
+            db.moisture_stats.min(soil), dict(db.rainfall_totals.totals(weather)), db.event_states.current('site0'))
+
+
+def test_snapshot_and_newer_rows_match_a_cold_start(site, path):
+    tilt = db.get_sensor(payload.TILT_PORT, TILT).id
+    soil = db.get_sensor(payload.SOIL_PORT, SOIL).id
+    weather = db.get_sensor(payload.WEATHER_PORT, WEATHER).id
+    assert snapshot.save(path) > 0
+    saved = state(tilt, soil, weather)
+    assert [reading.observed_at for reading in saved[0]] == [1, 2, 3]
+    assert saved[2] == 15.0
+    assert saved[3]['1h'] == 2.5
+    snapshot.invalidate()
+
+    # スナップショットの後に別のプロセスが書いた行
+    db.engine.execute(db.TiltSensorData.__table__.insert(), [dict(
+        sensor_id=tilt, received_at=saved[0][-1].received_at, node_state=0, battery_voltage=3.3,
+        observed_at=4, tilt_x=0.9, tilt_y=0.2, tempereture=20.0, table_id=8)])
+    assert snapshot.load(path) == 1
+    restored = state(tilt, soil, weather)
+    assert restored[0][:-1] == saved[0]
+    assert restored[0][-1].observed_at == 4
+    assert restored[1:] == saved[1:]
+
+    snapshot.invalidate()
+    assert state(tilt, soil, weather) == restored
+
+
+def test_snapshot_is_not_used_when_too_far_behind(site, path):
+    snapshot.save(path)
+    detect(tilt_frame(4))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load(path, max_delta=0)
+    assert snapshot.warm_start(path, max_delta=0) is False
+    assert snapshot.warm_start(path + '.missing') is False
+    assert snapshot.warm_start(path) is True
+
+
+def test_unreadable_snapshot(site, path):
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(b'not a snapshot')
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read(path)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+The SQLite backend opens the gateway file in WAL mode with foreign keys,
+and a reader does not wait for a writer.
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import exc
+
+import db
+
+
+@pytest.fixture
+def path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'data', 'detector.db')
+    shutil.rmtree(directory)
+
+
+def test_backend_url(monkeypatch, path):
+    monkeypatch.setenv('SSS_SQLITE_PATH', path)
+    assert db.backend_url('sqlite') == 'sqlite:///' + path
+    with pytest.raises(ValueError):
+        db.backend_url('postgres')
+
+
+def test_file_is_opened_with_pragmas(path):
+    engine = db.create_db_engine('sqlite:///' + path, count_queries=False)
+    try:
+        db.Base.metadata.create_all(bind=engine)
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert engine.execute('PRAGMA foreign_keys').scalar() == 1
+        # 登録されていないセンサのデータは入らない
+        with pytest.raises(exc.IntegrityError):
+            engine.execute(db.TiltSensorData.__table__.insert(), [dict(sensor_id=99, observed_at=1)])
+    finally:
+        engine.dispose()
+
+
+def test_reader_does_not_wait_for_a_writer(path):
+    engine = db.create_db_engine('sqlite:///' + path, count_queries=False)
+    try:
+        db.Base.metadata.create_all(bind=engine)
+        engine.execute(db.TiltSensor.__table__.insert(), [dict(name='tilt', mac='00:01', threshold=10)])
+        writer = engine.connect()
+        transaction = writer.begin()
+        writer.execute(db.TiltSensor.__table__.insert(), [dict(name='tilt', mac='00:02', threshold=10)])
+        # 書き込み中のトランザクションがあっても，コミット済みの行は読める
+        assert engine.execute('SELECT count(*) FROM tilt_sensors').scalar() == 1
+        transaction.commit()
+        writer.close()
+        assert engine.execute('SELECT count(*) FROM tilt_sensors').scalar() == 2
+    finally:
+        engine.dispose()
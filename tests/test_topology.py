@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Sites are read from the JSON topology or, without one, from the old
+environment variables, and every MAC is located in its site and group.
+"""
+
+import json
+import os
+import tempfile
+
+import topology
+
+CONFIG = {
+    'default': 'slope1',
+    'sites': [
+        {
+            'name': 'slope1',
+            'groups': {'ABCD': ['00:00:00:00:00:00:00:0a', '00:00:00:00:00:00:00:0b'], 'E': ['00:00:00:00:00:00:00:0e']},
+            'default_group': 'ABCD',
+            'soil': '00:00:00:00:00:00:01:00',
+            'weather': '00:11:22:33:44:55',
+            'thresholds': {'alert': 50.0, 'caution': '10'},
+            'rain': {'1h': 40.0, '24h': '150'},
+        },
+        {
+            'name': 'slope2',
+            'groups': {'A': ['00:00:00:00:00:00:02:0a']},
+        },
+    ],
+}
+
+
+def test_sites_are_located_by_mac():
+    sites = topology.Topology.from_dict(CONFIG)
+    slope1, slope2 = list(sites)
+    assert sites.locate('00:00:00:00:00:00:00:0B') == (slope1, 'ABCD')
+    assert sites.locate('00:00:00:00:00:00:00:0e') == (slope1, 'E')
+    assert sites.locate('00:00:00:00:00:00:01:00') == (slope1, 'ABCD')
+    assert sites.locate('00:11:22:33:44:55') == (slope1, None)
+    assert sites.locate('00:00:00:00:00:00:02:0a') == (slope2, 'A')
+    # どのサイトにもないセンサはデフォルトのサイト
+    assert sites.locate('ff:ff:ff:ff:ff:ff:ff:ff') == (slope1, 'ABCD')
+    assert topology.Topology.from_dict({'sites': CONFIG['sites']}).locate('ff:ff') == (None, None)
+    assert (slope1.alert_threshold, slope1.caution_threshold) == (50.0, 10.0)
+    assert slope1.rain_thresholds == {'1h': 40.0, '24h': 150.0, 'intensity': 30.0}
+    assert slope2.default_group == 'A'
+    assert slope2.group_key('A') == 'slope2/A'
+
+
+def test_load_reads_the_file(monkeypatch):
+    path = os.path.join(tempfile.mkdtemp(), 'topology.json')
+    with open(path, 'w') as f:
+        json.dump(CONFIG, f)
+    monkeypatch.setenv('SSS_TOPOLOGY', path)
+    assert [site.name for site in topology.load()] == ['slope1', 'slope2']
+
+
+def test_environment_builds_one_site(monkeypatch):
+    monkeypatch.delenv('SSS_TOPOLOGY', raising=False)
+    monkeypatch.setenv('SSS_SITE_NAME', 'field')
+    for k in 'ABCDE':
+        monkeypatch.setenv('FIELD_TILT_MAC_' + k, '00:00:00:00:00:00:00:0' + k.lower())
+    monkeypatch.delenv('FIELD_TILT_MAC_D')
+    monkeypatch.setenv('SOIL_MAC', '00:00:00:00:00:00:01:00')
+    monkeypatch.setenv('Y_ALERT_THRESHOLD', '50')
+    monkeypatch.delenv('Y_CAUTION_THRESHOLD', raising=False)
+    monkeypatch.setenv('RAIN_3H_THRESHOLD', '80')
+    sites = topology.load()
+    site, = sites
+    assert site.name == 'field'
+    assert site.groups['ABCD'] == ['00:00:00:00:00:00:00:0a', '00:00:00:00:00:00:00:0b', '00:00:00:00:00:00:00:0c']
+    assert sites.locate('00:00:00:00:00:00:00:0e') == (site, 'E')
+    assert (site.alert_threshold, site.caution_threshold) == (50.0, None)
+    assert site.rain_thresholds == {'3h': 80.0, 'intensity': 30.0}
+    assert sites.default is site
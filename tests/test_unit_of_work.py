@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+A unit of work that fails leaves no pending row, cached reading or
+aggregate of its data behind.
+"""
+
+from collections import OrderedDict
+
+import pytest
+
+import db
+import cache
+import payload
+import detector_v1 as detector
+from topology import Site, Topology
+
+TILT = '00:00:00:00:00:00:00:01'
+SOIL = '00:00:00:00:00:00:01:00'
+
+
+def tilt_frame(observed_at, tilt_x=0.1):
+    return payload.parse_fields(['52660', TILT, '170302185339', TILT.replace(':', ''), '00', '3.3', '1',
+                                 str(observed_at), str(tilt_x), '0.2', '20', '8'])
+
+
+def soil_frame(data_get_at, moisture):
+    return payload.parse_fields(['52652', SOIL, '170302185339', '4002', '1001', '14',
+                                 '000101{0:06d}'.format(data_get_at), '0003', '-5.45', str(moisture), '0'])
+
+
+@pytest.fixture
+def site(held_writes, monkeypatch):
+    # 土中水分センサが登録されていないので，傾斜センサのデータの検知は保存した後に失敗する
+    site = Site('site0', OrderedDict([('A', [TILT])]), soil_mac=SOIL, alert_threshold=50.0, caution_threshold=10.0)
+    topology = Topology([site])
+    monkeypatch.setattr(detector, 'site_topology', topology)
+    db.sensor_registry.define_group(site.group_key('A'), payload.TILT_PORT, [TILT])
+    db.add_tilt_sensor('tilt sensor', TILT, 10)
+    return site
+
+
+def detect(frame):
+    with db.unit_of_work():
+        return detector.detect(frame)
+
+
+def test_failed_unit_leaves_nothing_pending(site):
+    sensor = db.get_sensor(payload.TILT_PORT, TILT)
+    with pytest.raises(AttributeError):
+        detect(tilt_frame(1))
+    assert db.write_buffer.pending(db.TiltSensorData.__table__) == []
+    assert db.state_cache.history(cache.TILT, sensor.id) == []
+    assert db.sensor_features.features(cache.TILT, sensor.id).x.count == 0
+
+
+def test_failed_unit_keeps_earlier_rows(site):
+    db.add_soil_sensor('soil sensor', SOIL, 50)
+    soil = db.get_sensor(payload.SOIL_PORT, SOIL)
+    detect(soil_frame(1, 20.0))
+    sensor = db.get_sensor(payload.TILT_PORT, TILT)
+    detect(tilt_frame(1))
+
+    def fail(site, group, *args):
+        raise RuntimeError("detection failed")
+
+    original = detector.detect_by_algo
+    detector.detect_by_algo = fail
+    try:
+        with pytest.raises(RuntimeError):
+            detect(soil_frame(2, 10.0))
+        with pytest.raises(RuntimeError):
+            detect(tilt_frame(2, 0.5))
+    finally:
+        detector.detect_by_algo = original
+    assert [row['moisture'] for row in db.write_buffer.pending(db.SoilSensorData.__table__)] == [20.0]
+    assert [row['observed_at'] for row in db.write_buffer.pending(db.TiltSensorData.__table__)] == [1]
+    assert [reading.moisture for reading in db.state_cache.history(cache.SOIL, soil.id)] == [20.0]
+    assert db.state_cache.latest(cache.TILT, sensor.id).observed_at == 1
+    assert db.state_cache.latest_diff(cache.TILT, sensor.id) == (0.0, 0.0)
+    assert db.moisture_stats.min(soil.id) == 20.0
+    assert db.moisture_stats.stats(soil.id).count == 1
+
+
+def test_rows_already_written_stay(site):
+    sensor = db.get_sensor(payload.TILT_PORT, TILT)
+
+    def failing_detect(frame):
+        with db.unit_of_work():
+            sensor.save_data(frame)
+            db.write_buffer.flush()
+            raise RuntimeError("detection failed")
+
+    with pytest.raises(RuntimeError):
+        failing_detect(tilt_frame(1))
+    assert db.state_cache.latest(cache.TILT, sensor.id).observed_at == 1
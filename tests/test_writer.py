@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Failed batches of the write-behind buffer must not block the rows behind them.
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import MetaData, Table, Column, Integer, ForeignKey, select, func, exc
+
+import db
+import metrics
+import writer
+
+
+@pytest.fixture
+def tables():
+    directory = tempfile.mkdtemp()
+    engine = db.create_db_engine('sqlite:///' + os.path.join(directory, 'writer.db'), count_queries=False)
+    metadata = MetaData()
+    parents = Table('parents', metadata, Column('id', Integer, primary_key=True))
+    children = Table('children', metadata, Column('id', Integer, primary_key=True),
+                     Column('parent_id', Integer, ForeignKey('parents.id')), Column('value', Integer))
+    metadata.create_all(bind=engine)
+    engine.execute(parents.insert(), [{'id': 1}])
+    yield engine, parents, children
+    engine.dispose()
+    shutil.rmtree(directory)
+
+
+def count(engine, table):
+    return engine.execute(select([func.count()]).select_from(table)).scalar()
+
+
+def test_integrity_error_drops_only_the_bad_rows(tables):
+    engine, parents, children = tables
+    dropped = metrics.write_dropped_rows.value(('children',))
+    buffer = writer.WriteBehindBuffer(engine, batch_size=100, flush_interval=0)
+    buffer.batch_size = 4
+    buffer.flush_interval = 60
+    buffer.insert(children, [{'parent_id': 1, 'value': 1}, {'parent_id': 99, 'value': 2}])
+    buffer.update(parents, 1, {'id': 1})
+    buffer.insert(children, [{'parent_id': 1, 'value': 3}])
+    # バッチが一杯になった時点のフラッシュは投げずに，不正な行だけを捨てる
+    assert count(engine, children) == 2
+    assert metrics.write_dropped_rows.value(('children',)) == dropped + 1
+    buffer.insert(children, [{'parent_id': 1, 'value': 4}])
+    buffer.flush()
+    assert count(engine, children) == 3
+    assert buffer.pending(children) == []
+
+
+class DownEngine(object):
+    """
+    接続できないDB
+    """
+
+    def __init__(self):
+        self.attempts = 0
+
+    def begin(self):
+        self.attempts += 1
+        raise exc.OperationalError('INSERT', {}, Exception('database is down'))
+
+
+def test_connection_errors_are_retried_then_dropped(tables):
+    _, _, children = tables
+    engine = DownEngine()
+    dropped = metrics.write_dropped_rows.value(('children',))
+    buffer = writer.WriteBehindBuffer(engine, batch_size=1, flush_interval=60, max_retries=2, backoff=0)
+    buffer.insert(children, [{'parent_id': 1, 'value': 1}])
+    # 書き込めなかった行は残る
+    assert engine.attempts == 1
+    assert len(buffer.pending(children)) == 1
+    with pytest.raises(exc.OperationalError):
+        buffer.flush()
+    assert len(buffer.pending(children)) == 1
+    with pytest.raises(exc.OperationalError):
+        buffer.flush()
+    assert engine.attempts == 3
+    assert buffer.pending(children) == []
+    assert metrics.write_dropped_rows.value(('children',)) == dropped + 1
+
+
+def test_backoff_holds_automatic_flushes(tables):
+    _, _, children = tables
+    engine = DownEngine()
+    buffer = writer.WriteBehindBuffer(engine, batch_size=1, flush_interval=60, backoff=30)
+    buffer.insert(children, [{'parent_id': 1, 'value': 1}])
+    buffer.insert(children, [{'parent_id': 1, 'value': 2}])
+    assert engine.attempts == 1
+    assert len(buffer.pending(children)) == 2
+
+
+def test_alert_is_returned_when_the_flush_fails(memory_db, monkeypatch):
+    engine = DownEngine()
+    buffer = writer.WriteBehindBuffer(engine, batch_size=100, flush_interval=60, backoff=0)
+    monkeypatch.setattr(buffer, 'start', lambda: None)
+    monkeypatch.setattr(db, 'write_buffer', buffer)
+    assert db.add_event(2, -1, 'site0', flush=True)
+    assert engine.attempts == 1
+    # 警戒イベントの行は次のフラッシュで再試行する
+    assert len(buffer.pending(db.Event.__table__)) == 1
+
+
+def test_check_unique_skips_existing_keys(tables):
+    engine, _, children = tables
+    duplicates = metrics.duplicates.value(('db',))
+    buffer = writer.WriteBehindBuffer(engine, batch_size=100, flush_interval=0)
+    # パーティション化したテーブルのように，DBのユニークインデックスが重複を弾かない
+    buffer.check_unique(children, ('parent_id', 'value'))
+    buffer.insert(children, [{'parent_id': 1, 'value': 1}])
+    buffer.insert(children, [{'parent_id': 1, 'value': 1}, {'parent_id': 1, 'value': 2}, {'parent_id': 1, 'value': 2}])
+    assert sorted(row.value for row in engine.execute(select([children.c.value]))) == [1, 2]
+    assert metrics.duplicates.value(('db',)) == duplicates + 2
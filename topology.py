@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+サイトとそのセンサの構成．SSS_TOPOLOGY の JSON か，なければ環境変数から作る
+"""
+
+import os
+import json
+from collections import OrderedDict
+
+from registry import normalize_mac
+
+
+# 降雨強度 (R) のしきい値の既定値
+RAIN_INTENSITY_THRESHOLD = 30.0
+
+
+def to_float(value):
+    return None if value in (None, '') else float(value)
+
+
+def rain_thresholds(config):
+    """
+    {'1h': 雨量, ..., 'intensity': 降雨強度}．設定されていないものは含めない
+    """
+    config = dict(config or {})
+    config.setdefault('intensity', RAIN_INTENSITY_THRESHOLD)
+    thresholds = dict((key, to_float(value)) for key, value in config.items())
+    return dict((key, value) for key, value in thresholds.items() if value is not None)
+
+
+class Site(object):
+
+    def __init__(self, name, groups, soil_mac=None, weather_mac=None,
+                 alert_threshold=None, caution_threshold=None, default_group=None, rain_thresholds=None):
+        self.name = name
+        self.groups = OrderedDict((group, [mac for mac in macs if mac]) for group, macs in groups.items())
+        self.soil_mac = soil_mac
+        self.weather_mac = weather_mac
+        self.alert_threshold = alert_threshold
+        self.caution_threshold = caution_threshold
+        self.rain_thresholds = rain_thresholds if rain_thresholds is not None \
+            else {'intensity': RAIN_INTENSITY_THRESHOLD}
+        # トポロジにない傾斜センサと土中水分センサのデータで評価するグループ
+        self.default_group = default_group or (list(self.groups)[0] if self.groups else None)
+
+    def group_key(self, group):
+        return "{0}/{1}".format(self.name, group)
+
+    def __repr__(self):
+        return "Site({0})".format(self.name)
+
+
+class Topology(object):
+
+    def __init__(self, sites, default=None):
+        self.sites = OrderedDict((site.name, site) for site in sites)
+        self.default = self.sites.get(default) if default else None
+        self._index = {}
+        for site in sites:
+            for group, macs in site.groups.items():
+                for mac in macs:
+                    self._index[normalize_mac(mac)] = (site, group)
+            if site.soil_mac:
+                self._index[normalize_mac(site.soil_mac)] = (site, site.default_group)
+            if site.weather_mac:
+                self._index[normalize_mac(site.weather_mac)] = (site, None)
+
+    def __iter__(self):
+        return iter(self.sites.values())
+
+    def locate(self, mac):
+        """
+        MACアドレスからサイトとグループを求める．見つからなければデフォルトのサイト
+        """
+        located = self._index.get(normalize_mac(mac))
+        if located is not None:
+            return located
+        if self.default is not None:
+            return self.default, self.default.default_group
+        return None, None
+
+    @classmethod
+    def from_dict(cls, config):
+        sites = []
+        for site in config['sites']:
+            thresholds = site.get('thresholds', {})
+            sites.append(Site(site['name'], site.get('groups', {}),
+                              soil_mac=site.get('soil'),
+                              weather_mac=site.get('weather'),
+                              alert_threshold=to_float(thresholds.get('alert')),
+                              caution_threshold=to_float(thresholds.get('caution')),
+                              default_group=site.get('default_group'),
+                              rain_thresholds=rain_thresholds(site.get('rain'))))
+        return cls(sites, config.get('default'))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f, object_pairs_hook=OrderedDict))
+
+    @classmethod
+    def from_env(cls):
+        name = os.getenv('SSS_SITE_NAME', 'default')
+        site = Site(name,
+                    OrderedDict([
+                        ('ABCD', [os.getenv('FIELD_TILT_MAC_' + k) for k in 'ABCD']),
+                        ('E', [os.getenv('FIELD_TILT_MAC_E')]),
+                    ]),
+                    soil_mac=os.getenv('SOIL_MAC'),
+                    weather_mac=os.getenv('WEATHER_MAC'),
+                    alert_threshold=to_float(os.getenv('Y_ALERT_THRESHOLD')),
+                    caution_threshold=to_float(os.getenv('Y_CAUTION_THRESHOLD')),
+                    default_group='ABCD',
+                    rain_thresholds=rain_thresholds({
+                        '1h': os.getenv('RAIN_1H_THRESHOLD'),
+                        '3h': os.getenv('RAIN_3H_THRESHOLD'),
+                        '24h': os.getenv('RAIN_24H_THRESHOLD'),
+                        'intensity': os.getenv('RAIN_INTENSITY_THRESHOLD', str(RAIN_INTENSITY_THRESHOLD)),
+                    }))
+        return cls([site], name)
+
+
+def load():
+    path = os.getenv('SSS_TOPOLOGY')
+    if path:
+        return Topology.from_file(path)
+    return Topology.from_env()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from sqlalchemy import bindparam, exc, select, and_
+
+import metrics
+import logs
+
+logger = logs.get_logger(__name__, 'writer')
+
+
+def is_transient(error):
+    """
+    DBにつながらない・ロックが取れないなど，時間をおけば書き込めるエラーか
+    """
+    return isinstance(error, (exc.OperationalError, exc.DisconnectionError, exc.TimeoutError)) \
+        or getattr(error, 'connection_invalidated', False)
+
+
+def insert_ignore(table):
+    """
+    ユニークキーに違反する行を飛ばすINSERT (MySQL: INSERT IGNORE, SQLite: INSERT OR IGNORE)
+    """
+    return table.insert().prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite')
+
+
+class WriteBehindBuffer(object):
+    """
+    挿入と更新をためて1トランザクションで書き込む
+    テーブルごとの挿入は executemany，更新は (テーブル, 主キー) ごとに最新の値だけを書く．
+    batch_size 行たまるか，一番古い行が flush_interval 秒たつか，flush を呼ぶと書き込む (0 ならすぐ書き込む)．
+    一時的なエラーは backoff を倍にしながら max_retries 回まで再送し，それ以外のエラーは1行ずつ書き直して失敗した行だけを捨てる
+    """
+
+    def __init__(self, engine, batch_size=100, flush_interval=1.0, ignore_duplicates=(),
+                 max_retries=10, backoff=0.5, max_backoff=60.0):
+        self.engine = engine
+        self.ignore_duplicates = set(ignore_duplicates)
+        self.unique_keys = {}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._failures = 0
+        self._retry_at = 0.0
+        self._inserts = OrderedDict()
+        self._updates = OrderedDict()
+        self._flushing = OrderedDict()
+        self._size = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        atexit.register(self.close)
+
+    def start(self):
+        if self.flush_interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval / 2.0)
+            oldest = self._oldest
+            if oldest is not None and time.time() - oldest >= self.flush_interval:
+                self.try_flush()
+
+    def close(self):
+        """
+        終了時に残っている行を書く
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("rows left unwritten at exit: {0}".format(e))
+
+    def try_flush(self):
+        """
+        自動のフラッシュと警戒イベントのフラッシュ．再試行を待っている間は書き込まず，失敗しても呼び出し元には投げない
+        """
+        if time.time() < self._retry_at:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning("write-behind flush failed: {0}".format(e))
+
+    def _added(self, count):
+        self._size += count
+        if self._oldest is None:
+            self._oldest = time.time()
+        return self._size >= self.batch_size or self.flush_interval <= 0
+
+    def insert(self, table, rows):
+        self.start()
+        with self._lock:
+            self._inserts.setdefault(table, []).extend(rows)
+            full = self._added(len(rows))
+        if full:
+            self.try_flush()
+
+    def update(self, table, pk, values):
+        self.start()
+        with self._lock:
+            key = (table, pk)
+            if key in self._updates:
+                self._updates[key].update(values)
+                full = self.flush_interval <= 0
+            else:
+                self._updates[key] = dict(values)
+                full = self._added(1)
+        if full:
+            self.try_flush()
+
+    def discard(self, table, rows):
+        """
+        insert した行を取り消す．書き込みを始めていればなにもせずFalseを返す
+        """
+        discarded = set(id(row) for row in rows)
+        with self._lock:
+            pending = self._inserts.get(table, [])
+            kept = [row for row in pending if id(row) not in discarded]
+            if len(pending) - len(kept) < len(discarded):
+                return False
+            if kept:
+                self._inserts[table] = kept
+            else:
+                del self._inserts[table]
+            self._size -= len(discarded)
+            if self._size <= 0:
+                self._size, self._oldest = 0, None
+        return True
+
+    def pending(self, table):
+        """
+        まだコミットされていない行
+        """
+        with self._lock:
+            return self._flushing.get(table, []) + self._inserts.get(table, [])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                inserts, updates = self._inserts, self._updates
+                self._inserts, self._updates = OrderedDict(), OrderedDict()
+                self._flushing = inserts
+                self._size, self._oldest = 0, None
+            if not inserts and not updates:
+                return
+            try:
+                try:
+                    with metrics.stage_seconds.time(('flush',)), self.engine.begin() as conn:
+                        self._write(conn, inserts, updates)
+                except Exception as e:
+                    if is_transient(e):
+                        raise
+                    # 1行ずつ書き直し，書けない行だけを捨てる
+                    logger.warning("batch failed, writing it row by row: {0}".format(e))
+                    self._write_rows(inserts, updates)
+            except Exception as e:
+                self._failed(inserts, updates, e)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = OrderedDict()
+            self._failures, self._retry_at = 0, 0.0
+            logger.info("flushed %s inserts, %s updates",
+                        sum(len(rows) for rows in inserts.values()), len(updates), extra=logs.sampled())
+
+    def _write(self, conn, inserts, updates):
+        for table, rows in inserts.items():
+            self._insert(conn, table, rows)
+        for (table, columns), params in self._group_updates(updates).items():
+            conn.execute(self._update_statement(table, columns), params)
+
+    def _write_rows(self, inserts, updates):
+        """
+        1行ずつ別のトランザクションで書く．接続のエラーなら書いていない行を残して投げる
+        """
+        operations = [(table, row, None) for table, rows in inserts.items() for row in rows] + \
+                     [(table, values, pk) for (table, pk), values in updates.items()]
+        for i, (table, values, pk) in enumerate(operations):
+            try:
+                with self.engine.begin() as conn:
+                    if pk is None:
+                        self._insert(conn, table, [values])
+                    else:
+                        self._write(conn, {}, {(table, pk): values})
+            except Exception as e:
+                if is_transient(e):
+                    inserts.clear()
+                    updates.clear()
+                    for table, values, pk in operations[i:]:
+                        if pk is None:
+                            inserts.setdefault(table, []).append(values)
+                        else:
+                            updates[(table, pk)] = values
+                    raise
+                self._drop(table, [values], e)
+
+    def _failed(self, inserts, updates, error):
+        self._failures += 1
+        if self._failures > self.max_retries:
+            logger.error("write-behind gave up after {0} failures".format(self._failures))
+            for table, rows in inserts.items():
+                self._drop(table, rows, error)
+            for (table, pk), values in updates.items():
+                self._drop(table, [values], error)
+            self._failures, self._retry_at = 0, 0.0
+            return
+        self._retry_at = time.time() + min(self.backoff * 2 ** (self._failures - 1), self.max_backoff)
+        self._restore(inserts, updates)
+
+    def _drop(self, table, rows, error):
+        metrics.write_dropped_rows.inc(len(rows), (table.name,))
+        for row in rows:
+            logger.error("dropped row of {0}: {1}".format(table.name, error),
+                         extra=logs.fields(table=table.name, row=row))
+
+    def check_unique(self, table, columns):
+        """
+        table の columns の組が既にある行は書き込まない．
+        ユニークインデックスに別の列が入っていて，DBが重複を弾かないテーブルに使う
+        """
+        self.unique_keys[table] = tuple(columns)
+
+    def _new_rows(self, conn, table, rows):
+        """
+        rows のうち，キーがDBにもバッチの前の行にもない行
+        """
+        columns = self.unique_keys[table]
+        first = table.c[columns[0]]
+        values = set(row[columns[0]] for row in rows)
+        existing = set(tuple(key) for key in conn.execute(
+            select([table.c[column] for column in columns]).where(first.in_(values))
+            .where(and_(*[table.c[column].in_(set(row[column] for row in rows)) for column in columns[1:]]))))
+        new = []
+        for row in rows:
+            key = tuple(row[column] for column in columns)
+            if key not in existing:
+                existing.add(key)
+                new.append(row)
+        return new
+
+    def _insert(self, conn, table, rows):
+        if table in self.unique_keys:
+            new = self._new_rows(conn, table, rows)
+            if len(new) < len(rows):
+                metrics.duplicates.inc(len(rows) - len(new), ('db',))
+                logger.info("skipped {0} duplicate rows of {1}".format(len(rows) - len(new), table.name))
+            rows = new
+            if not rows:
+                return
+        if table not in self.ignore_duplicates:
+            conn.execute(table.insert(), rows)
+            return
+        result = conn.execute(insert_ignore(table), rows)
+        if 0 <= result.rowcount < len(rows):
+            metrics.duplicates.inc(len(rows) - result.rowcount, ('db',))
+            logger.info("skipped {0} duplicate rows of {1}".format(len(rows) - result.rowcount, table.name))
+
+    def _group_updates(self, updates):
+        # 同じ列を更新する行はexecutemanyでまとめて書き込む
+        groups = OrderedDict()
+        for (table, pk), values in updates.items():
+            params = dict(('v_' + k, v) for k, v in values.items())
+            params['v_pk'] = pk
+            groups.setdefault((table, tuple(sorted(values))), []).append(params)
+        return groups
+
+    def _update_statement(self, table, columns):
+        pk = list(table.primary_key.columns)[0]
+        return table.update().where(pk == bindparam('v_pk'))\
+                    .values(**dict((k, bindparam('v_' + k)) for k in columns))
+
+    def _restore(self, inserts, updates):
+        # 書き込みに失敗した行を戻し，次のフラッシュで再試行する
+        with self._lock:
+            for table, rows in self._inserts.items():
+                inserts.setdefault(table, []).extend(rows)
+            for key, values in self._updates.items():
+                if key in updates:
+                    updates[key].update(values)
+                else:
+                    updates[key] = values
+            self._inserts, self._updates = inserts, updates
+            self._size = sum(len(rows) for rows in inserts.values()) + len(updates)
+            self._oldest = time.time()